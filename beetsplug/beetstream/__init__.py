@@ -15,7 +15,7 @@
 
 """Beetstream is a Beets.io plugin that exposes SubSonic API endpoints."""
 from beets.plugins import BeetsPlugin
-from beets import ui
+from beets import library, ui
 import flask
 from flask import g
 from flask_cors import CORS
@@ -46,7 +46,15 @@ import beetsplug.beetstream.songs
 import beetsplug.beetstream.users
 import beetsplug.beetstream.auth
 import beetsplug.beetstream.queue
+import beetsplug.beetstream.bookmarks
 import beetsplug.beetstream.playlist
+import beetsplug.beetstream.metrics
+from beetsplug.beetstream.searchindex import SEARCH_INDEX
+from beetsplug.beetstream.albums import ALBUM_ORDER
+from beetsplug.beetstream.artists import ARTIST_INDEX
+from beetsplug.beetstream.server import run_server
+from beetsplug.beetstream.cache import GENERATION_UPDATER
+from beetsplug.beetstream.profiling import enable_profiling
 
 # Plugin hook.
 class BeetstreamPlugin(BeetsPlugin):
@@ -55,17 +63,102 @@ class BeetstreamPlugin(BeetsPlugin):
         self.config.add({
             'host': u'0.0.0.0',
             'port': 8080,
+            'server': u'flask',
+            'workers': 2,
+            'threads': 8,
+            'keepalive': 5,
+            'graceful_timeout': 30,
             'cors': '*',
             'cors_supports_credentials': True,
             'reverse_proxy': False,
             'include_paths': False,
             'playlist_dir': None,
+            'mapping_cache_size': 100000,
+            'database': None,
+            'play_queue': u'sqlite',
+            'ignored_articles': u'The El La Los Las Le Les',
+            'stream_offload': None,
+            'accel_redirect_location': '/beetstream-files',
+            'transcode': {
+                'command': u'ffmpeg -v error -i $source -map 0:a:0 '
+                           u'-b:a ${bitrate}k -f $format -',
+                'format': u'mp3',
+                'bitrate': 192,
+                'max_processes': 4,
+                'timeout': 10,
+                'cache_dir': None,
+                'cache_size': 1024,
+            },
+            'thumbnails': {
+                'cache_dir': None,
+                'format': u'jpeg',
+                'quality': 85,
+                'sizes': [80, 160, 300, 600],
+                'max_age': 7 * 24 * 3600,
+                'cache_size': 1024,
+            },
+            'response_cache': {
+                'backend': u'memory',
+                'size': 64,
+                'cache_dir': None,
+            },
+            'profile': {
+                'threshold': 0.5,
+                'sample_rate': 0.05,
+                'interval': 0.005,
+                'directory': None,
+                'max_files': 100,
+            },
         })
+        # Also used outside of the server, to track library changes
+        app.config.setdefault('config', self.config)
+
+        self.register_listener('database_change', self.on_database_change)
+        self.register_listener('item_imported', self.on_item_imported)
+        self.register_listener('album_imported', self.on_album_imported)
+        self.register_listener('item_removed', self.on_item_removed)
+        self.register_listener('album_removed', self.on_album_removed)
+        self.register_listener('cli_exit', self.on_cli_exit)
+
+    def on_database_change(self, lib, model):
+        GENERATION_UPDATER.changed()
+        if isinstance(model, library.Item):
+            SONG_CACHE.invalidate(model.id)
+            SEARCH_INDEX.update_item(model)
+        elif isinstance(model, library.Album):
+            ALBUM_CACHE.invalidate(model.id)
+            ALBUM_ORDER.invalidate()
+            SEARCH_INDEX.update_album(model)
+            ARTIST_INDEX.update_album(lib, model)
+        else:
+            SONG_CACHE.invalidate()
+            ALBUM_CACHE.invalidate()
+            ALBUM_ORDER.invalidate()
+
+    def on_item_imported(self, lib, item):
+        SONG_CACHE.invalidate(item.id)
+
+    def on_album_imported(self, lib, album):
+        ALBUM_CACHE.invalidate(album.id)
+        ALBUM_ORDER.invalidate()
+
+    def on_item_removed(self, item):
+        SEARCH_INDEX.remove_item(item)
+
+    def on_album_removed(self, album):
+        SEARCH_INDEX.remove_album(album)
+        ALBUM_ORDER.invalidate()
+        ARTIST_INDEX.remove_album(album._db, album)
+
+    def on_cli_exit(self, lib):
+        GENERATION_UPDATER.flush()
 
     def commands(self):
         cmd = ui.Subcommand('beetstream', help=u'run Beetstream server, exposing SubSonic API')
         cmd.parser.add_option(u'-d', u'--debug', action='store_true',
                               default=False, help=u'debug mode')
+        cmd.parser.add_option(u'-p', u'--profile', action='store_true',
+                              default=False, help=u'profile and log slow requests')
 
         def func(lib, opts, args):
             args = ui.decargs(args)
@@ -75,13 +168,21 @@ class BeetstreamPlugin(BeetsPlugin):
                 self.config['port'] = int(args.pop(0))
 
             app.config['lib'] = lib
+            beetsplug.beetstream.albums.create_album_list_indexes(lib)
             # Normalizes json output
             app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
             app.config['INCLUDE_PATHS'] = self.config['include_paths']
 
+            # Let the front-end server send files with X-Sendfile
+            app.config['USE_X_SENDFILE'] = \
+                self.config['stream_offload'].get() == 'x-sendfile'
+
             app.config['config'] = self.config
 
+            SONG_CACHE.max_size_ = self.config['mapping_cache_size'].get(int)
+            ALBUM_CACHE.max_size_ = self.config['mapping_cache_size'].get(int)
+
             # Enable CORS if required.
             if self.config['cors']:
                 self._log.info(u'Enabling CORS with origin: {0}',
@@ -102,12 +203,27 @@ class BeetstreamPlugin(BeetsPlugin):
                 app.wsgi_app = ReverseProxied(app.wsgi_app)
                 app.wsgi_app = ProxyFix(app.wsgi_app)
 
+            if opts.profile:
+                enable_profiling(self.config)
+
             # Start the web application.
-            app.run(host=self.config['host'].as_str(),
-                    port=self.config['port'].get(int),
-                    debug=opts.debug, threaded=True)
+            run_server(self.config, lib, opts.debug, self._log)
         cmd.func = func
-        return [cmd]
+
+        thumbs_cmd = ui.Subcommand('beetstream-thumbs',
+                                   help=u'pre-render cover art thumbnails')
+        thumbs_cmd.parser.add_option(u'-s', u'--size', action='append', type='int',
+                                     dest='sizes', help=u'size to render (repeatable)')
+        thumbs_cmd.parser.add_option(u'-j', u'--jobs', type='int', default=None,
+                                     help=u'number of worker processes')
+
+        def thumbs_func(lib, opts, args):
+            sizes = opts.sizes or self.config['thumbnails']['sizes'].get(list)
+            beetsplug.beetstream.thumbnails.pregenerate_thumbnails(
+                lib, self.config, sizes, opts.jobs, self._log)
+        thumbs_cmd.func = thumbs_func
+
+        return [cmd, thumbs_cmd]
 
 class ReverseProxied(object):
     '''Wrap the application in this middleware and configure the
@@ -2,17 +2,17 @@ from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
 import flask
 from flask import g, request
-from PIL import Image
-import io
-from random import shuffle
-from beets.dbcore.query import (
-    AndQuery,
-    MatchQuery,
-)
+from beetsplug.beetstream.thumbnails import thumbnail_response, thumbnail_size
+from beetsplug.beetstream.plays import most_played_albums, recently_played_albums
+from beetsplug.beetstream.annotations import starred
+from beetsplug.beetstream.cache import cached_response
+import sqlite3
+import threading
 
 
 @app.route('/rest/getAlbum', methods=["GET", "POST"])
 @app.route('/rest/getAlbum.view', methods=["GET", "POST"])
+@cached_response(plays=True)
 def get_album():
     id = int(album_subid_to_beetid(request.values.get('id')))
 
@@ -21,57 +21,145 @@ def get_album():
 
     return subsonic_response(request, {
         'album': {
-            **map_album(album),
-            "song": list(map(map_song, songs)),
+            **map_album(album, songs_stats(songs)),
+            "song": map_songs(songs),
         }
     })
 
+def random_album_list():
+    return request.values.get('type') == 'random'
+
 @app.route('/rest/getAlbumList', methods=["GET", "POST"])
 @app.route('/rest/getAlbumList.view', methods=["GET", "POST"])
+@cached_response(unless=random_album_list, plays=True)
 def album_list():
     return get_album_list(1)
 
 
 @app.route('/rest/getAlbumList2', methods=["GET", "POST"])
 @app.route('/rest/getAlbumList2.view', methods=["GET", "POST"])
+@cached_response(unless=random_album_list, plays=True)
 def album_list_2():
     return get_album_list(2)
 
-def get_album_list(version):
-    # TODO type == 'starred' and type == 'frequent'
-    sort_by = request.values.get('type') or 'alphabeticalByName'
-    size = int(request.values.get('size') or 10)
-    offset = int(request.values.get('offset') or 0)
-    fromYear = int(request.values.get('fromYear') or 0)
-    toYear = int(request.values.get('toYear') or 3000)
-    genre = request.values.get('genre')
-
-    albums = list(g.lib.albums())
-
+# Every getAlbumList type is planned as a single WHERE/ORDER BY over the
+# albums table, so SQLite does the filtering, sorting and paging and only the
+# requested page is ever turned into Album objects. Ties are broken by beets'
+# default album sort, which is the order `g.lib.albums()` used to return.
+# The alphabetical orders go through sort_key(), which no index can serve,
+# so they are computed once and kept by ALBUM_ORDER instead.
+def album_list_clauses(sort_by, fromYear, toYear, genre):
     if sort_by == 'newest':
-        albums.sort(key=lambda album: int(album.added), reverse=True)
+        return '1', (), 'added DESC'
     elif sort_by == 'alphabeticalByName':
-        albums.sort(key=lambda album: strip_accents(album.album).upper())
-    elif sort_by == 'alphabeticalByArtist':
-        albums.sort(key=lambda album: strip_accents(album.albumartist).upper())
+        return '1', (), 'sort_key(album)'
     elif sort_by == 'alphabeticalByArtist':
-        albums.sort(key=lambda album: strip_accents(album.albumartist).upper())
-    elif sort_by == 'recent':
-        albums.sort(key=lambda album: album.year, reverse=True)
+        return '1', (), 'sort_key(albumartist)'
     elif sort_by == 'byGenre':
-        albums = list(filter(lambda album: album.genre.lower() == genre.lower(), albums))
+        return 'genre = ? COLLATE NOCASE', (genre,), None
     elif sort_by == 'byYear':
         # TODO use month and day data to sort
         if fromYear <= toYear:
-            albums = list(filter(lambda album: album.year >= fromYear and album.year <= toYear, albums))
-            albums.sort(key=lambda album: int(album.year))
+            return 'year BETWEEN ? AND ?', (fromYear, toYear), 'year'
         else:
-            albums = list(filter(lambda album: album.year >= toYear and album.year <= fromYear, albums))
-            albums.sort(key=lambda album: int(album.year), reverse=True)
+            return 'year BETWEEN ? AND ?', (toYear, fromYear), 'year DESC'
     elif sort_by == 'random':
-        shuffle(albums)
+        return '1', (), 'RANDOM()'
+    return '1', (), None
+
+PRECOMPUTED_ORDERS = {'alphabeticalByName', 'alphabeticalByArtist'}
+
+class AlbumOrder:
+    """Album ids in the order of an ORDER BY clause, kept in memory so that
+    pages are list slices. The orders are dropped when albums change, from
+    beets' events or, for other processes, when the library file's mtime
+    moves.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.orders_ = {} # ORDER BY clause -> album ids
+        self.db_mtime_ = None
+        self.version_ = 0
+
+    def invalidate(self):
+        with self.lock_:
+            self.orders_ = {}
+            self.version_ += 1
+
+    def get(self, lib, order_by):
+        mtime = library_mtime(lib)
+        with self.lock_:
+            if mtime != self.db_mtime_:
+                self.orders_ = {}
+                self.db_mtime_ = mtime
+                self.version_ += 1
+            ids = self.orders_.get(order_by)
+            version = self.version_
+        if ids is not None:
+            return ids
+
+        register_sql_functions(lib)
+        with lib.transaction() as tx:
+            ids = [row[0] for row in tx.query(f"SELECT id FROM albums ORDER BY {order_by}")]
+        with self.lock_:
+            # Unless albums changed while sorting
+            if self.version_ == version:
+                self.orders_[order_by] = ids
+        return ids
+
+ALBUM_ORDER = AlbumOrder()
+
+def create_album_list_indexes(lib):
+    """Adds the indexes serving album lists, and the song counts and
+    durations of their albums, to the beets library. Lists still work
+    without them, only slower, e.g. when the library is read-only
+    or locked by another beets command.
+    """
+    try:
+        with lib.transaction() as tx:
+            tx.script("""
+                CREATE INDEX IF NOT EXISTS beetstream_albums_added ON albums (added);
+                CREATE INDEX IF NOT EXISTS beetstream_albums_year ON albums (year);
+                CREATE INDEX IF NOT EXISTS beetstream_albums_genre
+                    ON albums (genre COLLATE NOCASE);
+                CREATE INDEX IF NOT EXISTS beetstream_items_album_id ON items (album_id);
+                """)
+    except sqlite3.OperationalError as e:
+        app.logger.warning(f"could not add the album list indexes to the library: {e}")
+
+def query_album_list(sort_by, size, offset, fromYear, toYear, genre):
+    # Listening history lists come from the play counters of the store
+    if sort_by == 'frequent':
+        return albums_by_ids(most_played_albums(size, offset))
+    elif sort_by == 'recent':
+        return albums_by_ids(recently_played_albums(size, offset))
+    elif sort_by == 'starred':
+        return albums_by_ids([int(id) for id in starred(current_user(), 'album', size, offset)])
 
-    albums = handleSizeAndOffset(albums, size, offset)
+    where, subvals, order_by = album_list_clauses(sort_by, fromYear, toYear, genre)
+    default_sort = g.lib.get_default_album_sort()
+    tiebreak = None if default_sort.is_slow() else default_sort.order_clause()
+    order_by = ', '.join(filter(None, [order_by, tiebreak, 'id']))
+    if sort_by in PRECOMPUTED_ORDERS:
+        return albums_by_ids(ALBUM_ORDER.get(g.lib, order_by)[offset:offset + size])
+    register_sql_functions(g.lib)
+
+    with g.lib.transaction() as tx:
+        rows = tx.query(
+            f"SELECT id FROM albums WHERE {where} ORDER BY {order_by} LIMIT ? OFFSET ?",
+            (*subvals, size, offset))
+    return albums_by_ids([row[0] for row in rows])
+
+def get_album_list(version):
+    sort_by = request.values.get('type') or 'alphabeticalByName'
+    size = int(request.values.get('size') or 10)
+    offset = int(request.values.get('offset') or 0)
+    fromYear = int(request.values.get('fromYear') or 0)
+    toYear = int(request.values.get('toYear') or 3000)
+    genre = request.values.get('genre')
+
+    albums = query_album_list(sort_by, size, offset, fromYear, toYear, genre)
+    extra = album_annotations(album.id for album in albums)
 
     if version == 1:
         def map_album(album):
@@ -85,42 +173,46 @@ def get_album_list(version):
                 'year': album.year,
                 'coverArt': album_beetid_to_subid(album.id),
                 'created': timestamp_to_iso(album.added),
-                'playCount': 0,
-                # starred
-                # userRating
-                # averageRating
+                **extra[album.id],
             }
 
         return subsonic_response(request, {
             "albumList": {
-                "album": list(map(map_album, albums)),
+                "album": map(map_album, albums),
             }
         })
     elif version == 2:
+        stats = album_stats(album.id for album in albums)
+
         def map_album(album):
-            query = AndQuery([
-                MatchQuery("album", album['album']),
-                MatchQuery("albumartist", album['albumartist']),
-            ])
-            items = g.lib.items(query=query)
+            song_count, duration = stats.get(album.id, (0, 0))
             return {
                 'id': album_beetid_to_subid(album.id),
                 'name': album.album,
                 'artist': album.albumartist,
                 'artistId': artist_name_to_id(album.albumartist),
                 'coverArt': album_beetid_to_subid(album.id),
-                'songCount': len(items),
-                'duration': int(sum([item['length'] for item in items])),
+                'songCount': song_count,
+                'duration': duration,
                 'created': timestamp_to_iso(album.added),
                 'year': album.year,
                 'genre': album.genre,
+                **extra[album.id],
             }
         return subsonic_response(request, {
             "albumList2": {
-                "album": list(map(map_album, albums))
+                "album": map(map_album, albums)
             }
         })
 
+def cover_art_album_ids(id):
+    # Fallback on item id. Some apps use this
+    with g.lib.transaction() as tx:
+        rows = tx.query("SELECT id, 0 FROM albums WHERE id = ? "
+                        "UNION ALL SELECT album_id, 1 FROM items WHERE id = ? AND album_id IS NOT NULL "
+                        "ORDER BY 2 LIMIT 1", (id, id))
+    return [row[0] for row in rows]
+
 @app.route('/rest/getCoverArt', methods=["GET", "POST"])
 @app.route('/rest/getCoverArt.view', methods=["GET", "POST"])
 def cover_art_file():
@@ -130,34 +222,27 @@ def cover_art_file():
 
     query_id = int(album_subid_to_beetid(request.values.get('id')) or -1)
     size = request.values.get('size')
-    album = g.lib.get_album(query_id)
-
-    # Fallback on item id. Some apps use this
-    if not album:
-        item = g.lib.get_item(query_id)
-        if item is not None and item.album_id is not None:
-            album = g.lib.get_album(item.album_id)
-        else:
-            flask.abort(404)
+    albums = albums_by_ids(cover_art_album_ids(query_id))
+    if not albums:
+        flask.abort(404)
+    album = albums[0]
 
-    if album and album.artpath:
+    if album.artpath:
         image_path = album.artpath.decode('utf-8')
 
         if size is not None and int(size) > 0:
-            size = int(size)
-            with Image.open(image_path) as image:
-                bytes_io = io.BytesIO()
-                image = image.resize((size, size))
-                image.convert('RGB').save(bytes_io, 'PNG')
-                bytes_io.seek(0)
-                return flask.send_file(bytes_io, mimetype='image/png')
-
-        return flask.send_file(image_path)
+            size = thumbnail_size(int(size))
+            if size is not None:
+                return thumbnail_response(album, size)
+
+        max_age = app.config['config']['thumbnails']['max_age'].get(int)
+        return flask.send_file(image_path, conditional=True, max_age=max_age)
     else:
         return flask.abort(404)
 
 @app.route('/rest/getGenres', methods=["GET", "POST"])
 @app.route('/rest/getGenres.view', methods=["GET", "POST"])
+@cached_response
 def genres():
     with g.lib.transaction() as tx:
         def get_genres(table):
@@ -185,6 +270,7 @@ def genres():
 
 @app.route('/rest/getMusicDirectory', methods=["GET", "POST"])
 @app.route('/rest/getMusicDirectory.view', methods=["GET", "POST"])
+@cached_response(plays=True)
 def musicDirectory():
     # Works pretty much like a file system
     # Usually Artist first, than Album, than Songs
@@ -200,7 +286,7 @@ def musicDirectory():
             "directory": {
                 "id": artist_id,
                 "name": artist_name,
-                "child": list(map(map_album, albums))
+                "child": map_albums(albums)
             }
         })
     elif id.startswith(ALBUM_ID_PREFIX):
@@ -211,8 +297,8 @@ def musicDirectory():
 
         return subsonic_response(request, {
             "directory": {
-                **map_album(album),
-                "child": list(map(map_song, songs))
+                **map_album(album, songs_stats(songs)),
+                "child": map_songs(songs)
             }
         })
     elif id.startswith(SONG_ID_PREFIX):
@@ -0,0 +1,78 @@
+from beetsplug.beetstream.store import batches, bump_generation, get_store, register_schema
+import time
+
+# Stars and ratings of each user, for songs, albums and artists. Entities
+# are keyed by their beets id, or by name for artists.
+register_schema("""
+    CREATE TABLE IF NOT EXISTS annotations (
+        user TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        starred_at REAL,
+        rating INTEGER,
+        PRIMARY KEY (user, kind, entity)
+    )""")
+register_schema("""
+    CREATE INDEX IF NOT EXISTS annotations_starred ON annotations (user, kind, starred_at DESC)
+    WHERE starred_at IS NOT NULL""")
+register_schema("""
+    CREATE INDEX IF NOT EXISTS annotations_entity ON annotations (kind, entity)""")
+
+def set_starred(user, entities, starred):
+    """Stars or unstars the (kind, entity) pairs for the user."""
+    starred_at = time.time() if starred else None
+    with get_store().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO annotations (user, kind, entity, starred_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user, kind, entity) DO UPDATE SET "
+            "starred_at = CASE WHEN excluded.starred_at IS NULL THEN NULL "
+            "ELSE COALESCE(starred_at, excluded.starred_at) END",
+            ((user, kind, str(entity), starred_at) for kind, entity in entities))
+        prune(conn)
+        bump_generation()
+
+def set_rating(user, kind, entity, rating):
+    with get_store().transaction() as conn:
+        conn.execute(
+            "INSERT INTO annotations (user, kind, entity, rating) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user, kind, entity) DO UPDATE SET rating = excluded.rating",
+            (user, kind, str(entity), rating or None))
+        prune(conn)
+        bump_generation()
+
+def prune(conn):
+    conn.execute("DELETE FROM annotations WHERE starred_at IS NULL AND rating IS NULL")
+
+def starred(user, kind, size=-1, offset=0):
+    """Entities the user starred, most recent first."""
+    rows = get_store().query(
+        "SELECT entity FROM annotations WHERE user = ? AND kind = ? AND starred_at IS NOT NULL "
+        "ORDER BY starred_at DESC LIMIT ? OFFSET ?",
+        (user, kind, size, offset))
+    return [row[0] for row in rows]
+
+def annotations(user, kind, entities):
+    """The user's star time and rating, and the average rating of each
+    entity, as Subsonic attributes.
+    """
+    entities = list(dict.fromkeys(str(entity) for entity in entities))
+    rows = []
+    for batch in batches(entities):
+        placeholders = ', '.join('?' * len(batch))
+        rows += get_store().query(
+            f"SELECT entity, MAX(CASE WHEN user = ? THEN starred_at END), "
+            f"MAX(CASE WHEN user = ? THEN rating END), AVG(rating) FROM annotations "
+            f"WHERE kind = ? AND entity IN ({placeholders}) GROUP BY entity",
+            (user, user, kind, *batch))
+
+    result = {}
+    for entity, starred_at, rating, average in rows:
+        d = {}
+        if starred_at is not None:
+            d['starred'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(starred_at))
+        if rating is not None:
+            d['userRating'] = rating
+        if average is not None:
+            d['averageRating'] = round(average, 2)
+        result[entity] = d
+    return result
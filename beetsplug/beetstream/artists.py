@@ -1,6 +1,9 @@
+import threading
 import time
+from collections import Counter
 from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
+from beetsplug.beetstream.cache import cached_response
 from flask import g, request
 
 @app.route('/rest/getArtists', methods=["GET", "POST"])
@@ -13,59 +16,140 @@ def all_artists():
 def indexes():
     return get_artists("indexes")
 
-def get_artists(version):
-    with g.lib.transaction() as tx:
-        rows = tx.query("SELECT DISTINCT albumartist, COUNT(*) FROM albums GROUP BY albumartist")
-
-    def row_to_artist(row):
-        return {
-            'name': row[0],
-            'id': artist_name_to_id(row[0]),
-            'coverArt': '',
-            'albumCount': row[1]
-        }
+def strip_article(name, articles):
+    lower = name.lower()
+    for article in articles:
+        if lower.startswith(article.lower() + ' '):
+            return name[len(article) + 1:]
+    return name
+
+class ArtistIndex:
+    """Album artists bucketed by initial, kept in memory.
+
+    The album counts are updated incrementally from beets' album events and
+    the buckets are only re-sorted after a change. Changes made by other
+    processes are picked up by reloading when the library file's mtime moves.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.album_artists_ = None # album id -> album artist
+        self.counts_ = Counter()
+        self.db_mtime_ = None
+        self.last_modified_ = 0
+        self.indexes_ = None
+
+    def load(self, lib):
+        mtime = library_mtime(lib)
+        with lib.transaction() as tx:
+            rows = tx.query("SELECT id, albumartist FROM albums")
+
+        with self.lock_:
+            self.album_artists_ = {row[0]: row[1] for row in rows}
+            self.counts_ = Counter(self.album_artists_.values())
+            self.db_mtime_ = mtime
+            self.last_modified_ = (mtime // 1000000) if mtime else int(time.time() * 1000)
+            self.indexes_ = None
+
+    def changed(self, lib):
+        self.last_modified_ = int(time.time() * 1000)
+        self.db_mtime_ = library_mtime(lib)
+        self.indexes_ = None
 
-    all_artists = [row_to_artist(row) for row in rows]
-    all_artists.sort(key=lambda artist: strip_accents(artist['name']).upper())
-    all_artists = filter(lambda artist: len(artist['name']) > 0, all_artists)
+    def update_album(self, lib, album):
+        with self.lock_:
+            if self.album_artists_ is None:
+                return
+            old = self.album_artists_.get(album.id)
+            if old == album.albumartist:
+                return
+            if old is not None:
+                self.counts_[old] -= 1
+            self.album_artists_[album.id] = album.albumartist
+            self.counts_[album.albumartist] += 1
+            self.changed(lib)
 
-    indicies_dict = {}
+    def remove_album(self, lib, album):
+        with self.lock_:
+            if self.album_artists_ is None or album.id not in self.album_artists_:
+                return
+            self.counts_[self.album_artists_.pop(album.id)] -= 1
+            self.changed(lib)
 
-    for artist in all_artists:
-        index = strip_accents(artist['name'][0]).upper()
-        if index not in indicies_dict:
-            indicies_dict[index] = []
-        indicies_dict[index].append(artist)
+    def get(self, lib, articles):
+        """Returns the last modification time (in ms) and the indexes."""
+        if self.album_artists_ is None or library_mtime(lib) != self.db_mtime_:
+            self.load(lib)
+
+        with self.lock_:
+            if self.indexes_ is None or self.indexes_[0] != articles:
+                self.indexes_ = (articles, self.build(articles))
+            return self.last_modified_, self.indexes_[1]
+
+    def build(self, articles):
+        artists = [(name, count) for name, count in self.counts_.items() if count > 0 and len(name) > 0]
+        artists = [(sort_key(strip_article(name, articles)), name, count) for name, count in artists]
+        artists.sort()
+
+        indicies_dict = {}
+        for key, name, count in artists:
+            index = key[0]
+            if index not in indicies_dict:
+                indicies_dict[index] = []
+            indicies_dict[index].append({
+                'name': name,
+                'id': artist_name_to_id(name),
+                'coverArt': '',
+                'albumCount': count
+            })
+
+        indicies = []
+        for index, artist in indicies_dict.items():
+            indicies.append({
+                "name": index,
+                "artist": artist,
+            })
+        return indicies
+
+ARTIST_INDEX = ArtistIndex()
+
+def get_artists(version):
+    ignored_articles = app.config['config']['ignored_articles'].as_str()
+    last_modified, indicies = ARTIST_INDEX.get(g.lib, tuple(ignored_articles.split()))
 
-    indicies = []
-    for index, artist in indicies_dict.items():
-        indicies.append({
-            "name": index,
-            "artist": artist,
+    if_modified_since = int(request.values.get('ifModifiedSince') or 0)
+    if version == "indexes" and if_modified_since >= last_modified:
+        return subsonic_response(request, {
+            version: {
+                "ignoredArticles": ignored_articles,
+                "lastModified": last_modified,
+            }
         })
 
     return subsonic_response(request, {
         version: {
-            "ignoredArticles": "",
-            "lastModified": int(time.time() * 1000),
+            "ignoredArticles": ignored_articles,
+            "lastModified": last_modified,
             "index": indicies
         }
     })
 
 @app.route('/rest/getArtist', methods=["GET", "POST"])
 @app.route('/rest/getArtist.view', methods=["GET", "POST"])
+@cached_response(plays=True)
 def artist():
     artist_id = request.values.get('id')
     artist_name = artist_id_to_name(artist_id)
     albums = g.lib.albums(artist_name.replace("'", "\\'"))
     albums = filter(lambda album: album.albumartist == artist_name, albums)
-    albums = list(map(map_album, albums))
+    albums = map_albums(albums)
+    stars = annotations(current_user(), 'artist', [artist_name]).get(artist_name, {})
 
     return subsonic_response(request, {
         'artist': {
             Attr('id'): artist_id,
             Attr('name'): artist_name,
             Attr('albumCount'): len(albums),
+            **{Attr(k): v for k, v in stars.items()},
             'album': albums,
         }
     })
@@ -0,0 +1,158 @@
+from beetsplug.beetstream.transcode import CHUNK_SIZE
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import FileWrapper
+
+# Endpoints whose response bodies are sent from the event loop
+STREAMING_ENDPOINTS = {'stream', 'download', 'getCoverArt'}
+
+def is_streaming(path):
+    endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+    if endpoint.endswith('.view'):
+        endpoint = endpoint[:-len('.view')]
+    return endpoint in STREAMING_ENDPOINTS
+
+def file_wrapper(file, buffer_size=8192):
+    return FileWrapper(file, CHUNK_SIZE)
+
+def build_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': file_wrapper,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        value = value.decode('latin-1')
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+class StreamingApp:
+    """ASGI application serving the Flask app.
+
+    Requests are handled by the Flask views on a pool of `threads` threads.
+    The stream, download and getCoverArt response bodies are then sent from
+    the event loop: a thread is only taken to read each chunk, and the next
+    chunk is not read before the client has accepted the previous one. Slow
+    clients then wait on their sockets instead of pinning threads. The
+    bodies of other endpoints are read in full by their thread.
+    """
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app_ = wsgi_app
+        self.executor_ = ThreadPoolExecutor(threads, thread_name_prefix='beetstream')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, b''.join(body))
+        if not is_streaming(scope['path']):
+            status, headers, content = \
+                await loop.run_in_executor(self.executor_, self.respond, environ)
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers,
+            })
+            await send({'type': 'http.response.body', 'body': content})
+            return
+
+        status, headers, result, chunks, chunk = \
+            await loop.run_in_executor(self.executor_, self.start, environ)
+
+        disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers,
+            })
+            while chunk is not None and not disconnect.done():
+                if chunk:
+                    # Waits for the transport to drain when the client is slow
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor_, next, chunks, None)
+            if not disconnect.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor_, result.close)
+
+    def respond(self, environ):
+        status, headers, result, chunks, chunk = self.start(environ)
+        try:
+            content = b''.join([chunk or b'', *chunks])
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return status, headers, content
+
+    def start(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        result = self.wsgi_app_(environ, start_response)
+        chunks = iter(result)
+        try:
+            # start_response may only be called once the body is first iterated
+            chunk = next(chunks, None)
+        except Exception:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+        return response['status'], response['headers'], result, chunks, chunk
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor_.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
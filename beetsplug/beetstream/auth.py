@@ -1,59 +1,155 @@
 from beetsplug.beetstream import app
 from beetsplug.beetstream.utils import *
+from collections import OrderedDict
 from hashlib import md5
 import flask
 import binascii
+import hmac
+import os
+import threading
+import time
 from flask import request
 
-password_cache = {}
+VERIFIED_CACHE_SIZE = 4096
+# How often password files are checked for changes, in seconds
+PASSWORD_FILE_CHECK_INTERVAL = 2
 
-def get_password(user):
-    if user in password_cache:
-        return password_cache[user]
+class Credentials:
+    """Passwords and API keys of the configured users, read once from the
+    config instead of on every request. Password files are reloaded when
+    they change.
 
-    users = app.config['config']['users']
-    if user not in users:
-        return None
-    user_conf = users[user]
+    Requests send the same credentials over and over (clients keep their
+    salt for a session), so verified (user, salt, token) tuples are kept in
+    an LRU and checking them again costs a dict lookup.
+    """
+    def __init__(self, users):
+        self.lock_ = threading.Lock()
+        self.passwords_ = {}
+        self.password_files_ = {}
+        self.api_keys_ = {}
+        self.verified_ = OrderedDict()
+        self.checked_at_ = time.monotonic()
 
-    if 'password' in user_conf:
-        password = user_conf['password']
-    elif 'passwordFile' in users[user]:
-        with open(user_conf['passwordFile'], 'r') as f:
-            password = f.read()
+        for user in users:
+            user_conf = users[user]
+            if 'password' in user_conf:
+                self.passwords_[user] = str(user_conf['password'])
+            elif 'passwordFile' in user_conf:
+                path = user_conf['passwordFile'].as_filename()
+                self.password_files_[user] = (path, None)
+                self.load_password_file(user)
+            if 'apiKey' in user_conf:
+                for key in user_conf['apiKey'].as_str_seq():
+                    self.api_keys_[key] = user
 
-    password_cache[user] = password
-    return password
+    def load_password_file(self, user):
+        path, mtime = self.password_files_[user]
+        try:
+            new_mtime = os.stat(path).st_mtime_ns
+            if new_mtime == mtime:
+                return
+            with open(path, 'r') as f:
+                self.passwords_[user] = f.read()
+        except OSError as e:
+            app.logger.warning(f"could not read the password file of {user}: {e}")
+            self.passwords_.pop(user, None)
+            new_mtime = None
+        self.password_files_[user] = (path, new_mtime)
+        self.verified_.clear()
+
+    def check_password_files(self):
+        now = time.monotonic()
+        if now - self.checked_at_ < PASSWORD_FILE_CHECK_INTERVAL:
+            return
+        self.checked_at_ = now
+        for user in self.password_files_:
+            self.load_password_file(user)
+
+    def is_user(self, user):
+        return user in self.passwords_ or user in self.password_files_
+
+    def verify(self, user, salt, token, supplied_pw):
+        key = (user, salt, token, supplied_pw)
+        with self.lock_:
+            self.check_password_files()
+            if key in self.verified_:
+                self.verified_.move_to_end(key)
+                return True
+            password = self.passwords_.get(user)
+
+        if password is None or not authorized(password, salt, token, supplied_pw):
+            return False
+
+        with self.lock_:
+            self.verified_[key] = True
+            if len(self.verified_) > VERIFIED_CACHE_SIZE:
+                self.verified_.popitem(last=False)
+        return True
+
+    def api_key_user(self, key):
+        return self.api_keys_.get(key)
+
+_credentials = None
+_setup_lock = threading.Lock()
+
+def get_credentials():
+    """The credentials of the configured users, or False when there are
+    none and everyone is let through.
+    """
+    global _credentials
+    if _credentials is None:
+        with _setup_lock:
+            if _credentials is None:
+                config = app.config['config']
+                _credentials = Credentials(config['users']) if 'users' in config else False
+    return _credentials
 
 def authorized(password, salt, token, supplied_pw):
     if salt is not None and token is not None:
-        concat = (str(password) + salt).encode('utf-8')
-        return md5(concat).hexdigest() == token
+        concat = (password + salt).encode('utf-8')
+        return hmac.compare_digest(md5(concat).hexdigest(), token)
     elif supplied_pw is not None:
         if supplied_pw.startswith('enc:'):
-            supplied_pw = binascii.unhexlify(supplied_pw[4:].encode('utf-8'))
-        return supplied_pw == str(password)
+            supplied_pw = binascii.unhexlify(supplied_pw[4:].encode('utf-8')).decode('utf-8')
+        return hmac.compare_digest(supplied_pw.encode('utf-8'), password.encode('utf-8'))
     return False
 
 @app.before_request
 def handle_auth():
+    credentials = get_credentials()
     # Allow all users through by default.
-    if 'users' not in app.config['config']:
+    if not credentials:
         return
 
-    user = request.values.get('u')
-    salt = request.values.get('s')
-    token = request.values.get('t')
-    pw = request.values.get('p')
+    values = request.values
+    user = values.get('u')
+    salt = values.get('s')
+    token = values.get('t')
+    pw = values.get('p')
+    api_key = values.get('apiKey')
+
+    # OpenSubsonic API key authentication, which replaces all the other
+    # parameters
+    if api_key is not None:
+        if user is not None or token is not None or pw is not None:
+            return subsonic_response_error(request, SubsonicErrorCode.CONFLICTING_AUTH,
+                                           "multiple conflicting authentication mechanisms provided")
+        user = credentials.api_key_user(api_key)
+        if user is None:
+            return subsonic_response_error(request, SubsonicErrorCode.INVALID_API_KEY,
+                                           "invalid API key")
+        flask.g.user = user
+        return
 
-    if user is None and ((salt is None or token is None) or (pw is None)):
+    if user is None or ((salt is None or token is None) and pw is None):
         return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
                                        "missing required parameter for auth")
-    password = get_password(user)
-    if password is None:
+    if not credentials.is_user(user):
         return subsonic_response_error(request, SubsonicErrorCode.INVALID_AUTH,
                                        "unknown username")
 
-    if not authorized(password, salt, token, pw):
+    if not credentials.verify(user, salt, token, pw):
         return subsonic_response_error(request, SubsonicErrorCode.INVALID_AUTH,
                                        "incorrect password")
+    flask.g.user = user
@@ -0,0 +1,91 @@
+from beetsplug.beetstream.utils import *
+from beetsplug.beetstream import app
+from beetsplug.beetstream.store import get_store, register_schema
+from flask import request
+import time
+
+register_schema("""
+    CREATE TABLE IF NOT EXISTS bookmarks (
+        user TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        comment TEXT,
+        created REAL NOT NULL,
+        changed REAL NOT NULL,
+        PRIMARY KEY (user, item_id)
+    )""")
+
+def timestamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+def save_bookmark(user, item_id, position, comment):
+    now = time.time()
+    with get_store().transaction() as conn:
+        conn.execute(
+            "INSERT INTO bookmarks (user, item_id, position, comment, created, changed) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user, item_id) DO UPDATE SET "
+            "position = excluded.position, comment = excluded.comment, changed = excluded.changed",
+            (user, item_id, position, comment, now, now))
+
+def delete_bookmark(user, item_id):
+    with get_store().transaction() as conn:
+        conn.execute("DELETE FROM bookmarks WHERE user = ? AND item_id = ?", (user, item_id))
+
+def user_bookmarks(user):
+    return get_store().query(
+        "SELECT item_id, position, comment, created, changed FROM bookmarks "
+        "WHERE user = ? ORDER BY changed DESC", (user,))
+
+@app.route('/rest/getBookmarks', methods=["GET", "POST"])
+@app.route('/rest/getBookmarks.view', methods=["GET", "POST"])
+def getBookmarks():
+    user = current_user()
+    rows = user_bookmarks(user)
+    items = items_by_ids([row[0] for row in rows])
+    songs = {item.id: song for item, song in zip(items, map_songs(items))}
+
+    bookmarks = []
+    for item_id, position, comment, created, changed in rows:
+        # Bookmarks of items removed from the library are left out
+        if item_id not in songs:
+            continue
+        bookmark = {
+            Attr('position'): position,
+            Attr('username'): user,
+            Attr('created'): timestamp(created),
+            Attr('changed'): timestamp(changed),
+            'entry': songs[item_id],
+        }
+        if comment:
+            bookmark[Attr('comment')] = comment
+        bookmarks.append(bookmark)
+
+    return subsonic_response(request, {
+        'bookmarks': {
+            'bookmark': bookmarks
+        }
+    })
+
+@app.route('/rest/createBookmark', methods=["GET", "POST"])
+@app.route('/rest/createBookmark.view', methods=["GET", "POST"])
+def createBookmark():
+    id = request.values.get('id') or ''
+    position = request.values.get('position')
+    if not id.startswith(SONG_ID_PREFIX) or position is None:
+        return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                       "a song id and a position are required")
+
+    save_bookmark(current_user(), int(song_subid_to_beetid(id)), int(position),
+                  request.values.get('comment'))
+    return subsonic_response(request, {})
+
+@app.route('/rest/deleteBookmark', methods=["GET", "POST"])
+@app.route('/rest/deleteBookmark.view', methods=["GET", "POST"])
+def deleteBookmark():
+    id = request.values.get('id') or ''
+    if not id.startswith(SONG_ID_PREFIX):
+        return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                       "a song id is required")
+
+    delete_bookmark(current_user(), int(song_subid_to_beetid(id)))
+    return subsonic_response(request, {})
@@ -0,0 +1,321 @@
+from beetsplug.beetstream.utils import *
+from beetsplug.beetstream import app
+from beetsplug.beetstream.store import bump_generation, library_generation, play_generation
+from beetsplug.beetstream.metrics import family, register_collector
+from collections import OrderedDict
+from flask import request
+import beets
+import flask
+import functools
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Parameters that identify the client rather than what it asks for
+IGNORED_PARAMS = {'u', 'p', 't', 's', 'c', 'v', 'apiKey'}
+# Library changes are applied to the generation after this many seconds, so
+# that a burst of changes bumps it once. Changes committed later than that
+# still move the library file's mtime, which is part of the generation too.
+GENERATION_DELAY = 1
+# The disk cache directory is scanned for eviction whenever a process wrote
+# this fraction of its size to it
+SCAN_FRACTION = 16
+# Temporary files older than this were left over by an interrupted write
+STALE_TEMP_AGE = 600
+
+_cache = None
+_setup_lock = threading.Lock()
+
+def get_response_cache():
+    global _cache
+    with _setup_lock:
+        if _cache is None:
+            config = app.config['config']['response_cache']
+            backend = config['backend'].as_choice(['memory', 'disk', 'none'])
+            max_size = config['size'].get(int) * 1024 * 1024
+            if backend == 'none' or max_size <= 0:
+                _cache = False
+            elif backend == 'memory':
+                _cache = MemoryResponseCache(max_size)
+            else:
+                directory = config['cache_dir'].get()
+                if directory is None:
+                    directory = os.path.join(beets.config.config_dir(), 'beetstream', 'responses')
+                _cache = DiskResponseCache(directory, max_size)
+        return _cache
+
+def evict_lru(directory, max_size, is_temporary, stale_age):
+    """Deletes the least recently used files of a cache directory shared by
+    the server processes, the mtime of a file being its last use, until the
+    directory holds at most `max_size` bytes. Temporary files are left to
+    the process writing them, unless older than `stale_age` seconds. Returns
+    the number of files and bytes left.
+    """
+    entries = []
+    now = time.time()
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+            if not is_temporary(entry.name):
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+            elif now - stat.st_mtime > stale_age:
+                # Left over by an interrupted write
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            # Published or evicted by another process meanwhile
+            pass
+
+    entries.sort()
+    size = sum(entry[2] for entry in entries)
+    evicted = 0
+    for _, path, entry_size in entries:
+        if size <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+        evicted += 1
+    return len(entries) - evicted, size
+
+class MemoryResponseCache:
+    """Response bodies of this server process, bounded to `max_size` bytes
+    by evicting the least recently used ones. Each entry remembers the
+    library generation it was rendered at, and is a miss at any other.
+    """
+    def __init__(self, max_size):
+        self.max_size_ = max_size
+        self.lock_ = threading.Lock()
+        self.entries_ = OrderedDict() # least recently used first
+        self.size_ = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        with self.lock_:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries_),
+                'size': self.size_,
+                'max_size': self.max_size_,
+            }
+
+    def get(self, key, generation):
+        with self.lock_:
+            entry = self.entries_.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries_.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, generation, mimetype, body):
+        with self.lock_:
+            old = self.entries_.pop(key, None)
+            if old is not None:
+                self.size_ -= len(old[2])
+            self.entries_[key] = (generation, mimetype, body)
+            self.size_ += len(body)
+            while self.size_ > self.max_size_ and self.entries_:
+                _, (_, _, evicted) = self.entries_.popitem(last=False)
+                self.size_ -= len(evicted)
+            app.logger.debug(f"response cache: {self.hits} hits, {self.misses} misses, "
+                             f"{self.size_}/{self.max_size_} bytes")
+
+class DiskResponseCache:
+    """Response bodies on disk, shared by all the server processes. The
+    mtime of an entry is its last use. The directory is bounded to about
+    `max_size` bytes by evicting the least recently used entries, from a scan
+    of the directory whenever this process wrote another `max_size` /
+    SCAN_FRACTION bytes to it.
+    """
+    def __init__(self, directory, max_size):
+        self.directory_ = directory
+        self.max_size_ = max_size
+        self.lock_ = threading.Lock()
+        self.scanning_ = False
+        # As of the last scan, plus what this process wrote since
+        self.entries_ = 0
+        self.size_ = 0
+        self.unscanned_ = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def path(self, key):
+        return os.path.join(self.directory_, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def scan(self):
+        entries, size = evict_lru(self.directory_, self.max_size_,
+                                  lambda name: name.startswith('.'), STALE_TEMP_AGE)
+        with self.lock_:
+            self.entries_ = entries
+            self.size_ = size
+            self.unscanned_ = 0
+
+    def stats(self):
+        with self.lock_:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': self.entries_,
+                'size': self.size_,
+                'max_size': self.max_size_,
+            }
+
+    def get(self, key, generation):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline().decode('utf-8').split()
+                body = f.read()
+        except FileNotFoundError:
+            header = None
+
+        with self.lock_:
+            if header is None or header[0] != generation:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return header[1], body
+
+    def put(self, key, generation, mimetype, body):
+        path = self.path(key)
+        data = f"{generation} {mimetype}\n".encode('utf-8') + body
+        # Atomic publish: other processes either see the whole file or none
+        fd, part = tempfile.mkstemp(prefix='.', dir=self.directory_)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(part, path)
+
+        with self.lock_:
+            self.entries_ += 1
+            self.size_ += len(data)
+            self.unscanned_ += len(data)
+            scan = self.unscanned_ > self.max_size_ / SCAN_FRACTION and not self.scanning_
+            if scan:
+                self.scanning_ = True
+            app.logger.debug(f"response cache: {self.hits} hits, {self.misses} misses, "
+                             f"{self.size_}/{self.max_size_} bytes")
+        if scan:
+            try:
+                self.scan()
+            finally:
+                self.scanning_ = False
+
+def cache_key():
+    """The endpoint, the user and the parameters of the request, which
+    together determine the response.
+    """
+    endpoint = request.path
+    if endpoint.endswith('.view'):
+        endpoint = endpoint[:-len('.view')]
+    params = sorted((k, v) for k, v in request.values.items(multi=True)
+                    if k not in IGNORED_PARAMS)
+    return '\n'.join([endpoint, current_user(), *(f'{k}={v}' for k, v in params)])
+
+def cache_generation(plays):
+    """Changes whenever the library or the annotations change, including
+    from other beets processes, and with `plays` when the play counts do.
+    """
+    parts = [library_generation(), request_library_mtime()]
+    if plays:
+        parts.append(play_generation())
+    return '-'.join(map(str, parts))
+
+def cached_response(view=None, unless=None, plays=False):
+    """Serves the view's responses from the response cache until their
+    generation changes, with an ETag so that HTTP clients can
+    revalidate them without the body being sent again. Requests for which
+    `unless` returns true are not cached, nor are failed responses. Views
+    whose responses include play counts pass `plays`, so that they are
+    also rendered again after scrobbles.
+    """
+    if view is None:
+        return functools.partial(cached_response, unless=unless, plays=plays)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_response_cache()
+        if not cache or (unless is not None and unless()):
+            return view(*args, **kwargs)
+
+        key = cache_key()
+        generation = cache_generation(plays)
+        etag = hashlib.sha1(f'{generation}\n{key}'.encode('utf-8')).hexdigest()
+        if etag in request.if_none_match:
+            response = flask.Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        hit = cache.get(key, generation)
+        if hit is None:
+            response = view(*args, **kwargs)
+            if response.status_code != 200 or response.cache_control.no_store:
+                return response
+            mimetype, body = response.mimetype, response.get_data()
+            response.close()
+            cache.put(key, generation, mimetype, body)
+        else:
+            mimetype, body = hit
+
+        response = flask.Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        return response
+    return wrapper
+
+class GenerationUpdater:
+    """Bumps the library generation shortly after beets changes the
+    library, from this process or any other beets command. Changes come in
+    bursts while importing, and are only committed after the event.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.timer_ = None
+
+    def changed(self):
+        with self.lock_:
+            if self.timer_ is None:
+                self.timer_ = threading.Timer(GENERATION_DELAY, self.flush)
+                self.timer_.daemon = True
+                self.timer_.start()
+
+    def flush(self):
+        with self.lock_:
+            if self.timer_ is None:
+                return
+            self.timer_.cancel()
+            self.timer_ = None
+        try:
+            bump_generation()
+        except sqlite3.Error as e:
+            app.logger.warning(f"could not update the library generation: {e}")
+
+GENERATION_UPDATER = GenerationUpdater()
+
+def collect_metrics():
+    if not _cache:
+        return []
+    stats = _cache.stats()
+    return [
+        family('beetstream_response_cache_hits_total', 'counter',
+               'Responses served from the response cache.', stats['hits']),
+        family('beetstream_response_cache_misses_total', 'counter',
+               'Responses rendered for the response cache.', stats['misses']),
+        family('beetstream_response_cache_bytes', 'gauge',
+               'Size of the cached responses.', stats['size']),
+    ]
+
+register_collector(collect_metrics)
@@ -0,0 +1,380 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.store import get_store, register_schema
+from beets.dbcore.db import Transaction
+from bisect import bisect_left
+from flask import request, Response
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Endpoints whose responses are audio streams
+STREAM_ENDPOINTS = {'stream', 'download'}
+
+# Metrics, and functions returning metric families that are only computed
+# when the metrics are scraped
+METRICS = []
+COLLECTORS = []
+# Seconds between the snapshots each server process saves of its metrics
+SNAPSHOT_INTERVAL = 5
+# Snapshots not updated for this long are from processes that exited
+STALE_SNAPSHOT_AGE = 60
+ARCHIVED = 'archived'
+
+# Latest metrics of each server process, so that any of them can report the
+# metrics of all. The counters of exited processes are summed into the
+# ARCHIVED row, which keeps the totals from ever going down.
+register_schema("""
+    CREATE TABLE IF NOT EXISTS metric_snapshots (
+        process TEXT PRIMARY KEY,
+        families TEXT NOT NULL,
+        updated REAL NOT NULL
+    )""")
+
+def register_collector(collect):
+    COLLECTORS.append(collect)
+
+def family(name, type, help, value):
+    """A metric family with a single unlabelled sample, for collectors."""
+    return (name, type, help, [(name, {}, value)])
+
+def format_sample(name, labels, value):
+    if labels:
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for v in labels.values())
+        name += '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+    return f"{name} {value}"
+
+class Counter:
+    """A value per combination of labels, which only goes up."""
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock_ = threading.Lock()
+        self.values_ = {}
+        METRICS.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self.lock_:
+            self.values_[labels] = self.values_.get(labels, 0) + amount
+
+    def collect(self):
+        with self.lock_:
+            values = list(self.values_.items())
+        samples = [(self.name, dict(zip(self.labels, labels)), value) for labels, value in values]
+        return [(self.name, self.type, self.help, samples)]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock_:
+            counts = self.values_.get(labels)
+            if counts is None:
+                # One count per bucket, the +Inf bucket, then the sum
+                counts = self.values_[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def collect(self):
+        with self.lock_:
+            values = [(labels, list(counts)) for labels, counts in self.values_.items()]
+
+        samples = []
+        for labels, counts in values:
+            labels = dict(zip(self.labels, labels))
+            total = 0
+            for le, count in zip([*self.buckets, '+Inf'], counts):
+                total += count
+                samples.append((self.name + '_bucket', {**labels, 'le': le}, total))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, total))
+        return [(self.name, self.type, self.help, samples)]
+
+def collect():
+    """The metric families of this process."""
+    families = []
+    for metric in METRICS:
+        families.extend(metric.collect())
+    for collect in COLLECTORS:
+        families.extend(collect())
+    return families
+
+def merge(snapshots):
+    """Sums the samples of the (process, families) snapshots. Gauges are
+    kept apart with a process label instead, as they describe the current
+    state of each process.
+    """
+    merged = {}
+    for process, families in snapshots:
+        for name, type, help, samples in families:
+            family = merged.setdefault(name, (type, help, {}))
+            for sample, labels, value in samples:
+                if type == 'gauge':
+                    labels = {**labels, 'process': process}
+                key = (sample, tuple(labels.items()))
+                family[2][key] = family[2].get(key, 0) + value
+    return [(name, type, help, [(sample, dict(labels), value)
+                                for (sample, labels), value in samples.items()])
+            for name, (type, help, samples) in merged.items()]
+
+def without_gauges(families):
+    return [family for family in families if family[1] != 'gauge']
+
+_process = (None, None)
+
+def process_id():
+    # Pids get reused, so the start time tells processes apart
+    global _process
+    if _process[0] != os.getpid():
+        _process = (os.getpid(), f"{os.getpid()}-{int(time.time())}")
+    return _process[1]
+
+def save_snapshot():
+    now = time.time()
+    families = json.dumps(collect())
+    with get_store().transaction(immediate=True) as conn:
+        conn.execute(
+            "INSERT INTO metric_snapshots (process, families, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (process) DO UPDATE SET families = excluded.families, "
+            "updated = excluded.updated",
+            (process_id(), families, now))
+
+        stale = conn.execute(
+            "SELECT process, families FROM metric_snapshots WHERE updated < ? AND process != ?",
+            (now - STALE_SNAPSHOT_AGE, ARCHIVED)).fetchall()
+        if stale:
+            archived = conn.execute("SELECT families FROM metric_snapshots WHERE process = ?",
+                                    (ARCHIVED,)).fetchall()
+            snapshots = [(ARCHIVED, json.loads(row[0])) for row in archived]
+            snapshots += [(process, without_gauges(json.loads(families)))
+                          for process, families in stale]
+            conn.execute(
+                "INSERT OR REPLACE INTO metric_snapshots (process, families, updated) VALUES (?, ?, ?)",
+                (ARCHIVED, json.dumps(merge(snapshots)), now))
+            conn.executemany("DELETE FROM metric_snapshots WHERE process = ?",
+                             [(process,) for process, _ in stale])
+
+class MetricsSnapshots:
+    """Saves the metrics of this process to the store every
+    SNAPSHOT_INTERVAL seconds, and when it exits.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.pid_ = None
+
+    def start(self):
+        with self.lock_:
+            if self.pid_ != os.getpid():
+                # Threads don't survive a fork
+                self.pid_ = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+                atexit.register(self.save)
+
+    def save(self):
+        try:
+            save_snapshot()
+        except sqlite3.Error as e:
+            app.logger.warning(f"could not save the metrics: {e}")
+
+    def run(self):
+        while True:
+            self.save()
+            time.sleep(SNAPSHOT_INTERVAL)
+
+METRICS_SNAPSHOTS = MetricsSnapshots()
+
+def exposition():
+    """The metrics of all the server processes in the Prometheus text
+    exposition format. Those of this process are up to date, those of the
+    others as of their latest snapshot.
+    """
+    now = time.time()
+    own = process_id()
+    snapshots = [(own, collect())]
+    for process, families, updated in get_store().query(
+            "SELECT process, families, updated FROM metric_snapshots"):
+        if process == own:
+            continue
+        families = json.loads(families)
+        if process == ARCHIVED or now - updated > STALE_SNAPSHOT_AGE:
+            # The gauges of exited processes are meaningless
+            families = without_gauges(families)
+        snapshots.append((process, families))
+    families = merge(snapshots)
+
+    lines = []
+    for name, type, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        lines.extend(format_sample(*sample) for sample in samples)
+    return '\n'.join(lines) + '\n'
+
+REQUEST_DURATION = Histogram(
+    'beetstream_request_duration_seconds',
+    'Time to build the response to a request, until its body is streamed.',
+    ('endpoint',))
+REQUESTS = Counter(
+    'beetstream_requests_total', 'Requests served.', ('endpoint', 'status'))
+RESPONSE_BYTES = Counter(
+    'beetstream_response_bytes_total', 'Size of the response bodies.', ('endpoint',))
+SQL_QUERIES = Counter(
+    'beetstream_sql_queries_total', 'SQL statements run on the beets library.', ('endpoint',))
+SQL_SECONDS = Counter(
+    'beetstream_sql_seconds_total', 'Time spent in SQL statements on the beets library.',
+    ('endpoint',))
+STREAMS_IN_FLIGHT = Gauge(
+    'beetstream_streams_in_flight', 'Audio streams being sent.')
+THUMBNAIL_RENDER = Histogram(
+    'beetstream_thumbnail_render_seconds', 'Time to render a cover art thumbnail.')
+SCROBBLES = Counter(
+    'beetstream_scrobbles_total',
+    'Scrobbles and now playing updates by outcome (sent, retried or dropped).',
+    ('service', 'kind', 'outcome'))
+
+class RequestStats(threading.local):
+    """Start time and SQL statements of the request being served on this
+    thread.
+    """
+    def __init__(self):
+        self.start = None
+        self.queries = 0
+        self.sql_time = 0.0
+        # Collected only while a request is being profiled
+        self.statements = None
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.statements = None
+
+REQUEST_STATS = RequestStats()
+
+def record_sql(statement, subvals, start):
+    elapsed = time.perf_counter() - start
+    stats = REQUEST_STATS
+    stats.queries += 1
+    stats.sql_time += elapsed
+    if stats.statements is not None:
+        stats.statements.append((statement, subvals, elapsed))
+
+class InstrumentedTransaction(Transaction):
+    def query(self, statement, subvals=()):
+        start = time.perf_counter()
+        try:
+            return super().query(statement, subvals)
+        finally:
+            record_sql(statement, subvals, start)
+
+    def mutate(self, statement, subvals=()):
+        start = time.perf_counter()
+        try:
+            return super().mutate(statement, subvals)
+        finally:
+            record_sql(statement, subvals, start)
+
+    def script(self, statements):
+        start = time.perf_counter()
+        try:
+            return super().script(statements)
+        finally:
+            record_sql(statements, (), start)
+
+def instrument_library(lib):
+    """Makes the library's transactions count and time their statements."""
+    lib.transaction = lambda: InstrumentedTransaction(lib)
+
+ENDPOINT_NAMES = {}
+
+def endpoint_name():
+    rule = request.url_rule
+    if rule is None:
+        return 'unknown'
+    endpoint = ENDPOINT_NAMES.get(rule.rule)
+    if endpoint is None:
+        endpoint = rule.rule
+        if endpoint.startswith('/rest/'):
+            endpoint = endpoint[len('/rest/'):]
+        if endpoint.endswith('.view'):
+            endpoint = endpoint[:-len('.view')]
+        ENDPOINT_NAMES[rule.rule] = endpoint
+    return endpoint
+
+def count_bytes(body, endpoint):
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        RESPONSE_BYTES.inc((endpoint,), sent)
+        if hasattr(body, 'close'):
+            body.close()
+
+@app.before_request
+def start_request():
+    REQUEST_STATS.reset()
+
+@app.after_request
+def record_request(response):
+    stats = REQUEST_STATS
+    if stats.start is None:
+        return response
+
+    endpoint = endpoint_name()
+    labels = (endpoint,)
+    REQUEST_DURATION.observe(time.perf_counter() - stats.start, labels)
+    stats.start = None
+    REQUESTS.inc((endpoint, str(response.status_code)))
+    if stats.queries:
+        SQL_QUERIES.inc(labels, stats.queries)
+        SQL_SECONDS.inc(labels, stats.sql_time)
+
+    if response.content_length is not None:
+        RESPONSE_BYTES.inc(labels, response.content_length)
+    elif response.is_streamed:
+        response.response = count_bytes(response.response, endpoint)
+
+    if endpoint in STREAM_ENDPOINTS and response.status_code in (200, 206):
+        STREAMS_IN_FLIGHT.inc()
+        call_on_close(response, STREAMS_IN_FLIGHT.dec)
+    return response
+
+def call_on_close(response, callback):
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return
+
+    # The body of send_file responses is given to the WSGI server as is
+    # (so that it can use sendfile), and only the body gets closed
+    body = response.response
+    close = getattr(body, 'close', None)
+    def close_body():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+    body.close = close_body
+
+@app.route('/metrics')
+def metrics():
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
@@ -1,71 +1,392 @@
 from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
-from beets import library
 from flask import request, g
+import atexit
 import base64
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from beetsplug.beetstream import PLAYLIST_ID_PREFIX
+from beetsplug.beetstream.store import batches, get_store
 import beets
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+# Without watchdog, playlist_dir is rescanned at most this often (seconds)
+POLL_INTERVAL = 10
+# Edits are written to the m3u file after this many seconds
+WRITE_DELAY = 2
+# Extended m3u directive holding the playlist's name
+NAME_DIRECTIVE = '#PLAYLIST:'
 
 class FileCache:
-    def __init__(self, ctr):
+    """Objects built from files, rebuilt when the file's mtime changes.
+    Holds at most `max_size` objects, evicting the least recently used.
+    """
+    def __init__(self, ctr, max_size=256):
         self.ctr_ = ctr
-        self.dict_ = {}
+        self.max_size_ = max_size
+        self.dict_ = OrderedDict()
+        self.lock_ = threading.Lock()
 
     def get(self, path):
         path = Path(path)
         mtime = path.stat().st_mtime
 
-        if path in self.dict_:
-            stored_mtime, obj = self.dict_[path]
-            if stored_mtime == mtime:
-                return obj
+        with self.lock_:
+            if path in self.dict_:
+                stored_mtime, obj = self.dict_[path]
+                if stored_mtime == mtime:
+                    self.dict_.move_to_end(path)
+                    return obj
 
         obj = self.ctr_(path)
-        self.dict_[path] = (mtime, obj)
+        self.put(path, mtime, obj)
         return obj
 
+    def put(self, path, mtime, obj):
+        with self.lock_:
+            self.dict_[Path(path)] = (mtime, obj)
+            self.dict_.move_to_end(Path(path))
+            while len(self.dict_) > self.max_size_:
+                self.dict_.popitem(last=False)
+
+    def pop(self, path):
+        with self.lock_:
+            self.dict_.pop(Path(path), None)
+
+def resolve_paths(lib, paths):
+    """Maps normalized item paths to (id, length) with one query per batch
+    of paths.
+    """
+    paths = list(set(paths))
+    resolved = {}
+    with lib.transaction() as tx:
+        for batch in batches(paths):
+            placeholders = ', '.join('?' * len(batch))
+            rows = tx.query(f"SELECT path, id, length FROM items WHERE path IN ({placeholders})", batch)
+            resolved.update((bytes(row[0]), (row[1], row[2])) for row in rows)
+    return resolved
+
+def item_path(line, musicdir):
+    path = Path(line)
+    if not path.is_absolute():
+        path = musicdir / path
+    return beets.util.normpath(str(path))
+
+def song_entries(lib, ids):
+    """(id, m3u line, length) of the items with the given ids, in the same
+    order. Paths inside the music directory are written relative to it.
+    """
+    musicdir = os.path.abspath(beets.config['directory'].as_filename())
+    unique_ids = list(dict.fromkeys(ids))
+    found = {}
+    with lib.transaction() as tx:
+        for batch in batches(unique_ids):
+            placeholders = ', '.join('?' * len(batch))
+            rows = tx.query(f"SELECT id, path, length FROM items WHERE id IN ({placeholders})", batch)
+            found.update((row[0], (bytes(row[1]), row[2])) for row in rows)
+
+    entries = []
+    for id in ids:
+        if id in found:
+            path, length = found[id]
+            path = beets.util.displayable_path(path)
+            relpath = os.path.relpath(path, musicdir)
+            line = path if relpath.startswith(os.pardir) else relpath
+            entries.append((id, line, length))
+    return entries
+
+def file_version(path):
+    """Changes whenever the file is written, including when it is replaced
+    within the same mtime tick.
+    """
+    st = path.stat()
+    return st.st_ino, st.st_mtime_ns, st.st_size
 
 class Playlist:
+    """A playlist file, kept in memory as the ordered list of its item ids
+    along with their m3u lines. Edits are applied to these lists and the
+    file is then rewritten by PLAYLIST_WRITER.
+
+    Other server processes keep their own copy of the playlist. The edits
+    not yet written are remembered, so that when the file was rewritten by
+    another process in the meantime, they are applied again to its new
+    contents instead of overwriting them.
+    """
     def __init__(self, path):
         self.path_ = Path(path)
+        self.lib_ = g.lib
+        self.lock_ = threading.RLock()
+        self.edits_ = []
+        self.load()
+
+    def load(self):
+        self.version_ = file_version(self.path_)
         self.ctime_ = self.path_.stat().st_ctime
-        self.songs_ = []
+        self.name_ = None
 
         musicdir = Path(beets.config['directory'].get(str))
+        lines = []
+        for line in self.path_.read_text().split('\n'):
+            if line.startswith(NAME_DIRECTIVE):
+                self.name_ = line[len(NAME_DIRECTIVE):].strip()
+            elif line != '' and not line.startswith('#'):
+                lines.append(line)
+        paths = [item_path(line, musicdir) for line in lines]
+        resolved = resolve_paths(self.lib_, paths)
 
-        paths = self.path_.read_text().split('\n')
-        for path in paths:
-            if path == '':
-                continue
+        self.ids_ = []
+        self.lines_ = []
+        self.missing_ = [] # lines of files that aren't in the library
+        self.lengths_ = {}
+        for line, path in zip(lines, paths):
+            if path in resolved:
+                id, length = resolved[path]
+                self.ids_.append(id)
+                self.lines_.append(line)
+                self.lengths_[id] = length
+            else:
+                self.missing_.append(line)
+        self.duration_ = sum(self.lengths_[id] for id in self.ids_)
 
-            path = Path(path)
-            if not path.is_absolute():
-                path = musicdir / path
-
-            query = library.PathQuery('path', path)
-            item = g.lib.items(query).get()
-            if item:
-                self.songs_.append(item)
+    def get_song_ids(self):
+        with self.lock_:
+            return list(self.ids_)
 
     def get_songs(self):
-        return self.songs_
+        return items_by_ids(self.get_song_ids())
 
     def get_song_count(self):
-        return len(self.get_songs())
+        return len(self.ids_)
 
     def get_duration(self):
-        return ceil(sum([x.length for x in self.get_songs()]))
+        return ceil(self.duration_)
 
     def get_created(self):
         return self.ctime_
 
     def get_name(self):
-        return self.path_.stem
+        return self.name_ or self.path_.stem
+
+    def summary(self):
+        with self.lock_:
+            return self.get_name(), self.get_song_count(), self.get_duration(), self.get_created()
+
+    def edit(self, name, *args):
+        with self.lock_:
+            self.edits_.append((name, args))
+            getattr(self, f"apply_{name}")(*args)
+
+    def rename(self, name):
+        self.edit('rename', name)
+
+    def append(self, entries):
+        self.edit('append', entries)
+
+    def remove(self, indexes):
+        self.edit('remove', indexes)
+
+    def clear(self):
+        self.edit('clear')
+
+    def apply_rename(self, name):
+        self.name_ = name
+
+    def apply_append(self, entries):
+        for id, line, length in entries:
+            self.ids_.append(id)
+            self.lines_.append(line)
+            self.lengths_[id] = length
+            self.duration_ += length
+
+    def apply_remove(self, indexes):
+        for index in sorted(set(indexes), reverse=True):
+            if 0 <= index < len(self.ids_):
+                self.duration_ -= self.lengths_[self.ids_[index]]
+                del self.ids_[index]
+                del self.lines_[index]
+
+    def apply_clear(self):
+        self.ids_ = []
+        self.lines_ = []
+        self.missing_ = []
+        self.duration_ = 0
+
+    def write(self):
+        # The store's write lock keeps other server processes from writing
+        # the file between the check and the write
+        with get_store().transaction(immediate=True), self.lock_:
+            if file_version(self.path_) != self.version_:
+                edits = self.edits_
+                self.load()
+                for name, args in edits:
+                    getattr(self, f"apply_{name}")(*args)
+
+            header = ['#EXTM3U']
+            if self.name_ is not None:
+                header.append(f"{NAME_DIRECTIVE}{self.name_}")
+            text = '\n'.join(header + self.lines_ + self.missing_) + '\n'
+
+            # Atomic: readers see either the old or the new file
+            fd, tmp = tempfile.mkstemp(prefix=f".{self.path_.name}.", suffix='.tmp',
+                                       dir=self.path_.parent)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, self.path_)
+            except Exception:
+                os.unlink(tmp)
+                raise
+            self.version_ = file_version(self.path_)
+            self.edits_ = []
+
+        PLAYLIST_CACHE.put(self.path_, self.path_.stat().st_mtime, self)
+        PLAYLIST_DIRECTORY.invalidate(self.path_)
 
 PLAYLIST_CACHE = FileCache(Playlist)
 
+class PlaylistWriter:
+    """Writes edited playlists back to their files. Writes happen
+    WRITE_DELAY seconds after the first edit, so a burst of edits to a
+    playlist results in a single write.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.pending_ = {}
+        self.timer_ = None
+        atexit.register(self.flush)
+
+    def schedule(self, playlist):
+        with self.lock_:
+            self.pending_[playlist.path_] = playlist
+            if self.timer_ is None:
+                self.timer_ = threading.Timer(WRITE_DELAY, self.flush)
+                self.timer_.daemon = True
+                self.timer_.start()
+        PLAYLIST_DIRECTORY.invalidate(playlist.path_)
+
+    def pending(self, path):
+        with self.lock_:
+            return self.pending_.get(Path(path))
+
+    def discard(self, path):
+        with self.lock_:
+            self.pending_.pop(Path(path), None)
+
+    def flush(self):
+        with self.lock_:
+            pending = self.pending_
+            self.pending_ = {}
+            self.timer_ = None
+        for playlist in pending.values():
+            try:
+                playlist.write()
+            except OSError as e:
+                app.logger.error(f"could not write {playlist.path_}: {e}")
+
+PLAYLIST_WRITER = PlaylistWriter()
+
+def get_playlist(path):
+    # Playlists waiting to be written may have been evicted from the cache
+    return PLAYLIST_WRITER.pending(path) or PLAYLIST_CACHE.get(path)
+
+class PlaylistDirectory:
+    """Summaries of the playlists found in playlist_dir.
+
+    With watchdog installed, only the files reported as changed are looked
+    at again. Otherwise the directory is scanned for changed mtimes at most
+    every POLL_INTERVAL seconds. Only changed playlists are reloaded.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.pldir_ = None
+        self.summaries_ = {} # path -> (mtime, summary)
+        self.scanned_ = None
+        self.observer_ = None
+        self.dirty_ = set()
+        self.rescan_ = False
+
+    def watch(self, pldir):
+        if Observer is None:
+            return
+        directory = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                with directory.lock_:
+                    if event.is_directory:
+                        directory.rescan_ = True
+                    for path in (event.src_path, getattr(event, 'dest_path', '')):
+                        if path.endswith('.m3u'):
+                            directory.dirty_.add(Path(path))
+
+        self.observer_ = Observer()
+        self.observer_.schedule(Handler(), str(pldir), recursive=True)
+        self.observer_.daemon = True
+        self.observer_.start()
+
+    def changed_paths(self, pldir):
+        """Returns the playlists to look at again, or None for all of them."""
+        if self.pldir_ != pldir:
+            self.pldir_ = pldir
+            self.summaries_ = {}
+            self.scanned_ = None
+            if self.observer_ is not None:
+                self.observer_.stop()
+                self.observer_ = None
+            self.watch(pldir)
+
+        now = time.monotonic()
+        if self.scanned_ is None or self.rescan_ or \
+                (self.observer_ is None and now - self.scanned_ >= POLL_INTERVAL):
+            self.scanned_ = now
+            self.rescan_ = False
+            self.dirty_ = set()
+            return None
+
+        dirty = self.dirty_
+        self.dirty_ = set()
+        return dirty
+
+    def invalidate(self, path):
+        with self.lock_:
+            self.dirty_.add(Path(path))
+
+    def update(self, path):
+        pending = PLAYLIST_WRITER.pending(path)
+        if pending is not None:
+            # Looked at again once written
+            self.summaries_[path] = (None, pending.summary())
+            self.dirty_.add(path)
+            return
+        try:
+            mtime = path.stat().st_mtime
+            if path not in self.summaries_ or self.summaries_[path][0] != mtime:
+                self.summaries_[path] = (mtime, PLAYLIST_CACHE.get(path).summary())
+        except FileNotFoundError:
+            self.summaries_.pop(path, None)
+            PLAYLIST_CACHE.pop(path)
+
+    def list(self, pldir):
+        """(path, summary) of every playlist, sorted by path."""
+        with self.lock_:
+            paths = self.changed_paths(pldir)
+            if paths is None:
+                paths = set(pldir.glob("**/*.m3u")) | set(self.summaries_)
+            for path in paths:
+                self.update(path)
+            return sorted((path, summary) for path, (_, summary) in self.summaries_.items())
+
+PLAYLIST_DIRECTORY = PlaylistDirectory()
+
 def pl_path_to_id(playlist_dir, playlist):
     rel = str(playlist.relative_to(playlist_dir))
     b64 = base64.b64encode(rel.encode('utf-8')).decode('utf-8')
@@ -74,25 +395,37 @@ def pl_path_to_id(playlist_dir, playlist):
 def pl_id_to_path(playlist_dir, plid):
     plid = plid[len(PLAYLIST_ID_PREFIX):]
     rel = base64.b64decode(plid.encode('utf-8')).decode('utf-8')
-    return playlist_dir / rel
+    path = playlist_dir / rel
+    # Ids must not reach outside of playlist_dir
+    if path.suffix != '.m3u' or os.path.commonpath([
+            os.path.abspath(path), os.path.abspath(playlist_dir)]) != os.path.abspath(playlist_dir):
+        return None
+    return path
+
+def new_playlist_path(playlist_dir, name):
+    stem = ''.join('_' if c in '/\\\0' else c for c in name).lstrip('.') or 'playlist'
+    path = playlist_dir / f"{stem}.m3u"
+    n = 2
+    while path.exists():
+        path = playlist_dir / f"{stem} ({n}).m3u"
+        n += 1
+    return path
 
 @app.route('/rest/getPlaylists', methods=["GET", "POST"])
 @app.route('/rest/getPlaylists.view', methods=["GET", "POST"])
 def playlists():
     playlists = []
     pldir = Path(app.config['config']['playlist_dir'].get(str))
-    for m3u in pldir.glob("**/*.m3u"):
-        pl = PLAYLIST_CACHE.get(m3u)
-        plid = pl_path_to_id(pldir, m3u)
+    for m3u, (name, song_count, duration, created) in PLAYLIST_DIRECTORY.list(pldir):
         playlists.append({
             "id": pl_path_to_id(pldir, m3u),
-            "name": pl.get_name(),
+            "name": name,
             "comment": "",
             "owner": "admin",
             "public": True,
-            "songCount": pl.get_song_count(),
-            "duration": pl.get_duration(),
-            "created": timestamp_to_iso(pl.get_created()),
+            "songCount": song_count,
+            "duration": duration,
+            "created": timestamp_to_iso(created),
             "coverArt": 'playlist', # TODO: generate cover art?
         })
 
@@ -102,14 +435,7 @@ def playlists():
         }
     })
 
-@app.route('/rest/getPlaylist', methods=["GET", "POST"])
-@app.route('/rest/getPlaylist.view', methods=["GET", "POST"])
-def playlist():
-    plid = request.values.get('id')
-    pldir = Path(app.config['config']['playlist_dir'].get(str))
-    plpath = pl_id_to_path(pldir, plid)
-    pl = PLAYLIST_CACHE.get(plpath)
-
+def playlist_response(plid, pl):
     return subsonic_response(request, {
         "playlist": {
             Attr("id"): plid,
@@ -121,6 +447,81 @@ def playlist():
             Attr("duration"): pl.get_duration(),
             Attr("created"): timestamp_to_iso(pl.get_created()),
             Attr("coverArt"): "playlist",
-            "entry": list(map(map_song, pl.get_songs())),
+            "entry": map_songs(pl.get_songs()),
         }
     })
+
+def playlist_not_found():
+    return subsonic_response_error(request, SubsonicErrorCode.NOT_FOUND, "playlist not found")
+
+@app.route('/rest/getPlaylist', methods=["GET", "POST"])
+@app.route('/rest/getPlaylist.view', methods=["GET", "POST"])
+def playlist():
+    plid = request.values.get('id')
+    pldir = Path(app.config['config']['playlist_dir'].get(str))
+    plpath = pl_id_to_path(pldir, plid)
+    if plpath is None or not plpath.exists():
+        return playlist_not_found()
+    return playlist_response(plid, get_playlist(plpath))
+
+@app.route('/rest/createPlaylist', methods=["GET", "POST"])
+@app.route('/rest/createPlaylist.view', methods=["GET", "POST"])
+def create_playlist():
+    pldir = Path(app.config['config']['playlist_dir'].get(str))
+    plid = request.values.get('playlistId')
+    name = request.values.get('name')
+    song_ids = [int(song_subid_to_beetid(id)) for id in request.values.getlist('songId')]
+
+    if plid:
+        # Replaces the songs of an existing playlist
+        plpath = pl_id_to_path(pldir, plid)
+        if plpath is None or not plpath.exists():
+            return playlist_not_found()
+        pl = get_playlist(plpath)
+        pl.clear()
+    elif name:
+        plpath = new_playlist_path(pldir, name)
+        plpath.write_text(f"#EXTM3U\n{NAME_DIRECTIVE}{name}\n")
+        plid = pl_path_to_id(pldir, plpath)
+        pl = get_playlist(plpath)
+    else:
+        return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                       "playlistId or name is required")
+
+    pl.append(song_entries(g.lib, song_ids))
+    PLAYLIST_WRITER.schedule(pl)
+    return playlist_response(plid, pl)
+
+@app.route('/rest/updatePlaylist', methods=["GET", "POST"])
+@app.route('/rest/updatePlaylist.view', methods=["GET", "POST"])
+def update_playlist():
+    pldir = Path(app.config['config']['playlist_dir'].get(str))
+    plpath = pl_id_to_path(pldir, request.values.get('playlistId') or '')
+    if plpath is None or not plpath.exists():
+        return playlist_not_found()
+    pl = get_playlist(plpath)
+
+    name = request.values.get('name')
+    if name:
+        pl.rename(name)
+    # Indexes refer to the playlist before any song is added
+    pl.remove([int(index) for index in request.values.getlist('songIndexToRemove')])
+    song_ids = [int(song_subid_to_beetid(id)) for id in request.values.getlist('songIdToAdd')]
+    pl.append(song_entries(g.lib, song_ids))
+
+    PLAYLIST_WRITER.schedule(pl)
+    return subsonic_response(request, {})
+
+@app.route('/rest/deletePlaylist', methods=["GET", "POST"])
+@app.route('/rest/deletePlaylist.view', methods=["GET", "POST"])
+def delete_playlist():
+    pldir = Path(app.config['config']['playlist_dir'].get(str))
+    plpath = pl_id_to_path(pldir, request.values.get('id') or '')
+    if plpath is None or not plpath.exists():
+        return playlist_not_found()
+
+    PLAYLIST_WRITER.discard(plpath)
+    plpath.unlink()
+    PLAYLIST_CACHE.pop(plpath)
+    PLAYLIST_DIRECTORY.invalidate(plpath)
+    return subsonic_response(request, {})
@@ -0,0 +1,88 @@
+from beetsplug.beetstream.store import batches, bump_play_generation, get_store, register_schema
+
+# Every play is kept, and the per item/album/artist counters are updated
+# along with it so that reads never have to aggregate the history.
+register_schema("""
+    CREATE TABLE IF NOT EXISTS plays (
+        id INTEGER PRIMARY KEY,
+        user TEXT,
+        item_id INTEGER NOT NULL,
+        album_id INTEGER,
+        artist TEXT,
+        played_at INTEGER NOT NULL
+    )""")
+register_schema("""
+    CREATE TABLE IF NOT EXISTS item_plays (
+        item_id INTEGER PRIMARY KEY,
+        artist TEXT,
+        count INTEGER NOT NULL,
+        last_played INTEGER NOT NULL
+    )""")
+register_schema("""
+    CREATE INDEX IF NOT EXISTS item_plays_artist ON item_plays (artist, count DESC)""")
+for table, key in [('album_plays', 'album_id INTEGER'), ('artist_plays', 'artist TEXT')]:
+    register_schema(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {key} PRIMARY KEY,
+            count INTEGER NOT NULL,
+            last_played INTEGER NOT NULL
+        )""")
+    register_schema(f"""
+        CREATE INDEX IF NOT EXISTS {table}_count ON {table} (count DESC, last_played DESC)""")
+    register_schema(f"""
+        CREATE INDEX IF NOT EXISTS {table}_last_played ON {table} (last_played DESC)""")
+
+def upsert_counter(table, key):
+    return (f"INSERT INTO {table} ({key}, count, last_played) VALUES (?, 1, ?) "
+            f"ON CONFLICT ({key}) DO UPDATE SET count = count + 1, "
+            f"last_played = MAX(last_played, excluded.last_played)")
+
+def record_plays(user, items, times):
+    plays = list(zip(items, times))
+    with get_store().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO plays (user, item_id, album_id, artist, played_at) VALUES (?, ?, ?, ?, ?)",
+            ((user, item.id, item.album_id, item.albumartist, timestamp) for item, timestamp in plays))
+        conn.executemany(
+            "INSERT INTO item_plays (item_id, artist, count, last_played) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT (item_id) DO UPDATE SET count = count + 1, artist = excluded.artist, "
+            "last_played = MAX(last_played, excluded.last_played)",
+            ((item.id, item.albumartist, timestamp) for item, timestamp in plays))
+        conn.executemany(upsert_counter('album_plays', 'album_id'),
+                         ((item.album_id, timestamp) for item, timestamp in plays
+                          if item.album_id is not None))
+        conn.executemany(upsert_counter('artist_plays', 'artist'),
+                         ((item.albumartist, timestamp) for item, timestamp in plays))
+        bump_play_generation()
+
+def play_counts(table, key, ids):
+    counts = {}
+    for batch in batches(list(dict.fromkeys(ids))):
+        placeholders = ', '.join('?' * len(batch))
+        counts.update(get_store().query(
+            f"SELECT {key}, count FROM {table} WHERE {key} IN ({placeholders})", batch))
+    return counts
+
+def item_play_counts(item_ids):
+    return play_counts('item_plays', 'item_id', item_ids)
+
+def album_play_counts(album_ids):
+    return play_counts('album_plays', 'album_id', album_ids)
+
+def most_played_albums(size, offset):
+    rows = get_store().query(
+        "SELECT album_id FROM album_plays ORDER BY count DESC, last_played DESC LIMIT ? OFFSET ?",
+        (size, offset))
+    return [row[0] for row in rows]
+
+def recently_played_albums(size, offset):
+    rows = get_store().query(
+        "SELECT album_id FROM album_plays ORDER BY last_played DESC LIMIT ? OFFSET ?",
+        (size, offset))
+    return [row[0] for row in rows]
+
+def most_played_songs(artist, count):
+    rows = get_store().query(
+        "SELECT item_id FROM item_plays WHERE artist = ? ORDER BY count DESC LIMIT ?",
+        (artist, count))
+    return [row[0] for row in rows]
@@ -0,0 +1,154 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.metrics import REQUEST_STATS, STREAM_ENDPOINTS, call_on_close, endpoint_name
+from collections import Counter
+from flask import g
+import beets
+import os
+import random
+import sys
+import threading
+import time
+
+PROFILER = None
+
+def enable_profiling(config):
+    global PROFILER
+    config = config['profile']
+    directory = config['directory'].get()
+    if directory is None:
+        directory = os.path.join(beets.config.config_dir(), 'beetstream', 'profiles')
+    PROFILER = Profiler(directory,
+                        config['threshold'].as_number(),
+                        config['sample_rate'].as_number(),
+                        config['interval'].as_number(),
+                        config['max_files'].get(int))
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+
+class RequestProfile:
+    def __init__(self, thread, sampled):
+        self.thread = thread
+        self.start = time.perf_counter()
+        # Folded stacks of the samples, for sampled requests
+        self.stacks = Counter() if sampled else None
+        self.statements = []
+
+class Profiler:
+    """Reports the requests taking longer than `threshold` seconds, with the
+    SQL statements they ran.
+
+    A fraction of the requests is also sampled: a background thread records
+    their stack every `interval` seconds, which costs nothing to the thread
+    serving the request. The stacks of slow sampled requests are written in
+    the folded format read by flamegraph.pl and speedscope, keeping the
+    `max_files` most recent ones.
+    """
+    def __init__(self, directory, threshold, sample_rate, interval, max_files):
+        self.directory_ = directory
+        self.threshold_ = threshold
+        self.sample_rate_ = sample_rate
+        self.interval_ = interval
+        self.max_files_ = max_files
+        self.lock_ = threading.Lock()
+        self.wakeup_ = threading.Event()
+        self.active_ = {}
+        self.thread_ = None
+        self.pid_ = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def start_request(self):
+        sampled = random.random() < self.sample_rate_
+        profile = RequestProfile(threading.get_ident(), sampled)
+        REQUEST_STATS.statements = profile.statements
+        if sampled:
+            with self.lock_:
+                if self.pid_ != os.getpid():
+                    # Threads don't survive a fork
+                    self.pid_ = os.getpid()
+                    self.thread_ = threading.Thread(target=self.run, daemon=True)
+                    self.thread_.start()
+                self.active_[profile.thread] = profile
+            self.wakeup_.set()
+        return profile
+
+    def finish_request(self, profile, endpoint):
+        elapsed = time.perf_counter() - profile.start
+        with self.lock_:
+            if self.active_.get(profile.thread) is profile:
+                del self.active_[profile.thread]
+        if endpoint is not None and elapsed >= self.threshold_:
+            self.report(profile, endpoint, elapsed)
+
+    def run(self):
+        while True:
+            with self.lock_:
+                active = list(self.active_.items())
+            if not active:
+                self.wakeup_.wait()
+                self.wakeup_.clear()
+                continue
+
+            frames = sys._current_frames()
+            samples = [(profile, folded_stack(frames[thread]))
+                       for thread, profile in active if thread in frames]
+            del frames
+            with self.lock_:
+                # Finished requests may be reporting their stacks already
+                for profile, stack in samples:
+                    if self.active_.get(profile.thread) is profile:
+                        profile.stacks[stack] += 1
+            time.sleep(self.interval_)
+
+    def report(self, profile, endpoint, elapsed):
+        sql_time = sum(statement[2] for statement in profile.statements)
+        lines = [f"slow request {endpoint}: {elapsed * 1000:.1f} ms, "
+                 f"{len(profile.statements)} SQL statements in {sql_time * 1000:.1f} ms"]
+
+        if profile.stacks:
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{endpoint}-{int(elapsed * 1000)}ms.folded"
+            path = os.path.join(self.directory_, name.replace('/', '_'))
+            with open(path, 'w') as f:
+                for stack, count in profile.stacks.items():
+                    f.write(f"{stack} {count}\n")
+            self.prune()
+            lines.append(f"  profile: {path}")
+
+        for statement, subvals, duration in profile.statements:
+            statement = ' '.join(statement.split())
+            lines.append(f"  {duration * 1000:8.2f} ms  {statement}  {list(subvals)[:10]}")
+        app.logger.warning('\n'.join(lines))
+
+    def prune(self):
+        profiles = sorted(entry.path for entry in os.scandir(self.directory_)
+                          if entry.name.endswith('.folded'))
+        for path in profiles[:max(len(profiles) - self.max_files_, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def folded_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(stack)).replace(' ', '_')
+
+def start_profile():
+    g.profile = PROFILER.start_request()
+
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    endpoint = endpoint_name()
+    if endpoint in STREAM_ENDPOINTS:
+        # Audio streams last as long as the song, they are never slow
+        PROFILER.finish_request(profile, None)
+    else:
+        # Response bodies are serialized while they are being sent
+        call_on_close(response, lambda: PROFILER.finish_request(profile, endpoint))
+    return response
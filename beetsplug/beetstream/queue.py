@@ -1,53 +1,117 @@
 from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
+from beetsplug.beetstream.store import get_store, register_schema
 from flask import g, request
+from array import array
 import datetime
+import threading
+import time
 
+register_schema("""
+    CREATE TABLE IF NOT EXISTS play_queues (
+        user TEXT PRIMARY KEY,
+        ids BLOB NOT NULL,
+        current INTEGER,
+        position INTEGER NOT NULL,
+        changed REAL NOT NULL,
+        changed_by TEXT NOT NULL
+    )""")
 
-play_queue = {}
+# Item ids are stored as packed 64-bit integers
+ID_ARRAY_TYPE = 'q'
+
+class PlayQueue:
+    def __init__(self, ids, current, position, changed, changed_by):
+        self.ids = ids
+        self.current = current
+        self.position = position
+        self.changed = changed
+        self.changed_by = changed_by
+
+class MemoryQueueBackend:
+    """Play queues kept in the server process, lost on restart."""
+    def __init__(self):
+        self.queues_ = {}
+        self.lock_ = threading.Lock()
+
+    def save(self, user, queue):
+        with self.lock_:
+            self.queues_[user] = queue
+
+    def load(self, user):
+        with self.lock_:
+            return self.queues_.get(user)
+
+class SqliteQueueBackend:
+    """Play queues in the store, shared by all the server processes. A
+    queue is a single row holding its ids as a packed array.
+    """
+    def save(self, user, queue):
+        ids = array(ID_ARRAY_TYPE, queue.ids).tobytes()
+        with get_store().transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO play_queues (user, ids, current, position, changed, changed_by) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user, ids, queue.current, queue.position, queue.changed, queue.changed_by))
+
+    def load(self, user):
+        rows = get_store().query(
+            "SELECT ids, current, position, changed, changed_by FROM play_queues WHERE user = ?",
+            (user,))
+        if not rows:
+            return None
+        ids, current, position, changed, changed_by = rows[0]
+        ids = array(ID_ARRAY_TYPE, ids).tolist()
+        return PlayQueue(ids, current, position, changed, changed_by)
+
+BACKENDS = {
+    'sqlite': SqliteQueueBackend,
+    'memory': MemoryQueueBackend,
+}
+
+_backend = None
+_setup_lock = threading.Lock()
+
+def get_backend():
+    global _backend
+    with _setup_lock:
+        if _backend is None:
+            name = app.config['config']['play_queue'].as_choice(list(BACKENDS))
+            _backend = BACKENDS[name]()
+        return _backend
 
 @app.route('/rest/savePlayQueue', methods=["GET", "POST"])
 @app.route('/rest/savePlayQueue.view', methods=["GET", "POST"])
 def savePlayQueue():
-    user = request.values.get('u')
-    ids = request.values.getlist('id')
+    user = current_user()
+    ids = [int(song_subid_to_beetid(id)) for id in request.values.getlist('id')]
     current = request.values.get('current')
-    position = request.values.get('position')
+    position = int(request.values.get('position') or 0)
     client = request.values.get('c') or 'unknown'
 
-    play_queue[user] = {
-        'ids': ids,
-        'current': current,
-        'position': position,
-        'changed': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-        'changedBy': client,
-    }
+    current = int(song_subid_to_beetid(current)) if current else None
+    get_backend().save(user, PlayQueue(ids, current, position, time.time(), client))
 
     return subsonic_response(request, {})
 
 @app.route('/rest/getPlayQueue', methods=["GET", "POST"])
 @app.route('/rest/getPlayQueue.view', methods=["GET", "POST"])
 def getPlayQueue():
-    user = request.values.get('u')
-
-    if user not in play_queue:
+    user = current_user()
+    q = get_backend().load(user)
+    if q is None:
         return subsonic_response(request, {})
 
-    q = play_queue[user]
-
-    def mk_entry(subid):
-        beetid = int(song_subid_to_beetid(subid))
-        song = g.lib.get_item(beetid)
-
-        return map_song(song)
-
-    return subsonic_response(request, {
-        'playQueue': {
-            Attr('current'): q['current'],
-            Attr('position'): q['position'],
-            Attr('username'): user,
-            Attr('changed'): q['changed'],
-            Attr('changedBy'): q['changedBy'],
-            "entry": list(map(mk_entry, q['ids'])),
-        }
+    changed = datetime.datetime.fromtimestamp(q.changed, datetime.timezone.utc)
+    queue = {}
+    if q.current is not None:
+        queue[Attr('current')] = song_beetid_to_subid(str(q.current))
+    queue.update({
+        Attr('position'): str(q.position),
+        Attr('username'): user,
+        Attr('changed'): changed.isoformat(),
+        Attr('changedBy'): q.changed_by,
+        "entry": map_songs(items_by_ids(q.ids)),
     })
+
+    return subsonic_response(request, {'playQueue': queue})
@@ -0,0 +1,260 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.store import get_store, register_schema
+from beetsplug.beetstream.metrics import SCROBBLES
+import json
+import os
+import threading
+import time
+import pylast
+import pylistenbrainz
+
+SERVICES = ('last.fm', 'listenbrainz')
+BATCH_SIZE = 50 # the most Last.fm accepts in one call
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 20
+CLAIM_TIMEOUT = 300
+
+register_schema("""
+    CREATE TABLE IF NOT EXISTS scrobble_queue (
+        id INTEGER PRIMARY KEY,
+        user TEXT NOT NULL,
+        service TEXT NOT NULL,
+        track TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        submission INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL,
+        claimed_by INTEGER,
+        claimed_at REAL
+    )""")
+register_schema("""
+    CREATE INDEX IF NOT EXISTS scrobble_queue_next_attempt
+    ON scrobble_queue (next_attempt)""")
+
+def track_info(item):
+    return {
+        'artist': item.artist,
+        'title': item.title,
+        'album': item.album,
+        'album_artist': item.albumartist,
+        'duration': int(item.length),
+        'track_number': item.track,
+        'mbid': item.mb_trackid,
+        'mb_artistid': item.mb_artistid,
+        'mb_albumid': item.mb_albumid,
+        'mb_releasegroupid': item.mb_releasegroupid,
+        'mb_workid': item.mb_workid,
+    }
+
+def user_services(user):
+    if 'users' not in app.config['config']:
+        return {}
+    users = app.config['config']['users']
+    if user not in users or 'scrobble' not in users[user]:
+        return {}
+    config = users[user]['scrobble']
+    return {service: config[service] for service in SERVICES if service in config}
+
+class Scrobbler:
+    """Delivers scrobbles to Last.fm and ListenBrainz from a queue in the
+    store, so that requests never wait on the network.
+
+    A background thread sends the queued scrobbles of each user and service
+    in batches, reusing one client per user and service. Failed batches are
+    retried with an exponential backoff. Now playing updates are only sent
+    once, as they are stale by the time a retry would happen.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.wakeup_ = threading.Event()
+        self.thread_ = None
+        self.pid_ = None
+        self.clients_ = {}
+
+    def start(self):
+        with self.lock_:
+            if self.pid_ != os.getpid():
+                # Threads don't survive a fork
+                self.pid_ = os.getpid()
+                self.clients_ = {}
+                self.thread_ = threading.Thread(target=self.run, daemon=True)
+                self.thread_.start()
+
+    def enqueue(self, user, items, times, submission):
+        services = user_services(user)
+        if not services:
+            return
+        now = time.time()
+        rows = [(user, service, json.dumps(track_info(item)), timestamp, submission, now)
+                for service in services
+                for item, timestamp in zip(items, times)]
+        with get_store().transaction() as conn:
+            conn.executemany(
+                "INSERT INTO scrobble_queue (user, service, track, timestamp, submission, next_attempt) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.start()
+        self.wakeup_.set()
+
+    def run(self):
+        while True:
+            try:
+                delay = self.drain()
+            except Exception:
+                app.logger.exception("scrobble queue failed")
+                delay = RETRY_DELAY
+            self.wakeup_.wait(delay)
+            self.wakeup_.clear()
+
+    def claim(self):
+        """Claims the due scrobbles of one user and service, so that the
+        workers of other processes leave them alone.
+        """
+        now = time.time()
+        store = get_store()
+        with store.transaction(immediate=True) as conn:
+            due = conn.execute(
+                "SELECT user, service FROM scrobble_queue WHERE next_attempt <= ? "
+                "AND (claimed_by IS NULL OR claimed_at < ?) ORDER BY next_attempt LIMIT 1",
+                (now, now - CLAIM_TIMEOUT)).fetchone()
+            if due is None:
+                return None, None, []
+            rows = conn.execute(
+                "SELECT id, track, timestamp, submission, attempts FROM scrobble_queue "
+                "WHERE user = ? AND service = ? AND next_attempt <= ? "
+                "AND (claimed_by IS NULL OR claimed_at < ?) ORDER BY id LIMIT ?",
+                (*due, now, now - CLAIM_TIMEOUT, BATCH_SIZE)).fetchall()
+            conn.executemany("UPDATE scrobble_queue SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                             ((os.getpid(), now, row[0]) for row in rows))
+        return due[0], due[1], rows
+
+    def drain(self):
+        """Sends all the due scrobbles, and returns the time until the next
+        retry is due.
+        """
+        while True:
+            user, service, rows = self.claim()
+            if not rows:
+                break
+            self.send(user, service, rows)
+
+        rows = get_store().query("SELECT MIN(next_attempt) FROM scrobble_queue")
+        if rows[0][0] is None:
+            return None
+        return max(rows[0][0] - time.time(), 1)
+
+    def send(self, user, service, rows):
+        scrobbles = [(json.loads(row[1]), row[2]) for row in rows if row[3]]
+        playing = [(json.loads(row[1]), row[2]) for row in rows if not row[3]]
+        send_scrobbles, send_playing = SENDERS[service]
+
+        failed = []
+        if scrobbles:
+            try:
+                send_scrobbles(self.client(user, service), scrobbles)
+            except Exception as e:
+                app.logger.warning(f"{service} scrobble for {user} failed: {e}")
+                self.clients_.pop((user, service), None)
+                failed = [row for row in rows if row[3]]
+        playing_sent = False
+        if playing and not failed:
+            try:
+                # Only the latest one is still playing
+                send_playing(self.client(user, service), playing[-1])
+                playing_sent = True
+            except Exception as e:
+                app.logger.warning(f"{service} now playing for {user} failed: {e}")
+                self.clients_.pop((user, service), None)
+
+        now = time.time()
+        dropped = [row for row in failed if row[4] + 1 >= MAX_ATTEMPTS]
+        if dropped:
+            app.logger.error(f"dropping {len(dropped)} {service} scrobbles for {user}")
+        retried = [row for row in failed if row not in dropped]
+        SCROBBLES.inc((service, 'scrobble', 'sent'), len(scrobbles) - len(failed))
+        SCROBBLES.inc((service, 'scrobble', 'retried'), len(retried))
+        SCROBBLES.inc((service, 'scrobble', 'dropped'), len(dropped))
+        if playing:
+            # Stale now playing updates are dropped rather than retried
+            SCROBBLES.inc((service, 'now_playing', 'sent'), int(playing_sent))
+            SCROBBLES.inc((service, 'now_playing', 'dropped'), len(playing) - int(playing_sent))
+        with get_store().transaction() as conn:
+            conn.executemany("DELETE FROM scrobble_queue WHERE id = ?",
+                             ((row[0],) for row in rows if row not in retried))
+            conn.executemany(
+                "UPDATE scrobble_queue SET attempts = ?, next_attempt = ?, claimed_by = NULL "
+                "WHERE id = ?",
+                ((row[4] + 1, now + min(RETRY_DELAY * 2 ** row[4], MAX_RETRY_DELAY), row[0])
+                 for row in retried))
+
+    def client(self, user, service):
+        key = (user, service)
+        if key not in self.clients_:
+            config = user_services(user).get(service)
+            if config is None:
+                raise KeyError(f"{service} is not configured")
+            self.clients_[key] = CLIENTS[service](config)
+        return self.clients_[key]
+
+def lastfm_client(config):
+    return pylast.LastFMNetwork(
+        api_key=config['api_key'].get(str),
+        api_secret=config['api_secret'].get(str),
+        username=config['username'].get(str),
+        password_hash=pylast.md5(config['password'].get(str)))
+
+def lastfm_track(track):
+    return {
+        'artist': track['artist'],
+        'title': track['title'],
+        'album': track['album'],
+        'album_artist': track['album_artist'],
+        'duration': track['duration'],
+        'track_number': track['track_number'],
+        'mbid': track['mbid'],
+    }
+
+def lastfm_scrobbles(client, scrobbles):
+    client.scrobble_many([dict(lastfm_track(track), timestamp=timestamp)
+                          for track, timestamp in scrobbles])
+
+def lastfm_playing(client, scrobble):
+    client.update_now_playing(**lastfm_track(scrobble[0]))
+
+def listenbrainz_client(config):
+    client = pylistenbrainz.ListenBrainz()
+    client.set_auth_token(config['user_token'].get(str))
+    return client
+
+def listenbrainz_listen(track, timestamp=None):
+    return pylistenbrainz.Listen(
+        track_name=track['title'],
+        artist_name=track['artist'],
+        release_name=track['album'],
+        recording_mbid=track['mbid'],
+        artist_mbids=[track['mb_artistid']],
+        release_mbid=track['mb_albumid'],
+        release_group_mbid=track['mb_releasegroupid'],
+        work_mbids=[track['mb_workid']],
+        tracknumber=track['track_number'],
+        listened_at=timestamp,
+        listening_from='beetstream')
+
+def listenbrainz_scrobbles(client, scrobbles):
+    client.submit_multiple_listens([listenbrainz_listen(track, timestamp)
+                                    for track, timestamp in scrobbles])
+
+def listenbrainz_playing(client, scrobble):
+    client.submit_playing_now(listenbrainz_listen(scrobble[0]))
+
+CLIENTS = {
+    'last.fm': lastfm_client,
+    'listenbrainz': listenbrainz_client,
+}
+
+SENDERS = {
+    'last.fm': (lastfm_scrobbles, lastfm_playing),
+    'listenbrainz': (listenbrainz_scrobbles, listenbrainz_playing),
+}
+
+SCROBBLER = Scrobbler()
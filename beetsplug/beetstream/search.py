@@ -1,5 +1,6 @@
 from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
+from beetsplug.beetstream.searchindex import SEARCH_INDEX
 from flask import g, request
 from beets.dbcore.query import (
     AndQuery,
@@ -25,21 +26,27 @@ def search(version):
     songCount = int(request.values.get('songCount') or 20)
     songOffset = int(request.values.get('songOffset') or 0)
 
-    songs = handleSizeAndOffset(list(g.lib.items("title:{}".format(query.replace("'", "\\'")))), songCount, songOffset)
-    albums = handleSizeAndOffset(list(g.lib.albums("album:{}".format(query.replace("'", "\\'")))), albumCount, albumOffset)
+    if SEARCH_INDEX.is_ready(g.lib):
+        songs = items_by_ids(SEARCH_INDEX.songs(query, songCount, songOffset))
+        albums = albums_by_ids(SEARCH_INDEX.albums(query, albumCount, albumOffset))
+        artists = SEARCH_INDEX.artists(query, artistCount, artistOffset)
+    else:
+        # The index is still being built, or SQLite has no FTS5
+        songs = handleSizeAndOffset(list(g.lib.items("title:{}".format(query.replace("'", "\\'")))), songCount, songOffset)
+        albums = handleSizeAndOffset(list(g.lib.albums("album:{}".format(query.replace("'", "\\'")))), albumCount, albumOffset)
 
-    with g.lib.transaction() as tx:
-        rows = tx.query("SELECT DISTINCT albumartist FROM albums")
-    artists = [row[0] for row in rows]
-    artists = list(filter(lambda artist: strip_accents(query).lower() in strip_accents(artist).lower(), artists))
-    artists.sort(key=lambda name: strip_accents(name).upper())
-    artists = handleSizeAndOffset(artists, artistCount, artistOffset)
+        with g.lib.transaction() as tx:
+            rows = tx.query("SELECT DISTINCT albumartist FROM albums")
+        artists = [row[0] for row in rows]
+        artists = list(filter(lambda artist: strip_accents(query).lower() in strip_accents(artist).lower(), artists))
+        artists.sort(key=lambda name: strip_accents(name).upper())
+        artists = handleSizeAndOffset(artists, artistCount, artistOffset)
 
     return subsonic_response(request, {
         "searchResult{}".format(version): {
-            "artist": list(map(map_artist, artists)),
-            "album": list(map(map_album, albums)),
-            "song": list(map(map_song, songs))
+            "artist": map_artists(artists),
+            "album": map_albums(albums),
+            "song": map_songs(songs)
         }
     })
 
@@ -0,0 +1,211 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.utils import library_mtime, sort_key
+import sqlite3
+import threading
+
+# Titles weigh more than albums and artists when ranking songs
+SONG_WEIGHTS = (4.0, 1.0, 2.0)
+ALBUM_WEIGHTS = (2.0, 1.0)
+
+def match_expression(query):
+    """Turns a user query into an FTS5 expression where every word must
+    match the start of a word in any of the indexed columns. Single
+    characters only match whole words, as their prefix matches most of the
+    library.
+    """
+    terms = [term for term in query.split() if any(c.isalnum() for c in term)]
+    return ' '.join('"{}"{}'.format(term.replace('"', '""'), '*' if len(term) > 1 else '')
+                    for term in terms)
+
+def song_artist(artist, albumartist):
+    if artist and albumartist and artist != albumartist:
+        return f"{artist} {albumartist}"
+    return artist or albumartist or ''
+
+def create_index():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    tokenize = "tokenize='unicode61 remove_diacritics 2', prefix='2 3'"
+    conn.executescript(f"""
+        CREATE VIRTUAL TABLE songs USING fts5(title, album, artist, {tokenize});
+        CREATE VIRTUAL TABLE albums USING fts5(album, artist, {tokenize});
+        CREATE VIRTUAL TABLE artists USING fts5(name, sort UNINDEXED, {tokenize});
+        """)
+    return conn
+
+class SearchIndex:
+    """In-memory SQLite FTS5 index of song titles, albums and artists.
+
+    The index is built from the library when the server starts and is then
+    kept up to date from beets' library events. Other beets processes don't
+    send events to the server, so the index is also rebuilt in the
+    background when the library file's mtime moves. Matching is case and
+    accent insensitive.
+
+    Searches scan the library instead until the index is built, or for good
+    if SQLite was built without FTS5. A build failing for any other reason
+    is tried again once the library changes.
+    """
+    def __init__(self):
+        self.conn_ = None
+        self.lock_ = threading.RLock()
+        self.lib_ = None
+        self.pending_ = None
+        self.building_ = False
+        self.unavailable_ = False
+        self.db_mtime_ = None
+        self.artists_dirty_ = True
+
+    def is_ready(self, lib):
+        if library_mtime(lib) != self.db_mtime_:
+            # The current index answers until the new one is built
+            self.build_async(lib)
+        return self.conn_ is not None
+
+    def build_async(self, lib):
+        with self.lock_:
+            if self.building_ or self.unavailable_:
+                return
+            self.building_ = True
+        threading.Thread(target=self.build, args=(lib,), daemon=True).start()
+
+    def build(self, lib):
+        # A new index is filled and then swapped in, so that searches aren't
+        # blocked meanwhile. Changes made while the library is being read are
+        # replayed on it. The library is never queried with our lock held, as
+        # beets may send events from inside its own transactions.
+        with self.lock_:
+            self.lib_ = lib
+            self.pending_ = []
+            self.building_ = True
+
+        try:
+            conn = create_index()
+        except sqlite3.OperationalError as e:
+            app.logger.warning(f"search index unavailable, searches will scan the library: {e}")
+            with self.lock_:
+                self.unavailable_ = True
+                self.pending_ = None
+                self.building_ = False
+            return
+
+        try:
+            # Reading the library may fail while another beets command
+            # writes to it, in which case the next change retries
+            self.db_mtime_ = library_mtime(lib)
+            with lib.transaction() as tx:
+                songs = tx.query("SELECT id, title, album, artist, albumartist FROM items")
+                albums = tx.query("SELECT id, album, albumartist FROM albums")
+            artists = self.read_artists()
+
+            conn.executemany(
+                "INSERT INTO songs (rowid, title, album, artist) VALUES (?, ?, ?, ?)",
+                ((row[0], row[1], row[2], song_artist(row[3], row[4])) for row in songs))
+            conn.executemany(
+                "INSERT INTO albums (rowid, album, artist) VALUES (?, ?, ?)",
+                (tuple(row) for row in albums))
+            write_artists(conn, artists)
+
+            with self.lock_:
+                for statements in self.pending_:
+                    execute(conn, statements)
+                conn.commit()
+                self.conn_ = conn
+        except sqlite3.Error as e:
+            app.logger.warning(f"could not build the search index: {e}")
+            conn.close()
+        finally:
+            with self.lock_:
+                self.pending_ = None
+                self.building_ = False
+
+    def read_artists(self):
+        self.artists_dirty_ = False
+        with self.lib_.transaction() as tx:
+            rows = tx.query("SELECT DISTINCT albumartist FROM albums")
+        return [row[0] for row in rows if row[0]]
+
+    def apply(self, statements):
+        with self.lock_:
+            if self.pending_ is not None:
+                self.pending_.append(statements)
+            if self.conn_ is not None:
+                execute(self.conn_, statements)
+                self.conn_.commit()
+
+    def update_item(self, item):
+        self.apply([
+            ("DELETE FROM songs WHERE rowid = ?", (item.id,)),
+            ("INSERT INTO songs (rowid, title, album, artist) VALUES (?, ?, ?, ?)",
+             (item.id, item.title, item.album, song_artist(item.artist, item.albumartist))),
+        ])
+
+    def remove_item(self, item):
+        self.apply([("DELETE FROM songs WHERE rowid = ?", (item.id,))])
+
+    def update_album(self, album):
+        self.artists_dirty_ = True
+        self.apply([
+            ("DELETE FROM albums WHERE rowid = ?", (album.id,)),
+            ("INSERT INTO albums (rowid, album, artist) VALUES (?, ?, ?)",
+             (album.id, album.album, album.albumartist)),
+        ])
+
+    def remove_album(self, album):
+        self.artists_dirty_ = True
+        self.apply([("DELETE FROM albums WHERE rowid = ?", (album.id,))])
+
+    def query(self, table, weights, query, count, offset):
+        expression = match_expression(query)
+        with self.lock_:
+            if not expression:
+                rows = self.conn_.execute(
+                    f"SELECT rowid FROM {table} ORDER BY rowid LIMIT ? OFFSET ?",
+                    (count, offset))
+            else:
+                rank = ', '.join(map(str, weights))
+                rows = self.conn_.execute(
+                    f"SELECT rowid FROM {table} WHERE {table} MATCH ? "
+                    f"ORDER BY bm25({table}, {rank}), rowid LIMIT ? OFFSET ?",
+                    (expression, count, offset))
+            return [row[0] for row in rows]
+
+    def songs(self, query, count, offset):
+        """Ids of the matching songs, best matches first."""
+        return self.query('songs', SONG_WEIGHTS, query, count, offset)
+
+    def albums(self, query, count, offset):
+        """Ids of the matching albums, best matches first."""
+        return self.query('albums', ALBUM_WEIGHTS, query, count, offset)
+
+    def artists(self, query, count, offset):
+        """Names of the matching album artists, best matches first."""
+        expression = match_expression(query)
+        if self.artists_dirty_:
+            artists = self.read_artists()
+            with self.lock_:
+                write_artists(self.conn_, artists)
+                self.conn_.commit()
+
+        with self.lock_:
+            if not expression:
+                rows = self.conn_.execute(
+                    "SELECT name FROM artists ORDER BY sort LIMIT ? OFFSET ?",
+                    (count, offset))
+            else:
+                rows = self.conn_.execute(
+                    "SELECT name FROM artists WHERE artists MATCH ? "
+                    "ORDER BY rank, sort LIMIT ? OFFSET ?",
+                    (expression, count, offset))
+            return [row[0] for row in rows]
+
+def write_artists(conn, artists):
+    conn.execute("DELETE FROM artists")
+    conn.executemany(
+        "INSERT INTO artists (name, sort) VALUES (?, ?)",
+        ((name, sort_key(name)) for name in artists))
+
+def execute(conn, statements):
+    for sql, subvals in statements:
+        conn.execute(sql, subvals)
+
+SEARCH_INDEX = SearchIndex()
@@ -0,0 +1,75 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.searchindex import SEARCH_INDEX
+from beetsplug.beetstream.scrobbler import SCROBBLER
+from beetsplug.beetstream.metrics import METRICS_SNAPSHOTS, instrument_library
+from beets import ui
+
+SERVERS = ['flask', 'gunicorn', 'waitress', 'uvicorn']
+
+def init_worker(lib):
+    """Sets up the per-process state of a server worker.
+
+    SQLite connections must not be shared across a fork, so connections
+    inherited from the parent are dropped and each worker opens its own.
+    """
+    lib._close()
+    instrument_library(lib)
+    SEARCH_INDEX.build_async(lib)
+    # Sends the scrobbles left over by the previous run
+    SCROBBLER.start()
+    METRICS_SNAPSHOTS.start()
+
+def run_server(config, lib, debug, log):
+    server = config['server'].as_choice(SERVERS)
+    host = config['host'].as_str()
+    port = config['port'].get(int)
+    workers = config['workers'].get(int)
+    threads = config['threads'].get(int)
+
+    log.info(u'Starting {0} server on {1}:{2}', server, host, port)
+    if server == 'flask':
+        init_worker(lib)
+        app.run(host=host, port=port, debug=debug, threaded=True)
+    elif server == 'waitress':
+        waitress = import_server('waitress')
+        init_worker(lib)
+        waitress.serve(app, host=host, port=port, threads=threads)
+    elif server == 'uvicorn':
+        uvicorn = import_server('uvicorn')
+        from beetsplug.beetstream.asgi import StreamingApp
+        if workers > 1:
+            log.warning(u'uvicorn runs a single worker process')
+        init_worker(lib)
+        uvicorn.run(StreamingApp(app, threads), host=host, port=port,
+                    log_level='debug' if debug else 'info')
+    elif server == 'gunicorn':
+        run_gunicorn(config, lib, host, port, workers, threads)
+
+def import_server(name):
+    try:
+        return __import__(name, fromlist=['_'])
+    except ImportError:
+        raise ui.UserError(f"server requires the {name.split('.')[0]} package")
+
+def run_gunicorn(config, lib, host, port, workers, threads):
+    gunicorn_app = import_server('gunicorn.app.base')
+
+    class GunicornApplication(gunicorn_app.BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"{host}:{port}",
+                'workers': workers,
+                'threads': threads,
+                'worker_class': 'gthread',
+                'keepalive': config['keepalive'].get(int),
+                'graceful_timeout': config['graceful_timeout'].get(int),
+                'post_fork': lambda server, worker: init_worker(lib),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    # SIGHUP gracefully restarts the workers
+    GunicornApplication().run()
@@ -1,12 +1,18 @@
 from beetsplug.beetstream.utils import *
 from beetsplug.beetstream import app
+from beetsplug.beetstream.transcode import TranscodeError, transcode, transcode_target
+from beetsplug.beetstream.scrobbler import SCROBBLER
+from beetsplug.beetstream.plays import most_played_songs, record_plays
+from beetsplug.beetstream.annotations import set_rating, set_starred, starred
+from beetsplug.beetstream.store import batches
+import flask
 from flask import g, request, Response
+import beets
 import mimetypes
-from beets.random import random_objs
+import os
+from urllib.parse import quote
+import random
 import time
-import datetime
-import pylast
-import pylistenbrainz
 
 @app.route('/rest/getSong', methods=["GET", "POST"])
 @app.route('/rest/getSong.view', methods=["GET", "POST"])
@@ -29,167 +35,254 @@ def songs_by_genre():
 
     return subsonic_response(request, {
         "songsByGenre": {
-            "song": list(map(map_song, songs))
+            "song": map_songs(songs)
         }
     })
 
 @app.route('/rest/stream', methods=["GET", "POST"])
 @app.route('/rest/stream.view', methods=["GET", "POST"])
 def stream_song():
-    maxBitrate = int(request.values.get('maxBitRate') or 0) # TODO
-    format = request.values.get('format') #TODO
-    return stream(maxBitrate)
+    maxBitrate = int(request.values.get('maxBitRate') or 0)
+    format = request.values.get('format')
+    return stream(maxBitrate, format)
 
 @app.route('/rest/download', methods=["GET", "POST"])
 @app.route('/rest/download.view', methods=["GET", "POST"])
 def download_song():
-    return stream(0)
+    return stream(0, 'raw')
 
-def stream(maxBitrate):
+def stream(maxBitrate, format):
     id = int(song_subid_to_beetid(request.values.get('id')))
     item = g.lib.get_item(id)
 
-    def generate():
-        with open(item.path, "rb") as songFile:
-            data = songFile.read(1024)
-            while data:
-                yield data
-                data = songFile.read(1024)
-    return Response(generate(), mimetype=mimetypes.guess_type(item.path.decode('utf-8'))[0])
-
-def do_scrobble(config, item, timestamp, submission):
-    endpoints = {
-        'last.fm': do_scrobble_lastfm,
-        'listenbrainz': do_scrobble_listenbrainz,
-        'log': do_scrobble_log,
-    }
-
-    for k, func in endpoints.items():
-        if k in config:
-            func(config[k], item, timestamp, submission)
-
-
-def do_scrobble_listenbrainz(config, item, timestamp, submission):
-    listen = pylistenbrainz.Listen(
-        track_name=item.title,
-        artist_name=item.artist,
-        release_name=item.album,
-        recording_mbid=item.mb_trackid,
-        artist_mbids=[item.mb_artistid],
-        release_mbid=item.mb_albumid,
-        release_group_mbid=item.mb_releasegroupid,
-        work_mbids=[item.mb_workid],
-        tracknumber=item.track,
-        listening_from='beetstream')
-
-    client = pylistenbrainz.client.ListenBrainz()
-    client.set_auth_token(config['user_token'].get(str))
+    target = transcode_target(item, maxBitrate, format)
+    if target is None:
+        return send_item(item)
+
+    estimate = request.values.get('estimateContentLength') == 'true'
     try:
-        if submission:
-            listen.listened_at = int(timestamp)
-            client.submit_single_listen(listen)
-        else:
-            client.submit_playing_now(listen)
-    except pylistenbrainz.errors.ListenBrainzAPIException as e:
-        app.logger.error("listenbrainz error: " + str(e.message))
-
-
-def do_scrobble_lastfm(config, item, timestamp, submission):
-    lfm = pylast.LastFMNetwork(
-            api_key=config['api_key'].get(str),
-            api_secret=config['api_secret'].get(str),
-            username=config['username'].get(str),
-            password_hash=pylast.md5(config['password'].get(str)))
+        return transcode(item, *target, estimate_length=estimate)
+    except TranscodeError as e:
+        return subsonic_response_error(request, SubsonicErrorCode.GENERIC_ERROR, str(e))
 
-    if submission:
-        lfm.scrobble(
-            artist=item.artist,
-            title=item.title,
-            timestamp=timestamp,
-            album=item.album,
-            album_artist=item.albumartist,
-            duration=item.length,
-            track_number=item.track,
-            mbid=item.mb_trackid)
-    else:
-        lfm.update_now_playing(
-            artist=item.artist,
-            title=item.title,
-            album=item.album,
-            album_artist=item.albumartist,
-            duration=item.length,
-            track_number=item.track,
-            mbid=item.mb_trackid)
+def send_item(item):
+    path = item.path.decode('utf-8')
+    mimetype = mimetypes.guess_type(path)[0]
+    # beets refreshes mtime whenever it reads or writes the file's tags
+    etag = f"{item.id}-{int(item.mtime)}" if item.mtime else True
+    last_modified = item.mtime or None
 
+    if app.config['config']['stream_offload'].get() == 'x-accel-redirect':
+        return accel_redirect(path, mimetype, etag, last_modified)
 
-def do_scrobble_log(config, item, timestamp, submission):
-    if not submission:
-        return
+    # Handles Range/If-Range/If-None-Match, and lets the WSGI server use
+    # sendfile(2) (or X-Sendfile when USE_X_SENDFILE is set) for the body
+    return flask.send_file(path, mimetype=mimetype, conditional=True,
+                           etag=etag, last_modified=last_modified)
 
-    user = request.values.get('u')
-    app.logger.info(f"{user} listened to {item.artist} - {item.album} - {item.title}")
+def accel_redirect(path, mimetype, etag, last_modified):
+    # nginx serves the file itself (including ranges) from an internal
+    # location aliased to the beets music directory
+    location = app.config['config']['accel_redirect_location'].get(str).rstrip('/')
+    musicdir = os.path.abspath(beets.config['directory'].as_filename())
+    relpath = os.path.relpath(path, musicdir)
+    if relpath.startswith(os.pardir):
+        relpath = path.lstrip('/')
 
+    response = Response(mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = f"{location}/{quote(relpath)}"
+    if etag is not True:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+def logs_scrobbles(user):
+    # Scrobbles are logged when the user has `scrobble: {log: ...}`
+    if 'users' not in app.config['config']:
+        return False
+    users = app.config['config']['users']
+    return user in users and 'scrobble' in users[user] and 'log' in users[user]['scrobble']
 
 @app.route('/rest/scrobble', methods=["GET", "POST"])
 @app.route('/rest/scrobble.view', methods=["GET", "POST"])
 def scrobble():
-    user = request.values.get('u')
-    user_config = app.config['config']['users'][user]
-    if 'scrobble' not in user_config:
-        return subsonic_response(request, {})
-
+    user = current_user()
     ids = [int(song_subid_to_beetid(id)) for id in request.values.getlist('id')]
-    times = [int(time) for t in request.values.getlist('time')]
-    submission = True if request.values.get('submission', 'true') == 'true' else False
+    # Subsonic times are in milliseconds
+    times = [int(t) // 1000 for t in request.values.getlist('time')]
+    submission = request.values.get('submission', 'true') == 'true'
 
     # if you specify one time, better specify them all
     if len(times) > 0:
-        assert(len(times) == len(ids))
+        if len(times) != len(ids):
+            return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                           "one time per id is required")
     else:
-        now = int(time.mktime(datetime.datetime.now().timetuple()))
+        now = int(time.time())
         times = [now for _ in ids]
 
-    for id, timestamp in zip(ids, times):
-        item = g.lib.get_item(id)
-        do_scrobble(user_config['scrobble'], item, timestamp, submission)
+    found = {item.id: item for item in items_by_ids(ids)}
+    times = [timestamp for id, timestamp in zip(ids, times) if id in found]
+    items = [found[id] for id in ids if id in found]
+
+    if submission:
+        record_plays(user, items, times)
+        if logs_scrobbles(user):
+            for item in items:
+                app.logger.info(f"{user} listened to {item.artist} - {item.album} - {item.title}")
+
+    # Delivered to Last.fm and ListenBrainz in the background
+    SCROBBLER.enqueue(user, items, times, submission)
 
     return subsonic_response(request, {})
 
+MAX_RANDOM_SONGS = 500
+SAMPLING_ROUNDS = 5
+
+# Random songs are chosen among item ids in SQL, so only the chosen items are
+# ever turned into Item objects.
+def sample_item_ids(where, subvals, size):
+    with g.lib.transaction() as tx:
+        ids = [row[0] for row in tx.query(f"SELECT id FROM items WHERE {where}", subvals)]
+    return random.sample(ids, min(size, len(ids)))
+
+def sample_all_item_ids(size):
+    """Draws random ids between the smallest and the largest item id and
+    keeps those that exist, which is uniform over the items and only needs
+    a few primary key lookups unless the ids are very sparse.
+    """
+    with g.lib.transaction() as tx:
+        low, high = tx.query("SELECT MIN(id), MAX(id) FROM items")[0]
+    if low is None:
+        return []
+
+    chosen = set()
+    for _ in range(SAMPLING_ROUNDS):
+        wanted = size - len(chosen)
+        candidates = set(random.sample(range(low, high + 1), min(wanted * 2, high - low + 1)))
+        candidates -= chosen
+        if not candidates:
+            break
+        found = []
+        with g.lib.transaction() as tx:
+            for batch in batches(list(candidates)):
+                placeholders = ', '.join('?' * len(batch))
+                rows = tx.query(f"SELECT id FROM items WHERE id IN ({placeholders})", batch)
+                found.extend(row[0] for row in rows)
+        random.shuffle(found)
+        chosen.update(found[:wanted])
+        if len(chosen) >= size:
+            return random.sample(list(chosen), len(chosen))
+
+    # Too many gaps between the ids, or fewer items than asked for
+    return sample_item_ids('1', (), size)
+
 @app.route('/rest/getRandomSongs', methods=["GET", "POST"])
 @app.route('/rest/getRandomSongs.view', methods=["GET", "POST"])
 def random_songs():
-    size = int(request.values.get('size') or 10)
-    songs = list(g.lib.items())
-    songs = random_objs(songs, -1, size)
+    size = min(int(request.values.get('size') or 10), MAX_RANDOM_SONGS)
+    genre = request.values.get('genre')
+    fromYear = request.values.get('fromYear')
+    toYear = request.values.get('toYear')
+
+    clauses = []
+    subvals = []
+    if genre:
+        clauses.append('genre = ? COLLATE NOCASE')
+        subvals.append(genre)
+    if fromYear:
+        clauses.append('year >= ?')
+        subvals.append(int(fromYear))
+    if toYear:
+        clauses.append('year <= ?')
+        subvals.append(int(toYear))
+
+    if clauses:
+        ids = sample_item_ids(' AND '.join(clauses), subvals, size)
+    else:
+        ids = sample_all_item_ids(size)
+    songs = items_by_ids(ids)
 
     return subsonic_response(request, {
         "randomSongs": {
-            "song": list(map(map_song, songs))
+            "song": map_songs(songs)
         }
     })
 
-# TODO link with Last.fm or ListenBrainz
 @app.route('/rest/getTopSongs', methods=["GET", "POST"])
 @app.route('/rest/getTopSongs.view', methods=["GET", "POST"])
 def top_songs():
+    # The artist's most played songs on this server
+    artist = request.values.get('artist')
+    count = int(request.values.get('count') or 50)
+    songs = items_by_ids(most_played_songs(artist, count))
+
     return subsonic_response(request, {
-        "topSongs": {}
+        "topSongs": {
+            "song": map_songs(songs)
+        }
     })
 
+def annotation_target(id):
+    if id.startswith(ARTIST_ID_PREFIX):
+        return 'artist', artist_id_to_name(id)
+    elif id.startswith(ALBUM_ID_PREFIX):
+        return 'album', int(album_subid_to_beetid(id))
+    elif id.startswith(SONG_ID_PREFIX):
+        return 'song', int(song_subid_to_beetid(id))
+    return None
+
+def annotation_targets():
+    ids = request.values.getlist('id') + request.values.getlist('albumId') + \
+        request.values.getlist('artistId')
+    return [target for target in map(annotation_target, ids) if target is not None]
+
+@app.route('/rest/star', methods=["GET", "POST"])
+@app.route('/rest/star.view', methods=["GET", "POST"])
+def star():
+    set_starred(current_user(), annotation_targets(), True)
+    return subsonic_response(request, {})
+
+@app.route('/rest/unstar', methods=["GET", "POST"])
+@app.route('/rest/unstar.view', methods=["GET", "POST"])
+def unstar():
+    set_starred(current_user(), annotation_targets(), False)
+    return subsonic_response(request, {})
+
+@app.route('/rest/setRating', methods=["GET", "POST"])
+@app.route('/rest/setRating.view', methods=["GET", "POST"])
+def rating():
+    target = annotation_target(request.values.get('id') or '')
+    rating = int(request.values.get('rating') or -1)
+    if target is None or not 0 <= rating <= 5:
+        return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                       "id and a rating between 0 and 5 are required")
+
+    # A rating of 0 removes the rating
+    set_rating(current_user(), *target, rating)
+    return subsonic_response(request, {})
+
 @app.route('/rest/getStarred', methods=["GET", "POST"])
 @app.route('/rest/getStarred.view', methods=["GET", "POST"])
 def starred_songs():
-    return subsonic_response(request, {
-        "starred": {
-            "song": []
-        }
-    })
+    return get_starred("starred")
 
 @app.route('/rest/getStarred2', methods=["GET", "POST"])
 @app.route('/rest/getStarred2.view', methods=["GET", "POST"])
 def starred2_songs():
+    return get_starred("starred2")
+
+def get_starred(version):
+    user = current_user()
+    artists = starred(user, 'artist')
+    albums = albums_by_ids([int(id) for id in starred(user, 'album')])
+    songs = items_by_ids([int(id) for id in starred(user, 'song')])
+
     return subsonic_response(request, {
-        "starred2": {
-            "song": []
+        version: {
+            "artist": map_artists(artists),
+            "album": map_albums(albums),
+            "song": map_songs(songs),
         }
     })
@@ -0,0 +1,119 @@
+from beetsplug.beetstream import app
+import beets
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Tables of the store, registered by the modules using them
+SCHEMA = []
+# Stays below SQLite's limit on the number of parameters of a statement,
+# which is 999 before SQLite 3.32
+IDS_BATCH_SIZE = 500
+
+_store = None
+_setup_lock = threading.Lock()
+
+def register_schema(sql):
+    SCHEMA.append(sql)
+
+def batches(values):
+    """Splits a list of ids for IN clauses."""
+    for i in range(0, len(values), IDS_BATCH_SIZE):
+        yield values[i:i + IDS_BATCH_SIZE]
+
+def get_store():
+    global _store
+    with _setup_lock:
+        if _store is None:
+            path = app.config['config']['database'].get()
+            if path is None:
+                path = os.path.join(beets.config.config_dir(), 'beetstream', 'beetstream.db')
+            _store = Store(path)
+        return _store
+
+class Store:
+    """SQLite database holding beetstream's own state, next to the beets
+    library. Each thread of each server process gets its own connection.
+    """
+    def __init__(self, path):
+        self.path_ = path
+        self.local_ = threading.local()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection().executescript(';\n'.join(SCHEMA))
+
+    def connection(self):
+        local = self.local_
+        if getattr(local, 'pid', None) != os.getpid():
+            # Connections must not be used across a fork
+            conn = sqlite3.connect(self.path_, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            local.conn = conn
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Runs the block in a transaction, or in the enclosing one. An
+        immediate transaction takes the write lock right away.
+        """
+        conn = self.connection()
+        local = self.local_
+        if local.depth:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            local.depth = 0
+
+    def query(self, sql, subvals=()):
+        return self.connection().execute(sql, subvals).fetchall()
+
+# Generation of the library and of the annotations, bumped whenever they
+# change so that cached responses can tell they are stale. It lives in the
+# store to be shared by all the server processes and by other beets commands
+# changing the library.
+register_schema("""
+    CREATE TABLE IF NOT EXISTS generation (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        value INTEGER NOT NULL
+    )""")
+register_schema("INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0)")
+# Generation of the play counts, kept apart as it changes with every
+# scrobble and only some responses depend on it
+register_schema("""
+    CREATE TABLE IF NOT EXISTS play_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        value INTEGER NOT NULL
+    )""")
+register_schema("INSERT OR IGNORE INTO play_generation (id, value) VALUES (0, 0)")
+
+def library_generation():
+    return get_store().query("SELECT value FROM generation")[0][0]
+
+def bump_generation():
+    with get_store().transaction() as conn:
+        conn.execute("UPDATE generation SET value = value + 1")
+
+def play_generation():
+    return get_store().query("SELECT value FROM play_generation")[0][0]
+
+def bump_play_generation():
+    with get_store().transaction() as conn:
+        conn.execute("UPDATE play_generation SET value = value + 1")
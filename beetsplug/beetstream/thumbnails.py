@@ -0,0 +1,170 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.metrics import THUMBNAIL_RENDER
+from beetsplug.beetstream.cache import SCAN_FRACTION, STALE_TEMP_AGE, evict_lru
+import flask
+import beets
+import glob
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+FORMATS = {
+    'jpeg': ('jpg', 'image/jpeg'),
+    'webp': ('webp', 'image/webp'),
+}
+
+_cache = None
+_setup_lock = threading.Lock()
+
+def thumbnail_dir(config):
+    directory = config['thumbnails']['cache_dir'].get()
+    if directory is None:
+        directory = os.path.join(beets.config.config_dir(), 'beetstream', 'thumbnails')
+    return directory
+
+def thumbnail_name(album_id, artpath, size, fmt):
+    mtime = int(os.path.getmtime(artpath))
+    ext, _ = FORMATS[fmt]
+    return f"{album_id}-{mtime}-{size}.{ext}"
+
+def render_thumbnail(artpath, size, directory, name, fmt, quality):
+    """Writes the artwork scaled down to fit in a `size` square, keeping its
+    aspect ratio. The file is published atomically, and thumbnails of older
+    versions of the artwork are removed.
+    """
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return path
+
+    start = time.perf_counter()
+    with Image.open(artpath) as image:
+        image.thumbnail((size, size), Image.LANCZOS)
+        fd, tmp = tempfile.mkstemp(prefix=f"{name}.", suffix='.part', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.convert('RGB').save(f, fmt.upper(), quality=quality)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+    THUMBNAIL_RENDER.observe(time.perf_counter() - start)
+
+    album_id, _, rest = name.split('-', 2)
+    for old in glob.glob(os.path.join(directory, f"{album_id}-*-{rest}")):
+        if old == path:
+            continue
+        try:
+            os.unlink(old)
+        except FileNotFoundError:
+            # Removed by a concurrent render of the same version
+            pass
+    return path
+
+def thumbnail_size(size):
+    """Rounds the size asked for by a client up to the closest configured
+    size, so that clients can't have thumbnails rendered at any size. None
+    above the largest one, for the original artwork.
+    """
+    sizes = app.config['config']['thumbnails']['sizes'].get(list)
+    return min((s for s in sizes if s >= size), default=None)
+
+class ThumbnailCache:
+    """Bounds the thumbnail directory, shared by all the server processes,
+    to about `max_size` bytes. As for the disk response cache, the mtime of
+    a thumbnail is its last use, and the least recently used ones are
+    evicted from a scan of the directory whenever this process rendered
+    another `max_size` / SCAN_FRACTION bytes.
+    """
+    def __init__(self, directory, max_size):
+        self.directory_ = directory
+        self.max_size_ = max_size
+        self.lock_ = threading.Lock()
+        self.scanning_ = False
+        self.unscanned_ = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        evict_lru(self.directory_, self.max_size_,
+                  lambda name: name.endswith('.part'), STALE_TEMP_AGE)
+        with self.lock_:
+            self.unscanned_ = 0
+
+    def added(self, size):
+        with self.lock_:
+            self.unscanned_ += size
+            scan = self.unscanned_ > self.max_size_ / SCAN_FRACTION and not self.scanning_
+            if scan:
+                self.scanning_ = True
+        if scan:
+            try:
+                self.scan()
+            finally:
+                self.scanning_ = False
+
+def get_thumbnail_cache(config):
+    global _cache
+    with _setup_lock:
+        if _cache is None:
+            max_size = config['thumbnails']['cache_size'].get(int) * 1024 * 1024
+            _cache = ThumbnailCache(thumbnail_dir(config), max_size)
+        return _cache
+
+def thumbnail_response(album, size):
+    config = app.config['config']
+    fmt = config['thumbnails']['format'].as_choice(list(FORMATS))
+    quality = config['thumbnails']['quality'].get(int)
+    cache = get_thumbnail_cache(config)
+
+    artpath = album.artpath.decode('utf-8')
+    name = thumbnail_name(album.id, artpath, size, fmt)
+    path = os.path.join(cache.directory_, name)
+    try:
+        os.utime(path)
+        rendered = 0
+    except FileNotFoundError:
+        render_thumbnail(artpath, size, cache.directory_, name, fmt, quality)
+        rendered = os.path.getsize(path)
+
+    response = flask.send_file(path, mimetype=FORMATS[fmt][1], conditional=True,
+                               etag=name, max_age=config['thumbnails']['max_age'].get(int))
+    # Once the file is open, so that it can be evicted meanwhile
+    cache.added(rendered)
+    return response
+
+def render_job(job):
+    try:
+        render_thumbnail(*job)
+        return None
+    except Exception as e:
+        return f"{job[0]}: {e}"
+
+def pregenerate_thumbnails(lib, config, sizes, workers, log):
+    fmt = config['thumbnails']['format'].as_choice(list(FORMATS))
+    quality = config['thumbnails']['quality'].get(int)
+    directory = thumbnail_dir(config)
+    os.makedirs(directory, exist_ok=True)
+
+    jobs = []
+    for album in lib.albums():
+        if not album.artpath:
+            continue
+        artpath = album.artpath.decode('utf-8')
+        try:
+            names = [thumbnail_name(album.id, artpath, size, fmt) for size in sizes]
+        except OSError as e:
+            log.warning(u'{0}: {1}', artpath, e)
+            continue
+        for size, name in zip(sizes, names):
+            if not os.path.exists(os.path.join(directory, name)):
+                jobs.append((artpath, size, directory, name, fmt, quality))
+
+    log.info(u'Rendering {0} thumbnails', len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for error in pool.map(render_job, jobs, chunksize=16):
+            if error is not None:
+                log.warning(u'{0}', error)
@@ -0,0 +1,431 @@
+from beetsplug.beetstream import app
+from beetsplug.beetstream.metrics import family, register_collector
+from beetsplug.beetstream.cache import SCAN_FRACTION, evict_lru
+import flask
+from flask import Response
+import beets
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+from math import ceil
+from string import Template
+
+CHUNK_SIZE = 64 * 1024
+# Partial cache entries untouched for this many seconds were left over by
+# an encode that didn't finish. Others may be written by another process.
+STALE_PART_AGE = 3600
+
+# Formats clients can ask for, with the ffmpeg muxer producing them and
+# their mimetype. mp4 muxers need a seekable output, so m4a can't be
+# streamed from the encoder.
+FORMATS = {
+    'mp3': ('mp3', 'audio/mpeg'),
+    'opus': ('opus', 'audio/ogg'),
+    'ogg': ('ogg', 'audio/ogg'),
+    'oga': ('ogg', 'audio/ogg'),
+    'aac': ('adts', 'audio/aac'),
+    'flac': ('flac', 'audio/flac'),
+    'wav': ('wav', 'audio/wav'),
+}
+
+class TranscodeError(Exception):
+    pass
+
+_slots = None
+_cache = None
+_setup_lock = threading.Lock()
+
+def get_slots():
+    # Bounds the number of encoder processes running in this server
+    global _slots
+    with _setup_lock:
+        if _slots is None:
+            max_processes = app.config['config']['transcode']['max_processes'].get(int)
+            _slots = threading.BoundedSemaphore(max_processes)
+        return _slots
+
+def get_cache():
+    global _cache
+    config = app.config['config']['transcode']
+    max_size = config['cache_size'].get(int) * 1024 * 1024
+    if max_size <= 0:
+        return None
+
+    with _setup_lock:
+        if _cache is None:
+            directory = config['cache_dir'].get()
+            if directory is None:
+                directory = os.path.join(beets.config.config_dir(), 'beetstream', 'transcodes')
+            _cache = TranscodeCache(directory, max_size)
+        return _cache
+
+def transcode_target(item, max_bitrate, fmt):
+    """Returns the (format, bitrate) the item should be transcoded to, or
+    None if the original file can be sent as is.
+    """
+    config = app.config['config']['transcode']
+    suffix = item.format.lower()
+    bitrate = ceil(item.bitrate / 1000)
+
+    if fmt == 'raw' or (fmt and not fmt.isalnum()):
+        return None
+
+    if fmt and fmt != suffix:
+        target = config['bitrate'].get(int)
+        if max_bitrate > 0:
+            target = min(target, max_bitrate)
+        return fmt, target
+
+    if max_bitrate > 0 and bitrate > max_bitrate:
+        return fmt or config['format'].as_str(), max_bitrate
+
+    return None
+
+def transcode_command(item, fmt, bitrate):
+    command = app.config['config']['transcode']['command'].as_str()
+    values = {
+        'source': item.path.decode('utf-8'),
+        'format': FORMATS[fmt][0],
+        'bitrate': bitrate,
+    }
+    return [Template(arg).safe_substitute(values) for arg in shlex.split(command)]
+
+def start_encoder(item, fmt, bitrate):
+    """Starts an encoder for the item once a slot is free. Raises
+    TranscodeError if all the slots stayed busy or the encoder can't be run.
+    """
+    slots = get_slots()
+    timeout = app.config['config']['transcode']['timeout'].get(float)
+    if not slots.acquire(timeout=timeout):
+        raise TranscodeError("too many transcodes in progress")
+
+    # Kept in a file rather than a pipe, which could fill up and block the
+    # encoder since nothing reads it until the encoder is done
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(transcode_command(item, fmt, bitrate),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=errors)
+    except OSError as e:
+        errors.close()
+        slots.release()
+        app.logger.error(f"could not start the encoder: {e}")
+        raise TranscodeError("could not start the encoder")
+    proc.errors = errors
+    return proc
+
+def stop_encoder(proc):
+    proc.kill()
+    proc.stdout.close()
+    proc.wait()
+    proc.errors.close()
+    get_slots().release()
+
+def log_encoder_failure(proc):
+    proc.errors.seek(0)
+    message = proc.errors.read().decode('utf-8', 'replace').strip()
+    app.logger.error(f"encoder exited with status {proc.returncode}: {message}")
+
+class TranscodeStream:
+    """Response body reading from an encoder process. The WSGI server closes
+    it when the response ends or the client goes away, which kills the
+    encoder and frees its slot.
+    """
+    def __init__(self, proc, first):
+        self.proc_ = proc
+        self.first_ = first
+        self.closed_ = False
+
+    def __iter__(self):
+        data = self.first_
+        while data:
+            yield data
+            data = self.proc_.stdout.read1(CHUNK_SIZE)
+        if self.proc_.wait() != 0:
+            log_encoder_failure(self.proc_)
+
+    def close(self):
+        if self.closed_:
+            return
+        self.closed_ = True
+        stop_encoder(self.proc_)
+
+class CacheWriter:
+    """Copies an encoder's output to a `.part` file on a background thread.
+    The file is renamed to its final name once the encoder succeeds, so the
+    cache only ever lists complete files.
+    """
+    def __init__(self, cache, key):
+        self.cache_ = cache
+        self.key_ = key
+        fd, self.part_ = tempfile.mkstemp(prefix=f"{key}.", suffix='.part',
+                                          dir=cache.directory_)
+        self.file_ = os.fdopen(fd, 'wb')
+        self.cond_ = threading.Condition()
+        self.proc_ = None
+        self.readers_ = 0
+        self.written_ = 0
+        self.done_ = False
+        self.failed_ = False
+
+    def start(self, proc):
+        self.proc_ = proc
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        ok = False
+        try:
+            with self.file_ as f:
+                data = self.proc_.stdout.read1(CHUNK_SIZE)
+                while data:
+                    f.write(data)
+                    f.flush()
+                    with self.cond_:
+                        self.written_ += len(data)
+                        self.cond_.notify_all()
+                    data = self.proc_.stdout.read1(CHUNK_SIZE)
+            status = self.proc_.wait()
+            if status != 0 and not self.failed_:
+                log_encoder_failure(self.proc_)
+            ok = status == 0 and not self.failed_
+        finally:
+            stop_encoder(self.proc_)
+            self.cache_.finish(self, ok)
+
+    def abort(self):
+        # The last reader went away before the encoder was done
+        with self.cond_:
+            self.failed_ = True
+            self.done_ = True
+            self.cond_.notify_all()
+        if self.proc_ is not None:
+            self.proc_.kill()
+
+    def finish(self, ok):
+        self.file_.close()
+        with self.cond_:
+            self.failed_ = self.failed_ or not ok
+            self.done_ = True
+            self.cond_.notify_all()
+
+class CacheReader:
+    """Response body tailing a cache entry that is still being written."""
+    def __init__(self, cache, writer):
+        self.cache_ = cache
+        self.writer_ = writer
+        self.file_ = open(writer.part_, 'rb')
+        self.closed_ = False
+
+    def wait_for_output(self):
+        """Waits for the first bytes of the entry. Returns False if the
+        encoder ended without producing any.
+        """
+        writer = self.writer_
+        with writer.cond_:
+            while writer.written_ == 0 and not writer.done_:
+                writer.cond_.wait()
+            return writer.written_ > 0 and not writer.failed_
+
+    def __iter__(self):
+        writer = self.writer_
+        pos = 0
+        while True:
+            with writer.cond_:
+                while writer.written_ <= pos and not writer.done_:
+                    writer.cond_.wait()
+                end = writer.written_
+                done = writer.done_
+                if writer.failed_:
+                    return
+
+            while pos < end:
+                data = self.file_.read(min(CHUNK_SIZE, end - pos))
+                if not data:
+                    break
+                pos += len(data)
+                yield data
+
+            if done:
+                return
+
+    def close(self):
+        if self.closed_:
+            return
+        self.closed_ = True
+        self.file_.close()
+        self.cache_.release(self.writer_)
+
+class TranscodeCache:
+    """On-disk cache of encoder outputs, shared by all the server processes.
+    The mtime of an entry is its last use. The directory is bounded to about
+    `max_size` bytes by evicting the least recently used entries, from a scan
+    of the directory whenever this process wrote another `max_size` /
+    SCAN_FRACTION bytes to it.
+    """
+    def __init__(self, directory, max_size):
+        self.directory_ = directory
+        self.max_size_ = max_size
+        self.lock_ = threading.Lock()
+        self.writers_ = {}
+        self.scanning_ = False
+        # As of the last scan, plus what this process wrote since
+        self.entries_ = 0
+        self.size_ = 0
+        self.unscanned_ = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def path(self, key):
+        return os.path.join(self.directory_, key)
+
+    def scan(self):
+        entries, size = evict_lru(self.directory_, self.max_size_,
+                                  lambda name: name.endswith('.part'), STALE_PART_AGE)
+        with self.lock_:
+            self.entries_ = entries
+            self.size_ = size
+            self.unscanned_ = 0
+
+    def stats(self):
+        with self.lock_:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': self.entries_,
+                'size': self.size_,
+                'max_size': self.max_size_,
+            }
+
+    def open(self, key, encode):
+        """Returns the path of the complete entry, or a reader tailing the
+        entry being written. `encode` starts the encoder on a miss, and its
+        exceptions are raised.
+        """
+        with self.lock_:
+            path = self.path(key)
+            try:
+                os.utime(path)
+                self.hits += 1
+                return path
+            except FileNotFoundError:
+                pass
+
+            writer = self.writers_.get(key)
+            started = writer is not None
+            if started:
+                self.hits += 1
+            else:
+                self.misses += 1
+                writer = CacheWriter(self, key)
+                self.writers_[key] = writer
+            writer.readers_ += 1
+            reader = CacheReader(self, writer)
+
+        if not started:
+            try:
+                proc = encode()
+            except BaseException:
+                # Wakes up the requests that joined while waiting for a slot
+                self.finish(writer, False)
+                reader.close()
+                raise
+            writer.start(proc)
+        return reader
+
+    def release(self, writer):
+        with self.lock_:
+            writer.readers_ -= 1
+            abort = writer.readers_ == 0 and not writer.done_
+            if abort and self.writers_.get(writer.key_) is writer:
+                # Requests from now on start over with a new encoder
+                del self.writers_[writer.key_]
+        if abort:
+            writer.abort()
+            if writer.proc_ is None:
+                self.finish(writer, False)
+
+    def finish(self, writer, ok):
+        scan = False
+        try:
+            with self.lock_:
+                if self.writers_.get(writer.key_) is writer:
+                    del self.writers_[writer.key_]
+                if ok and not writer.failed_:
+                    # Atomic publish: readers either see the whole file or none
+                    os.replace(writer.part_, self.path(writer.key_))
+                    size = os.path.getsize(self.path(writer.key_))
+                    self.entries_ += 1
+                    self.size_ += size
+                    self.unscanned_ += size
+                    scan = self.unscanned_ > self.max_size_ / SCAN_FRACTION and not self.scanning_
+                    if scan:
+                        self.scanning_ = True
+                    app.logger.debug(f"transcode cache: {self.hits} hits, {self.misses} misses, "
+                                     f"{self.size_}/{self.max_size_} bytes")
+                else:
+                    os.unlink(writer.part_)
+        except OSError as e:
+            # Readers still have the file open, so they can finish reading it
+            app.logger.warning(f"could not publish {writer.key_} to the transcode cache: {e}")
+        finally:
+            writer.finish(ok)
+
+        if scan:
+            try:
+                self.scan()
+            finally:
+                self.scanning_ = False
+
+def transcode(item, fmt, bitrate, estimate_length=False):
+    """Returns a response streaming the item in the given format. Raises
+    TranscodeError if the format is not supported, no encoder slot got free
+    or the encoder failed before producing any output.
+    """
+    if fmt not in FORMATS:
+        raise TranscodeError(f"unsupported format {fmt}")
+    mimetype = FORMATS[fmt][1]
+    cache = get_cache()
+
+    if cache is None:
+        proc = start_encoder(item, fmt, bitrate)
+        first = proc.stdout.read1(CHUNK_SIZE)
+        if not first:
+            if proc.wait() != 0:
+                log_encoder_failure(proc)
+            stop_encoder(proc)
+            raise TranscodeError("transcoding failed")
+        response = Response(TranscodeStream(proc, first), mimetype=mimetype)
+    else:
+        key = f"{item.id}-{int(item.mtime)}-{bitrate}.{fmt}"
+        body = cache.open(key, lambda: start_encoder(item, fmt, bitrate))
+        if isinstance(body, str):
+            return flask.send_file(body, mimetype=mimetype, conditional=True)
+        if not body.wait_for_output():
+            body.close()
+            raise TranscodeError("transcoding failed")
+        response = Response(body, mimetype=mimetype)
+
+    if estimate_length:
+        response.headers['Content-Length'] = ceil(item.length * bitrate * 1000 / 8)
+    return response
+
+def collect_metrics():
+    if _cache is None:
+        return []
+    stats = _cache.stats()
+    return [
+        family('beetstream_transcode_cache_hits_total', 'counter',
+               'Transcodes served from the transcode cache.', stats['hits']),
+        family('beetstream_transcode_cache_misses_total', 'counter',
+               'Transcodes that started an encoder.', stats['misses']),
+        family('beetstream_transcode_cache_bytes', 'gauge',
+               'Size of the cached transcodes.', stats['size']),
+    ]
+
+register_collector(collect_metrics)
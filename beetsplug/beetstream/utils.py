@@ -5,9 +5,18 @@ import flask
 import json
 import base64
 import mimetypes
+import os
 import enum
-import xml.etree.cElementTree as ET
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from collections.abc import Iterator
+from itertools import chain
 from math import ceil
+from beets.dbcore.query import Query
+from beetsplug.beetstream.plays import album_play_counts, item_play_counts
+from beetsplug.beetstream.annotations import annotations
+from beetsplug.beetstream.store import IDS_BATCH_SIZE, batches
 
 class SubsonicErrorCode(enum.IntEnum):
     GENERIC_ERROR = 0    # A generic error
@@ -15,12 +24,35 @@ class SubsonicErrorCode(enum.IntEnum):
     CLIENT_TOO_OLD = 20  # Incompatible Subsonic REST protocol version. Client must upgrade.
     SERVER_TOO_OLD = 30  # Incompatible Subsonic REST protocol version. Server must upgrade.
     INVALID_AUTH = 40    # Wrong username or password.
+    CONFLICTING_AUTH = 43 # Multiple conflicting authentication mechanisms provided.
+    INVALID_API_KEY = 44 # Invalid API key.
     UNAUTHORIZED = 50    # User is not authorized for the given operation.
     NOT_FOUND = 70       # The requested data was not found.
 
 def strip_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
+def sort_key(s):
+    return strip_accents(s or '').upper()
+
+def register_sql_functions(lib):
+    # Connections are per thread, so this is (cheaply) redone before use
+    lib._connection().create_function('sort_key', 1, sort_key, deterministic=True)
+
+def library_mtime(lib):
+    # Moves whenever a beets process commits a change to the library, which
+    # is how changes made by other processes are noticed
+    try:
+        return os.stat(lib.path).st_mtime_ns
+    except OSError:
+        return None
+
+def request_library_mtime():
+    # Read once per request, for the records of whole lists
+    if 'library_mtime' not in flask.g:
+        flask.g.library_mtime = library_mtime(flask.g.lib)
+    return flask.g.library_mtime
+
 def timestamp_to_iso(timestamp):
     return datetime.fromtimestamp(int(timestamp)).isoformat()
 
@@ -56,57 +88,145 @@ class ElemText:
     def __repr__(self):
         return self.s
 
-def response_to_json(d):
-    if type(d) is dict:
-        ret = {}
-        for k, v in d.items():
-            if type(v) is dict:
-                ret[str(k)] = response_to_json(d[k])
-            elif type(v) is list:
-                ret[str(k)] = [response_to_json(val) for val in v]
-            else:
-                ret[str(k)] = v
-        return ret
-    else:
-        return d
+# Responses are serialized in a single pass, as a stream of string chunks,
+# so list values may be generators of mapped entities that are only consumed
+# while the response is being sent. The output is byte-identical to what
+# ElementTree (for XML) and jsonify/json.dumps (for JSON/JSONP) produce.
+
+CHUNK_SIZE = 16 * 1024
+JSON_RUN_SIZE = 256
+
+JSON_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+JSONP_ENCODER = json.JSONEncoder()
+
+# Checked first, as isinstance(v, Iterator) is slow and runs for every value
+SCALAR_TYPES = frozenset([str, int, float, bool, type(None)])
 
-def response_to_xml(d, parent=None):
-    def stringify(v):
-        if type(v) is bool:
-            return "true" if v else "false"
-        return str(v)
+def is_sequence(v):
+    return type(v) not in SCALAR_TYPES and (
+        type(v) is list or type(v) is tuple or isinstance(v, Iterator))
 
-    assert(len(d.keys()) == 1)
-    name = list(d.keys())[0]
+def is_container(v):
+    return type(v) not in SCALAR_TYPES and (type(v) is dict or is_sequence(v))
 
-    element = ET.Element(name) if parent is None else ET.SubElement(parent, name)
-    for k, v in d[name].items():
+def stringify(v):
+    if type(v) is bool:
+        return "true" if v else "false"
+    return str(v)
+
+def xml_text_chunk(name, v):
+    text = stringify(v)
+    if text:
+        return f"<{name}>{ET._escape_cdata(text)}</{name}>"
+    return f"<{name} />"
+
+def xml_chunks(name, d):
+    attrs = {}
+    text = None
+    children = []
+    for k, v in d.items():
         if isinstance(k, Attr):
-            k = k.s
-            element.set(k, stringify(v))
+            attrs[k.s] = v
         elif isinstance(k, ElemText):
-            element.text = v
+            text = v
         elif isinstance(k, Elem):
-            k = k.s
+            children.append((k.s, (v,)))
+        elif is_sequence(v):
+            children.append((k, v))
+        elif type(v) is dict:
+            children.append((k, (v,)))
+        else:
+            attrs[k] = v
+
+    # Same escaping as ElementTree.tostring()
+    head = '<' + name + ''.join(f' {k}="{ET._escape_attrib(stringify(v))}"'
+                                for k, v in attrs.items())
+    opened = False
+    if text:
+        yield head + '>' + ET._escape_cdata(text)
+        opened = True
+
+    for child_name, values in children:
+        for v in values:
+            if not opened:
+                yield head + '>'
+                opened = True
             if type(v) is dict:
-                response_to_xml({k: v}, parent=element)
+                yield from xml_chunks(child_name, v)
             else:
-                sub = ET.SubElement(element, k)
-                sub.text = stringify(v)
+                yield xml_text_chunk(child_name, v)
+
+    yield f"</{name}>" if opened else head + " />"
+
+def json_keys(d):
+    return {str(k): v for k, v in d.items()}
+
+def is_flat(v):
+    return not is_sequence(v) and not (type(v) is dict and any(map(is_container, v.values())))
+
+def json_run(run, encoder, first):
+    # Encoded as a list, without its brackets
+    return ('' if first else encoder.item_separator) + encoder.encode(run)[1:-1]
+
+def json_chunks(v, encoder):
+    if type(v) is dict:
+        d = json_keys(v)
+        if not any(map(is_container, d.values())):
+            yield encoder.encode(d)
+            return
+
+        yield '{'
+        first = True
+        for k in (sorted(d) if encoder.sort_keys else d):
+            if not first:
+                yield encoder.item_separator
+            first = False
+            yield encoder.encode(k) + encoder.key_separator
+            yield from json_chunks(d[k], encoder)
+        yield '}'
+    elif is_sequence(v):
+        if type(v) is not list or any(map(is_container, v)):
+            yield '['
+            first = True
+            # Consecutive flat entries (e.g. songs) are encoded together, as
+            # each encode() call costs about as much as a small dict
+            run = []
+            for val in v:
+                if is_flat(val):
+                    run.append(json_keys(val) if type(val) is dict else val)
+                    if len(run) == JSON_RUN_SIZE:
+                        yield json_run(run, encoder, first)
+                        first = False
+                        run = []
+                    continue
+                if run:
+                    yield json_run(run, encoder, first)
+                    first = False
+                    run = []
+                if not first:
+                    yield encoder.item_separator
+                first = False
+                yield from json_chunks(val, encoder)
+            if run:
+                yield json_run(run, encoder, first)
+            yield ']'
         else:
-            if type(v) is list:
-                for val in v:
-                    if type(val) is dict:
-                        response_to_xml({k: val}, parent=element)
-                    else:
-                        sub = ET.SubElement(element, k)
-                        sub.text = stringify(val)
-            elif type(v) is dict:
-                response_to_xml({k: v}, parent=element)
-            else:
-                element.set(k, stringify(v))
-
-    return element
+            yield encoder.encode(v)
+    else:
+        yield encoder.encode(v)
+
+def buffered(chunks):
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
 
 def subsonic_response(request, d, ok=True):
     fmt = request.values.get('f') or 'xml'
@@ -121,15 +241,21 @@ def subsonic_response(request, d, ok=True):
 
     if fmt == "xml":
         response["subsonic-response"]["xmlns"] = "http://subsonic.org/restapi"
-        xml = ET.tostring(response_to_xml(response), encoding='unicode')
-        return flask.Response(xml, mimetype='text/xml')
+        chunks = xml_chunks("subsonic-response", response["subsonic-response"])
+        mimetype = 'text/xml'
+    elif fmt == "jsonp":
+        callback = request.values.get("callback")
+        chunks = chain([f"{callback}("], json_chunks(response, JSONP_ENCODER), [");"])
+        mimetype = 'text/html'
     else:
-        response = response_to_json(response)
-        if fmt == "jsonp":
-            callback = request.values.get("callback")
-            return f"{callback}({json.dumps(response)});"
-        else:
-            return flask.jsonify(response)
+        chunks = chain(json_chunks(response, JSON_ENCODER), ["\n"])
+        mimetype = 'application/json'
+
+    response = flask.Response(flask.stream_with_context(buffered(chunks)), mimetype=mimetype)
+    if not ok:
+        # Errors may be transient, e.g. while beets imports
+        response.cache_control.no_store = True
+    return response
 
 def subsonic_response_error(request, code, message=""):
     d = {
@@ -141,7 +267,144 @@ def subsonic_response_error(request, code, message=""):
 
     return subsonic_response(request, d, ok=False)
 
-def map_album(album):
+
+class IdsQuery(Query):
+    """Matches the objects with the given ids, with a single IN clause."""
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    def clause(self):
+        return f"id IN ({', '.join('?' * len(self.ids))})", self.ids
+
+    def match(self, obj):
+        return obj.id in self.ids
+
+def fetch_by_ids(fetch, ids):
+    """Fetches the objects with the given ids with one query per batch of
+    ids, in the same order. Beets loads the flexible attributes of each
+    batch with a single extra query.
+    """
+    unique_ids = list(dict.fromkeys(ids))
+    objs = {}
+    for i in range(0, len(unique_ids), IDS_BATCH_SIZE):
+        objs.update((obj.id, obj) for obj in fetch(IdsQuery(unique_ids[i:i + IDS_BATCH_SIZE])))
+    return [objs[id] for id in ids if id in objs]
+
+def items_by_ids(ids):
+    """Fetches the items with the given ids, in the same order."""
+    return fetch_by_ids(flask.g.lib.items, ids)
+
+def albums_by_ids(ids):
+    """Fetches the albums with the given ids, in the same order."""
+    return fetch_by_ids(flask.g.lib.albums, ids)
+
+def album_stats(album_ids):
+    """Song count and total duration of each album, from one grouped query
+    per batch of ids.
+    """
+    album_ids = list(dict.fromkeys(album_ids))
+    rows = []
+    with flask.g.lib.transaction() as tx:
+        for batch in batches(album_ids):
+            placeholders = ', '.join('?' * len(batch))
+            rows += tx.query(f"SELECT album_id, COUNT(*), SUM(length) FROM items "
+                             f"WHERE album_id IN ({placeholders}) GROUP BY album_id", batch)
+    return {row[0]: (row[1], int(row[2] or 0)) for row in rows}
+
+def songs_stats(songs):
+    return len(songs), int(sum(song.length for song in songs))
+
+def current_user():
+    # Set by the authentication, which also accepts API keys instead of u
+    return flask.g.get('user') or flask.request.values.get('u') or ''
+
+# Play counts, stars and ratings are looked up for whole lists at once, with
+# one query per table of the store.
+def song_annotations(ids):
+    ids = list(ids)
+    play_counts = item_play_counts(ids)
+    stars = annotations(current_user(), 'song', ids)
+    return {id: {"playCount": play_counts.get(id, 0), **stars.get(str(id), {})} for id in ids}
+
+def album_annotations(ids):
+    ids = list(ids)
+    play_counts = album_play_counts(ids)
+    stars = annotations(current_user(), 'album', ids)
+    return {id: {"playCount": play_counts.get(id, 0), "averageRating": 0, **stars.get(str(id), {})}
+            for id in ids}
+
+def map_albums(albums):
+    albums = list(albums)
+    stats = album_stats(album.id for album in albums)
+    extra = album_annotations(album.id for album in albums)
+    return [map_album(album, stats.get(album.id, (0, 0)), extra[album.id]) for album in albums]
+
+def map_songs(songs):
+    songs = list(songs)
+    extra = song_annotations(song.id for song in songs)
+    return [map_song(song, extra[song.id]) for song in songs]
+
+def map_artists(artist_names):
+    artist_names = list(artist_names)
+    stars = annotations(current_user(), 'artist', artist_names)
+    return [{**map_artist(name), **stars.get(name, {})} for name in artist_names]
+
+class MappingCache:
+    """Bounded LRU of mapped entities, stored as tuples of values.
+
+    Each record is stored along with a stamp and is only returned while the
+    entity still has the same stamp. Stamps include the library file's mtime,
+    so that changes made by other beets processes (which don't send events
+    to the server) are seen. The plugin also invalidates records on beets'
+    database_change events.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size_ = max_size
+        self.keys_ = None
+        self.records_ = OrderedDict()
+        self.lock_ = threading.Lock()
+
+    def get(self, id, stamp, build):
+        with self.lock_:
+            entry = self.records_.get(id)
+            if entry is not None and entry[0] == stamp:
+                self.records_.move_to_end(id)
+                return dict(zip(self.keys_, entry[1]))
+
+        d = build()
+        with self.lock_:
+            if self.keys_ is None:
+                self.keys_ = tuple(d)
+            self.records_[id] = (stamp, tuple(d.values()))
+            self.records_.move_to_end(id)
+            while len(self.records_) > self.max_size_:
+                self.records_.popitem(last=False)
+        return d
+
+    def invalidate(self, id=None):
+        with self.lock_:
+            if id is None:
+                self.records_.clear()
+            else:
+                self.records_.pop(id, None)
+
+SONG_CACHE = MappingCache()
+ALBUM_CACHE = MappingCache()
+
+def map_album(album, stats=None, extra=None):
+    if stats is None:
+        stats = album_stats([album.id]).get(album.id, (0, 0))
+    song_count, duration = stats
+    if extra is None:
+        extra = album_annotations([album.id])[album.id]
+
+    d = ALBUM_CACHE.get(album.id, request_library_mtime(), lambda: album_record(album))
+    d["songCount"] = song_count
+    d["duration"] = duration
+    d.update(extra)
+    return d
+
+def album_record(album):
     return {
         "id": album_beetid_to_subid(str(album.id)),
         "name": album.album,
@@ -152,17 +415,24 @@ def map_album(album):
         "parent": artist_name_to_id(album.albumartist),
         "isDir": True,
         "coverArt": album_beetid_to_subid(str(album.id)) or "",
-        "songCount": 1, # TODO
-        "duration": 1, # TODO
-        "playCount": 1, # TODO
+        "songCount": 0,
+        "duration": 0,
+        "playCount": 0,
         "created": timestamp_to_iso(album.added),
         "year": album.year,
         "genre": album.genre,
-        "starred": "1970-01-01T00:00:00.000Z", # TODO
-        "averageRating": 0 # TODO
     }
 
-def map_song(item):
+def map_song(item, extra=None):
+    if extra is None:
+        extra = song_annotations([item.id])[item.id]
+    # Tags can change without the file being written, and item.mtime moving
+    stamp = (request_library_mtime(), item.mtime)
+    d = SONG_CACHE.get(item.id, stamp, lambda: song_record(item))
+    d.update(extra)
+    return d
+
+def song_record(item):
     path = item.path.decode('utf-8')
     return {
         "id": song_beetid_to_subid(str(item.id)),
@@ -182,9 +452,8 @@ def map_song(item):
         "duration": ceil(item.length),
         "bitRate": ceil(item.bitrate/1000),
         "path": path,
-        "playCount": 1, #TODO
+        "playCount": 0,
         "created": timestamp_to_iso(item.added),
-        # "starred": "2019-10-23T04:41:17.107Z",
         "albumId": album_beetid_to_subid(str(item.album_id)),
         "artistId": artist_name_to_id(item.albumartist),
         "type": "music"
@@ -194,8 +463,6 @@ def map_artist(artist_name):
     return {
         "id": artist_name_to_id(artist_name),
         "name": artist_name,
-        # TODO
-        # "starred": "2021-07-03T06:15:28.757Z", # nothing if not starred
         "coverArt": "",
         "albumCount": 1,
         "artistImageUrl": "https://t4.ftcdn.net/jpg/00/64/67/63/360_F_64676383_LdbmhiNM6Ypzb3FM4PPuFP9rHe7ri8Ju.jpg"
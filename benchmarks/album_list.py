@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Benchmark of getAlbumList2 paging as the library grows.
+
+Before: every album was loaded with `list(lib.albums())`, then sorted or
+filtered in Python, and the page sliced out of the whole list. After: each
+type is a single SQL query with ORDER BY/LIMIT/OFFSET (the alphabetical
+orders are sorted once and kept in memory). Both select a page from the
+middle of the list, and the full getAlbumList2 request is timed as well:
+
+    $ python benchmarks/album_list.py --albums 1000 10000 40000
+"""
+
+import argparse
+from random import shuffle
+
+from common import app, make_client, make_library, measure
+from flask import g
+
+from beetsplug.beetstream.albums import create_album_list_indexes, query_album_list
+from beetsplug.beetstream.utils import strip_accents
+
+TYPES = ['newest', 'alphabeticalByName', 'alphabeticalByArtist', 'byYear', 'byGenre', 'random']
+GENRE = 'Jazz'
+FROM_YEAR = 1990
+TO_YEAR = 2000
+
+def old_album_page(lib, sort_by, size, offset):
+    """The page as selected before getAlbumList2 was planned in SQL."""
+    albums = list(lib.albums())
+
+    if sort_by == 'newest':
+        albums.sort(key=lambda album: int(album.added), reverse=True)
+    elif sort_by == 'alphabeticalByName':
+        albums.sort(key=lambda album: strip_accents(album.album).upper())
+    elif sort_by == 'alphabeticalByArtist':
+        albums.sort(key=lambda album: strip_accents(album.albumartist).upper())
+    elif sort_by == 'byGenre':
+        albums = list(filter(lambda album: album.genre.lower() == GENRE.lower(), albums))
+    elif sort_by == 'byYear':
+        albums = list(filter(lambda album: FROM_YEAR <= album.year <= TO_YEAR, albums))
+        albums.sort(key=lambda album: int(album.year))
+    elif sort_by == 'random':
+        shuffle(albums)
+
+    return albums[offset:offset + size]
+
+def new_album_page(lib, sort_by, size, offset):
+    with app.test_request_context():
+        g.lib = lib
+        return query_album_list(sort_by, size, offset, FROM_YEAR, TO_YEAR, GENRE)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--albums', type=int, nargs='+', default=[1000, 10000, 40000],
+                        help='library sizes, in albums (default: 1000 10000 40000)')
+    parser.add_argument('--songs', type=int, default=10, help='songs per album (default: 10)')
+    parser.add_argument('--size', type=int, default=50, help='page size (default: 50)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed runs, the median is printed (default: 5)')
+    args = parser.parse_args()
+
+    print(f"{'albums':>7} {'type':<21} {'before ms':>10} {'after ms':>10} {'request ms':>11}")
+    for albums in args.albums:
+        lib = make_library(albums, args.songs)
+        create_album_list_indexes(lib)
+        client = make_client(lib)
+        # Within the albums matching the genre and year filters too
+        offset = albums // 20
+
+        for sort_by in TYPES:
+            before = measure(lambda: old_album_page(lib, sort_by, args.size, offset), args.repeat)
+            after = measure(lambda: new_album_page(lib, sort_by, args.size, offset), args.repeat)
+            url = (f"/rest/getAlbumList2?f=json&type={sort_by}&size={args.size}&offset={offset}"
+                   f"&genre={GENRE}&fromYear={FROM_YEAR}&toYear={TO_YEAR}")
+            request = measure(lambda: client.get(url).get_data(), args.repeat)
+            print(f"{albums:>7} {sort_by:<21} {before * 1000:>10.1f} {after * 1000:>10.1f} "
+                  f"{request * 1000:>11.1f}")
+
+if __name__ == '__main__':
+    main()
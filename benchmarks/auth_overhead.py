@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Benchmark of the authentication run before every request.
+
+Before: `handle_auth` read the users from the confuse config and hashed
+the password and salt with MD5 on every request. After: the credentials
+are read once and verified (user, salt, token) tuples are remembered, and
+OpenSubsonic API keys are a dict lookup. Both check the requests of a
+cover art grid, all sent with the same salt and token as clients do:
+
+    $ python benchmarks/auth_overhead.py --covers 200
+"""
+
+import argparse
+import binascii
+import statistics
+import time
+from hashlib import md5
+
+from common import app, make_client, make_library
+from flask import request
+
+from beetsplug.beetstream.auth import handle_auth
+from beetsplug.beetstream.utils import SubsonicErrorCode, subsonic_response_error
+
+USER = 'bench'
+PASSWORD = 'sesame'
+API_KEY = 'bench-api-key'
+SALT = 'c19b2d'
+
+password_cache = {}
+
+def get_password(user):
+    if user in password_cache:
+        return password_cache[user]
+
+    users = app.config['config']['users']
+    if user not in users:
+        return None
+    user_conf = users[user]
+
+    if 'password' in user_conf:
+        password = user_conf['password']
+    elif 'passwordFile' in users[user]:
+        with open(user_conf['passwordFile'], 'r') as f:
+            password = f.read()
+
+    password_cache[user] = password
+    return password
+
+def authorized(password, salt, token, supplied_pw):
+    if salt is not None and token is not None:
+        concat = (str(password) + salt).encode('utf-8')
+        return md5(concat).hexdigest() == token
+    elif supplied_pw is not None:
+        if supplied_pw.startswith('enc:'):
+            supplied_pw = binascii.unhexlify(supplied_pw[4:].encode('utf-8'))
+        return supplied_pw == str(password)
+    return False
+
+def old_handle_auth():
+    """handle_auth before credentials were cached."""
+    # Allow all users through by default.
+    if 'users' not in app.config['config']:
+        return
+
+    user = request.values.get('u')
+    salt = request.values.get('s')
+    token = request.values.get('t')
+    pw = request.values.get('p')
+
+    if user is None and ((salt is None or token is None) or (pw is None)):
+        return subsonic_response_error(request, SubsonicErrorCode.MISSING_PARAM,
+                                       "missing required parameter for auth")
+    password = get_password(user)
+    if password is None:
+        return subsonic_response_error(request, SubsonicErrorCode.INVALID_AUTH,
+                                       "unknown username")
+
+    if not authorized(password, salt, token, pw):
+        return subsonic_response_error(request, SubsonicErrorCode.INVALID_AUTH,
+                                       "incorrect password")
+
+def check_grid(check, urls):
+    """Runs `check` in the context of each request of the grid. Returns the
+    time spent in `check`, without setting up the requests and parsing
+    their parameters.
+    """
+    duration = 0
+    for url in urls:
+        with app.test_request_context(url):
+            # Parsed for the view in any case
+            request.values
+            start = time.perf_counter()
+            result = check()
+            duration += time.perf_counter() - start
+            assert result is None
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--covers', type=int, default=200,
+                        help='getCoverArt requests in the grid (default: 200)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed runs, the median is printed (default: 5)')
+    args = parser.parse_args()
+
+    make_client(make_library(1, 1), users={USER: {'password': PASSWORD, 'apiKey': API_KEY}})
+    token = md5((PASSWORD + SALT).encode('utf-8')).hexdigest()
+    token_urls = [f'/rest/getCoverArt?u={USER}&s={SALT}&t={token}&v=1.16.1&c=bench&id=2{n}'
+                  for n in range(args.covers)]
+    key_urls = [f'/rest/getCoverArt?apiKey={API_KEY}&v=1.16.1&c=bench&id=2{n}'
+                for n in range(args.covers)]
+    rows = [
+        ('before, token', old_handle_auth, token_urls),
+        ('after, token', handle_auth, token_urls),
+        ('after, apiKey', handle_auth, key_urls),
+    ]
+    print(f"{'path':<15} {'us/request':>11}")
+    for name, check, urls in rows:
+        check_grid(check, urls)
+        duration = statistics.median(check_grid(check, urls) for _ in range(args.repeat))
+        print(f"{name:<15} {duration / len(urls) * 1e6:>11.1f}")
+
+if __name__ == '__main__':
+    main()
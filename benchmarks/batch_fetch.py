@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Benchmark of fetching lists of songs and albums by id.
+
+Before: play queues, playlists, scrobbles, music directories and cover art
+looked up each id with `lib.get_item`/`lib.get_album`, which costs two
+queries per id (the row and its flexible attributes). After:
+`items_by_ids`/`albums_by_ids` fetch up to IDS_BATCH_SIZE ids with one
+IN (...) query, plus one for their flexible attributes. The SQL statements
+run (counted with a trace callback) and the time are printed:
+
+    $ python benchmarks/batch_fetch.py --ids 10 100 1000
+"""
+
+import argparse
+import random
+
+from common import app, make_library, measure
+from flask import g
+
+from beetsplug.beetstream.utils import albums_by_ids, items_by_ids
+
+def old_items(lib, ids):
+    return [lib.get_item(id) for id in ids]
+
+def old_albums(lib, ids):
+    return [lib.get_album(id) for id in ids]
+
+def new_fetch(lib, fetch, ids):
+    with app.test_request_context():
+        g.lib = lib
+        return fetch(ids)
+
+def count_statements(lib, fn):
+    statements = []
+    conn = lib._connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        conn.set_trace_callback(None)
+    return len(statements)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--ids', type=int, nargs='+', default=[10, 100, 1000],
+                        help='ids fetched at once (default: 10 100 1000)')
+    parser.add_argument('--albums', type=int, default=2000,
+                        help='albums in the library, of 10 songs (default: 2000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed runs, the median is printed (default: 5)')
+    args = parser.parse_args()
+
+    lib = make_library(args.albums, 10)
+    # Flexible attributes are loaded with a query of their own
+    with lib.transaction() as tx:
+        tx.mutate("INSERT INTO item_attributes (entity_id, key, value) "
+                  "SELECT id, 'mood', 'calm' FROM items")
+    rnd = random.Random(0)
+    item_ids = [row[0] for row in lib._connection().execute("SELECT id FROM items")]
+    album_ids = [row[0] for row in lib._connection().execute("SELECT id FROM albums")]
+
+    print(f"{'entity':<7} {'ids':>5} {'before queries':>15} {'after queries':>14} "
+          f"{'before ms':>10} {'after ms':>9}")
+    for entity, all_ids, old, new in [('songs', item_ids, old_items, items_by_ids),
+                                      ('albums', album_ids, old_albums, albums_by_ids)]:
+        for count in args.ids:
+            ids = rnd.sample(all_ids, min(count, len(all_ids)))
+            before = lambda: old(lib, ids)
+            after = lambda: new_fetch(lib, new, ids)
+            assert [obj.id for obj in before()] == [obj.id for obj in after()]
+            print(f"{entity:<7} {len(ids):>5} {count_statements(lib, before):>15} "
+                  f"{count_statements(lib, after):>14} "
+                  f"{measure(before, args.repeat) * 1000:>10.1f} "
+                  f"{measure(after, args.repeat) * 1000:>9.1f}")
+
+if __name__ == '__main__':
+    main()
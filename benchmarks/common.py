@@ -0,0 +1,92 @@
+"""Synthetic libraries and the Flask app, shared by the in-process benchmarks.
+
+The benchmarks import the plugin from this checkout and keep the beets
+configuration and Beetstream's database in a temporary directory, so they
+don't touch the user's own.
+"""
+
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BEETSDIR', tempfile.mkdtemp(prefix='beetstream-bench-'))
+
+import beets
+from beets import library
+from beetsplug.beetstream import app, BeetstreamPlugin
+
+GENRES = ['Rock', 'Jazz', 'Pop', 'Electronic', 'Classical', 'Folk']
+WORDS = ['black', 'blue', 'café', 'dance', 'électrique', 'fire', 'ghost', 'heart',
+         'island', 'jungle', 'kings', 'love', 'moon', 'night', 'ocean', 'paris']
+
+# Songs' files don't exist, and beets warns whenever their size is read
+logging.getLogger('beets').setLevel(logging.ERROR)
+
+def title(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for _ in range(words)).capitalize()
+
+def make_library(albums, songs_per_album, directory=None, seed=0):
+    """Returns a library file of `albums` albums of `songs_per_album` songs
+    each, in `directory` or a temporary one. Rows are written with plain
+    INSERTs, as adding that many beets models one by one takes minutes.
+    """
+    directory = directory or tempfile.mkdtemp(prefix='beetstream-bench-')
+    beets.config['directory'] = directory
+    lib = library.Library(os.path.join(directory, 'library.db'), directory)
+    rnd = random.Random(seed)
+
+    album_rows = []
+    item_rows = []
+    for album_id in range(1, albums + 1):
+        album = title(rnd, 2)
+        artist = title(rnd, 2)
+        genre = rnd.choice(GENRES)
+        year = rnd.randint(1960, 2024)
+        added = 1.5e9 + rnd.randint(0, 10 ** 8)
+        album_rows.append((album_id, album, artist, genre, year, added))
+        for track in range(1, songs_per_album + 1):
+            path = os.path.join(directory, artist, album, f"{track:02d}.mp3")
+            item_rows.append((album_id, title(rnd, 3), album, artist, artist, track, year,
+                              genre, rnd.uniform(120, 420), 320000, 'MP3',
+                              path.encode('utf-8'), added, added))
+
+    conn = lib._connection()
+    conn.executemany("INSERT INTO albums (id, album, albumartist, genre, year, added) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", album_rows)
+    conn.executemany("INSERT INTO items (album_id, title, album, artist, albumartist, track, "
+                     "year, genre, length, bitrate, format, path, mtime, added) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", item_rows)
+    conn.commit()
+    return lib
+
+def make_client(lib, **config):
+    """Returns a test client of the app serving `lib`. The response cache
+    is off unless `config` turns it on, so that views are measured.
+    """
+    plugin = BeetstreamPlugin()
+    plugin.config['database'] = os.path.join(tempfile.mkdtemp(prefix='beetstream-bench-'),
+                                             'beetstream.db')
+    plugin.config['response_cache']['backend'] = 'none'
+    for key, value in config.items():
+        plugin.config[key] = value
+    app.config['lib'] = lib
+    app.config['INCLUDE_PATHS'] = plugin.config['include_paths']
+    app.config['config'] = plugin.config
+    return app.test_client()
+
+def measure(fn, repeat=5):
+    """Runs `fn` once to warm up, then `repeat` times. Returns the median
+    duration, in seconds.
+    """
+    fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
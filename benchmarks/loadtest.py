@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Load test comparing the requests per second of Beetstream servers.
+
+Concurrent clients (one keep-alive connection each) send getAlbumList2 and
+stream requests to running servers for a fixed time, then the throughput
+and latencies of each server are printed side by side. For example, to
+compare Flask's server with gunicorn (`server: gunicorn` and another port
+in a second beets config):
+
+    $ beet beetstream
+    $ beet -c gunicorn.yaml beetstream
+    $ python benchmarks/loadtest.py flask=http://localhost:8080 gunicorn=http://localhost:8081
+
+Only responses with a Subsonic status of "ok" count as successes, others
+are errors. `getAlbumList2` asks for random list types and offsets, which
+are mostly missed by the response cache, while `getAlbumList2-cached`
+cycles through the same pages and mostly measures cache hits. To measure
+the views alone, run the servers with `response_cache: {backend: none}`.
+
+Only the standard library is needed.
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import random
+import string
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+CHUNK_SIZE = 64 * 1024
+
+def auth_params(user, password):
+    salt = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
+    token = hashlib.md5((password + salt).encode('utf-8')).hexdigest()
+    return {'u': user, 't': token, 's': salt, 'v': '1.16.1', 'c': 'loadtest', 'f': 'json'}
+
+class Client:
+    """A keep-alive connection to one server, reconnecting after errors."""
+    def __init__(self, url, params):
+        url = urlsplit(url)
+        self.https_ = url.scheme == 'https'
+        self.netloc_ = url.netloc
+        self.prefix_ = url.path.rstrip('/')
+        self.params_ = params
+        self.conn_ = None
+
+    def path(self, endpoint, params):
+        return f"{self.prefix_}/rest/{endpoint}?{urlencode({**self.params_, **params})}"
+
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.https_ else http.client.HTTPConnection
+        return cls(self.netloc_, timeout=60)
+
+    def get(self, endpoint, **params):
+        """Returns whether the request succeeded and the size of the body.
+        Subsonic errors are sent with a 200 status, so JSON bodies are
+        parsed and only an "ok" status is a success.
+        """
+        if self.conn_ is None:
+            self.conn_ = self.connect()
+        try:
+            self.conn_.request('GET', self.path(endpoint, params))
+            response = self.conn_.getresponse()
+            is_json = response.getheader('Content-Type', '').startswith('application/json')
+            size = 0
+            chunks = []
+            data = response.read(CHUNK_SIZE)
+            while data:
+                size += len(data)
+                if is_json:
+                    chunks.append(data)
+                data = response.read(CHUNK_SIZE)
+            if response.will_close:
+                self.close()
+            ok = response.status in (200, 206)
+            if ok and is_json:
+                ok = json.loads(b''.join(chunks))['subsonic-response']['status'] == 'ok'
+            return ok, size
+        except (OSError, ValueError, KeyError, http.client.HTTPException):
+            self.close()
+            return False, 0
+
+    def get_json(self, endpoint, **params):
+        conn = self.connect()
+        try:
+            conn.request('GET', self.path(endpoint, params))
+            return json.loads(conn.getresponse().read())['subsonic-response']
+        finally:
+            conn.close()
+
+    def close(self):
+        if self.conn_ is not None:
+            self.conn_.close()
+            self.conn_ = None
+
+def song_ids(url, params, count):
+    response = Client(url, params).get_json('getRandomSongs', size=count)
+    if response['status'] != 'ok':
+        raise SystemExit(f"{url}: {response['error']['message']}")
+    songs = response['randomSongs'].get('song', [])
+    if not songs:
+        raise SystemExit(f"{url}: the library has no songs")
+    return [song['id'] for song in songs]
+
+ALBUM_LIST_TYPES = ['newest', 'alphabeticalByName', 'alphabeticalByArtist', 'frequent', 'recent',
+                    'random']
+
+def requests_for(endpoint, args, ids):
+    """Returns the endpoint and a function giving the parameters of the
+    n-th request.
+    """
+    if endpoint == 'getAlbumList2':
+        return endpoint, lambda n: {'type': random.choice(ALBUM_LIST_TYPES), 'size': args.size,
+                                    'offset': random.randrange(args.max_offset)}
+    if endpoint == 'getAlbumList2-cached':
+        return 'getAlbumList2', lambda n: {'type': args.type, 'size': args.size,
+                                           'offset': (n * args.size) % args.max_offset}
+    return endpoint, lambda n: {'id': ids[n % len(ids)], 'format': 'raw'}
+
+def run(url, params, endpoint, next_params, concurrency, duration):
+    """Sends requests from `concurrency` clients during `duration` seconds.
+    Returns the latencies of the successful requests, the number of errors
+    and the bytes received.
+    """
+    latencies = []
+    errors = 0
+    received = 0
+    lock = threading.Lock()
+    counter = iter(range(1 << 62))
+    deadline = time.perf_counter() + duration
+
+    def client():
+        nonlocal errors, received
+        client = Client(url, params)
+        mine = []
+        my_errors = my_bytes = 0
+        while time.perf_counter() < deadline:
+            with lock:
+                n = next(counter)
+            start = time.perf_counter()
+            ok, size = client.get(endpoint, **next_params(n))
+            if ok:
+                mine.append(time.perf_counter() - start)
+                my_bytes += size
+            else:
+                my_errors += 1
+        client.close()
+        with lock:
+            latencies.extend(mine)
+            errors += my_errors
+            received += my_bytes
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, received
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('targets', nargs='+', metavar='[NAME=]URL',
+                        help='servers to compare, e.g. gunicorn=http://localhost:8081')
+    parser.add_argument('-e', '--endpoint', action='append',
+                        choices=['getAlbumList2', 'getAlbumList2-cached', 'stream'],
+                        help='endpoints to load (default: all)')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='concurrent clients (default: 16)')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='seconds of load per server and endpoint (default: 10)')
+    parser.add_argument('-u', '--user', default='loadtest')
+    parser.add_argument('-p', '--password', default='')
+    parser.add_argument('--type', default='alphabeticalByName',
+                        help='getAlbumList2-cached type (default: alphabeticalByName)')
+    parser.add_argument('--size', type=int, default=50, help='getAlbumList2 page size (default: 50)')
+    parser.add_argument('--max-offset', type=int, default=1000,
+                        help='getAlbumList2 pages cycle through offsets below this, which should '
+                             'not exceed the number of albums (default: 1000)')
+    parser.add_argument('--songs', type=int, default=100,
+                        help='number of random songs streamed in turn (default: 100)')
+    args = parser.parse_args()
+    endpoints = args.endpoint or ['getAlbumList2', 'getAlbumList2-cached', 'stream']
+
+    targets = []
+    for target in args.targets:
+        name, sep, url = target.partition('=')
+        if not sep or '://' in name:
+            name = url = target
+        targets.append((name, url))
+
+    print(f"{'server':<12} {'endpoint':<20} {'requests':>8} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6} {'MB/s':>8}")
+    for name, url in targets:
+        params = auth_params(args.user, args.password)
+        ids = song_ids(url, params, args.songs) if 'stream' in endpoints else []
+        for endpoint in endpoints:
+            path, next_params = requests_for(endpoint, args, ids)
+            # Warms up the server's caches and connection pools
+            run(url, params, path, next_params, args.concurrency, min(1, args.duration))
+            latencies, errors, received = run(url, params, path, next_params,
+                                              args.concurrency, args.duration)
+            latencies.sort()
+            print(f"{name:<12} {endpoint:<20} {len(latencies):>8} "
+                  f"{len(latencies) / args.duration:>8.1f} "
+                  f"{percentile(latencies, 0.5) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.95) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.1f} "
+                  f"{errors:>6} {received / args.duration / 1e6:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Benchmark of getRandomSongs on a large library.
+
+Before: every song of the library was loaded with `list(lib.items())` and
+10 of them picked by `beets.random.random_objs` (the genre and year filters
+were ignored, they are applied in Python here). After: the ids are chosen
+in SQL and only the chosen songs are loaded. The time and peak memory
+(tracemalloc) of choosing the songs before are compared with those of the
+whole getRandomSongs request after:
+
+    $ python benchmarks/random_songs.py --songs 300000
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from beets.random import random_objs
+from common import make_client, make_library, measure
+
+FILTERS = [
+    ('none', {}),
+    ('genre', {'genre': 'Jazz'}),
+    ('years', {'fromYear': 1990, 'toYear': 1995}),
+    ('genre+years', {'genre': 'Jazz', 'fromYear': 1990, 'toYear': 1995}),
+]
+
+def old_random_songs(lib, size, genre=None, fromYear=None, toYear=None):
+    songs = list(lib.items())
+    if genre:
+        songs = [song for song in songs if song.genre.lower() == genre.lower()]
+    if fromYear:
+        songs = [song for song in songs if song.year >= fromYear]
+    if toYear:
+        songs = [song for song in songs if song.year <= toYear]
+    return random_objs(songs, -1, size)
+
+def new_random_songs(client, size, **params):
+    response = client.get('/rest/getRandomSongs', query_string={'f': 'json', 'size': size,
+                                                               **params})
+    return response.get_json()['subsonic-response']['randomSongs']['song']
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--songs', type=int, default=300000,
+                        help='songs in the library (default: 300000)')
+    parser.add_argument('--size', type=int, default=10, help='songs asked for (default: 10)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs, the median is printed (default: 3)')
+    args = parser.parse_args()
+
+    lib = make_library(args.songs // 10, 10)
+    client = make_client(lib)
+
+    print(f"{'filters':<12} {'before ms':>10} {'after ms':>9} {'before MB':>10} {'after MB':>9}")
+    for name, params in FILTERS:
+        before = lambda: old_random_songs(lib, args.size, **params)
+        after = lambda: new_random_songs(client, args.size, **params)
+        assert len(after()) == args.size
+        before_time = measure(before, args.repeat)
+        before_memory = peak_memory(before)
+        # The items loaded before are only freed by a full collection, which
+        # would otherwise pause the requests timed after
+        gc.collect()
+        print(f"{name:<12} {before_time * 1000:>10.1f} {measure(after, args.repeat) * 1000:>9.1f} "
+              f"{before_memory / 2 ** 20:>10.1f} {peak_memory(after) / 2 ** 20:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Benchmark of serializing a large Subsonic response, in XML and JSON.
+
+Before: the mapped songs were collected in a list, copied again by
+`response_to_json` or turned into an ElementTree by `response_to_xml`,
+then the whole body was rendered as one string. After: `subsonic_response`
+writes the body in chunks while the songs are mapped from a generator.
+The time to the first and to the last chunk and the peak memory
+(tracemalloc) are printed, for a searchResult3 of 50k songs by default:
+
+    $ python benchmarks/serializer.py --songs 50000
+"""
+
+import argparse
+import time
+import tracemalloc
+import xml.etree.cElementTree as ET
+
+import flask
+from common import app
+
+from beetsplug.beetstream.utils import Attr, Elem, ElemText, subsonic_response
+
+def response_to_json(d):
+    if type(d) is dict:
+        ret = {}
+        for k, v in d.items():
+            if type(v) is dict:
+                ret[str(k)] = response_to_json(d[k])
+            elif type(v) is list:
+                ret[str(k)] = [response_to_json(val) for val in v]
+            else:
+                ret[str(k)] = v
+        return ret
+    else:
+        return d
+
+def response_to_xml(d, parent=None):
+    def stringify(v):
+        if type(v) is bool:
+            return "true" if v else "false"
+        return str(v)
+
+    assert(len(d.keys()) == 1)
+    name = list(d.keys())[0]
+
+    element = ET.Element(name) if parent is None else ET.SubElement(parent, name)
+    for k, v in d[name].items():
+        if isinstance(k, Attr):
+            k = k.s
+            element.set(k, stringify(v))
+        elif isinstance(k, ElemText):
+            element.text = v
+        elif isinstance(k, Elem):
+            k = k.s
+            if type(v) is dict:
+                response_to_xml({k: v}, parent=element)
+            else:
+                sub = ET.SubElement(element, k)
+                sub.text = stringify(v)
+        else:
+            if type(v) is list:
+                for val in v:
+                    if type(val) is dict:
+                        response_to_xml({k: val}, parent=element)
+                    else:
+                        sub = ET.SubElement(element, k)
+                        sub.text = stringify(val)
+            elif type(v) is dict:
+                response_to_xml({k: v}, parent=element)
+            else:
+                element.set(k, stringify(v))
+
+    return element
+
+def old_subsonic_response(request, d, ok=True):
+    """subsonic_response before the responses were written in chunks."""
+    fmt = request.values.get('f') or 'xml'
+
+    response = {
+        "subsonic-response": {
+            "status": "ok" if ok else "failed",
+            "version": "1.16.1",
+            **d,
+        }
+    }
+
+    if fmt == "xml":
+        response["subsonic-response"]["xmlns"] = "http://subsonic.org/restapi"
+        xml = ET.tostring(response_to_xml(response), encoding='unicode')
+        return flask.Response(xml, mimetype='text/xml')
+    else:
+        response = response_to_json(response)
+        return flask.jsonify(response)
+
+def song(i):
+    """A song as mapped by map_song."""
+    return {
+        "id": f"3{i}",
+        "parent": f"2{i // 10}",
+        "isDir": False,
+        "title": f"Song & title {i}",
+        "album": f"Album <{i // 10}>",
+        "artist": "Artist",
+        "track": i % 10 + 1,
+        "year": 2000,
+        "genre": "Rock",
+        "coverArt": f"2{i // 10}",
+        "size": 8000000 + i,
+        "contentType": "audio/mpeg",
+        "suffix": "mp3",
+        "duration": 240,
+        "bitRate": 320,
+        "path": f"Artist/Album {i // 10}/{i % 10:02d}.mp3",
+        "created": "2020-01-01T00:00:00",
+        "albumId": f"2{i // 10}",
+        "artistId": "141727469737421",
+        "type": "music",
+    }
+
+def old_response(songs):
+    return old_subsonic_response(flask.request, {
+        "searchResult3": {"song": [song(i) for i in range(songs)]}
+    })
+
+def new_response(songs):
+    return subsonic_response(flask.request, {
+        "searchResult3": {"song": (song(i) for i in range(songs))}
+    })
+
+def send(make_response, songs):
+    """Iterates the body as a WSGI server would. Returns the times to the
+    first and to the last chunk.
+    """
+    start = time.perf_counter()
+    response = make_response(songs)
+    first = None
+    for chunk in response.response:
+        first = first or time.perf_counter() - start
+    response.close()
+    return first, time.perf_counter() - start
+
+def peak_memory(make_response, songs):
+    tracemalloc.start()
+    send(make_response, songs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--songs', type=int, default=50000,
+                        help='songs in the response (default: 50000)')
+    args = parser.parse_args()
+
+    print(f"{'format':<7} {'path':<7} {'first ms':>9} {'total ms':>9} {'peak MB':>8} "
+          f"{'body MB':>8} {'identical':>10}")
+    for fmt in ['xml', 'json']:
+        with app.test_request_context(f'/rest/search3?f={fmt}'):
+            body = new_response(args.songs).get_data()
+            identical = old_response(args.songs).get_data() == body
+            for name, make_response in [('before', old_response), ('after', new_response)]:
+                first, total = send(make_response, args.songs)
+                peak = peak_memory(make_response, args.songs)
+                print(f"{fmt:<7} {name:<7} {first * 1000:>9.1f} {total * 1000:>9.1f} "
+                      f"{peak / 2 ** 20:>8.1f} {len(body) / 2 ** 20:>8.1f} {str(identical):>10}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Benchmark of metadata latency while slow clients stream songs.
+
+Opens many /rest/stream connections that read nothing of the response
+(with a small receive buffer), as mobile clients on slow links do,
+then times ping and getAlbumList2 requests sent meanwhile. With gunicorn
+or waitress each stalled stream holds one of the `threads`; with uvicorn
+it only holds a coroutine and metadata requests keep being served. For
+example, with `threads: 8` in both configs:
+
+    $ beet -c gunicorn.yaml beetstream
+    $ beet -c uvicorn.yaml beetstream
+    $ python benchmarks/slow_readers.py gunicorn=http://localhost:8081 uvicorn=http://localhost:8082
+
+Songs should be larger than a few MB, so that the streams can't be sent
+into the sockets' buffers at once. Only the standard library is needed.
+"""
+
+import argparse
+import socket
+import time
+from urllib.parse import urlsplit
+
+from loadtest import Client, auth_params, percentile, song_ids
+
+RECEIVE_BUFFER = 4096
+
+def open_reader(url, client, id):
+    """Sends a stream request and never reads its response. Servers out of
+    threads don't even start it.
+    """
+    url = urlsplit(url)
+    sock = socket.create_connection((url.hostname, url.port or 80), timeout=10)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    path = client.path('stream', {'id': id, 'format': 'raw'})
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n\r\n".encode('ascii'))
+    return sock
+
+class TimedClient(Client):
+    """A client whose requests fail after `timeout` seconds."""
+    def __init__(self, url, params, timeout):
+        super().__init__(url, params)
+        self.timeout_ = timeout
+
+    def connect(self):
+        conn = super().connect()
+        conn.timeout = self.timeout_
+        return conn
+
+def latencies(url, params, endpoint, count, timeout, **request_params):
+    """Times `count` requests, each on a new connection. Returns the
+    latencies of the successful ones and the number of failures.
+    """
+    times = []
+    failures = 0
+    for _ in range(count):
+        client = TimedClient(url, params, timeout)
+        start = time.perf_counter()
+        ok, _ = client.get(endpoint, **request_params)
+        if ok:
+            times.append(time.perf_counter() - start)
+        else:
+            failures += 1
+        client.close()
+    return sorted(times), failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('targets', nargs='+', metavar='[NAME=]URL',
+                        help='servers to compare, e.g. uvicorn=http://localhost:8082')
+    parser.add_argument('-n', '--readers', type=int, nargs='+', default=[0, 50, 200],
+                        help='slow readers to open (default: 0 50 200)')
+    parser.add_argument('-r', '--requests', type=int, default=20,
+                        help='timed requests per endpoint (default: 20)')
+    parser.add_argument('-t', '--timeout', type=float, default=5,
+                        help='seconds after which a request fails (default: 5)')
+    parser.add_argument('-u', '--user', default='loadtest')
+    parser.add_argument('-p', '--password', default='')
+    args = parser.parse_args()
+
+    targets = []
+    for target in args.targets:
+        name, sep, url = target.partition('=')
+        if not sep or '://' in name:
+            name = url = target
+        targets.append((name, url))
+
+    print(f"{'server':<12} {'readers':>7} {'endpoint':<14} {'p50 ms':>8} {'max ms':>8} "
+          f"{'failed':>6}")
+    for name, url in targets:
+        params = auth_params(args.user, args.password)
+        ids = song_ids(url, params, 100)
+        client = Client(url, params)
+        for readers in args.readers:
+            socks = [open_reader(url, client, ids[n % len(ids)]) for n in range(readers)]
+            # Lets the servers fill the readers' buffers and block
+            time.sleep(1)
+            for endpoint, request_params in [('ping', {}),
+                                             ('getAlbumList2', {'type': 'newest', 'size': 50})]:
+                times, failures = latencies(url, params, endpoint, args.requests, args.timeout,
+                                            **request_params)
+                print(f"{name:<12} {readers:>7} {endpoint:<14} "
+                      f"{percentile(times, 0.5) * 1000:>8.1f} "
+                      f"{(times[-1] if times else float('nan')) * 1000:>8.1f} {failures:>6}")
+            for sock in socks:
+                sock.close()
+            time.sleep(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Benchmark of serving original files from /rest/download.
+
+Before: the file was read in 1 KiB chunks by a Python generator, with no
+Content-Length and no Range support, so a client seeking near the end had
+to download the file from the start again. After: the file is sent by
+`flask.send_file` with Range/conditional support. Both are requested
+in-process and their bodies read to the end, for the whole file and for
+its last 64 KiB:
+
+    $ python benchmarks/stream.py --mb 10 50
+
+These are the Python-side costs only: behind gunicorn, waitress or uvicorn
+the body of the new path is sent with sendfile(2), or by nginx/Apache with
+`stream_offload`, and doesn't go through Python at all.
+"""
+
+import argparse
+import mimetypes
+import os
+
+from common import app, make_client, make_library, measure
+from flask import Response, g, request
+
+from beetsplug.beetstream.utils import song_subid_to_beetid
+
+TAIL_SIZE = 64 * 1024
+
+def old_stream():
+    """The /rest/download view before files were sent with send_file."""
+    id = int(song_subid_to_beetid(request.values.get('id')))
+    item = g.lib.get_item(id)
+
+    def generate():
+        with open(item.path, "rb") as songFile:
+            data = songFile.read(1024)
+            while data:
+                yield data
+                data = songFile.read(1024)
+    return Response(generate(), mimetype=mimetypes.guess_type(item.path.decode('utf-8'))[0])
+
+app.add_url_rule('/bench/oldDownload', view_func=old_stream)
+
+def download(client, url, headers=None):
+    """Reads the whole body, returning its status and size."""
+    response = client.get(url, headers=headers, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return response.status_code, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--mb', type=int, nargs='+', default=[10, 50],
+                        help='file sizes, in MB (default: 10 50)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed runs, the median is printed (default: 5)')
+    args = parser.parse_args()
+
+    lib = make_library(1, 1)
+    item = next(iter(lib.items()))
+    os.makedirs(os.path.dirname(item.path), exist_ok=True)
+    client = make_client(lib)
+    urls = [('before', f'/bench/oldDownload?id=3{item.id}'),
+            ('after', f'/rest/download?id=3{item.id}')]
+
+    print(f"{'MB':>4} {'path':<7} {'full MB/s':>10} {'tail ms':>8} {'tail status':>12} "
+          f"{'tail bytes':>11}")
+    for mb in args.mb:
+        size = mb * 1024 * 1024
+        with open(item.path, 'wb') as f:
+            f.write(os.urandom(size))
+        tail = {'Range': f'bytes={size - TAIL_SIZE}-'}
+
+        for name, url in urls:
+            full = measure(lambda: download(client, url), args.repeat)
+            seek = measure(lambda: download(client, url, tail), args.repeat)
+            status, received = download(client, url, tail)
+            print(f"{mb:>4} {name:<7} {mb / full:>10.0f} {seek * 1000:>8.1f} {status:>12} "
+                  f"{received:>11}")
+
+    os.remove(item.path)
+
+if __name__ == '__main__':
+    main()
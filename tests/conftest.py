@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+os.environ.setdefault('BEETSDIR', tempfile.mkdtemp())
+
+import beets
+import pytest
+from beets import library
+from beetsplug.beetstream import app, BeetstreamPlugin
+import beetsplug.beetstream.store as store
+
+@pytest.fixture
+def lib(tmp_path):
+    """A library of one album of three songs."""
+    music = tmp_path / 'music'
+    music.mkdir()
+    beets.config['directory'] = str(music)
+    lib = library.Library(str(tmp_path / 'library.db'), str(music))
+    items = []
+    for track in range(1, 4):
+        path = music / f"{track}.mp3"
+        path.write_bytes(b'\0' * 1000)
+        items.append(library.Item(path=str(path), title=f"Song {track}", album='Album',
+                                  albumartist='Artist', artist='Artist', track=track,
+                                  length=100.0, format='MP3', mtime=path.stat().st_mtime))
+    lib.add_album(items)
+    return lib
+
+@pytest.fixture
+def client(lib, tmp_path):
+    plugin = BeetstreamPlugin()
+    plugin.config['database'] = str(tmp_path / 'beetstream.db')
+    plugin.config['playlist_dir'] = str(tmp_path / 'playlists')
+    (tmp_path / 'playlists').mkdir()
+    app.config['lib'] = lib
+    app.config['INCLUDE_PATHS'] = plugin.config['include_paths']
+    app.config['config'] = plugin.config
+    store._store = None
+    yield app.test_client()
+    store._store = None
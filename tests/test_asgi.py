@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from beetsplug.beetstream.asgi import StreamingApp
+
+DELAY = 0.5
+
+def slow_app(environ, start_response):
+    time.sleep(DELAY)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'].encode('utf-8')]
+
+def scope(path):
+    return {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'query_string': b'',
+        'http_version': '1.1',
+        'headers': [],
+    }
+
+async def request(app, path):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope(path), receive, send)
+    return messages
+
+def test_metadata_requests_run_concurrently():
+    app = StreamingApp(slow_app, threads=4)
+
+    async def main():
+        return await asyncio.gather(request(app, '/rest/getAlbumList2'),
+                                    request(app, '/rest/search3'))
+
+    start = time.perf_counter()
+    first, second = asyncio.run(main())
+    elapsed = time.perf_counter() - start
+
+    assert first[0]['status'] == 200
+    assert first[1]['body'] == b'/rest/getAlbumList2'
+    assert second[1]['body'] == b'/rest/search3'
+    assert elapsed < 2 * DELAY * 0.9
@@ -0,0 +1,42 @@
+from flask import g
+
+from beetsplug.beetstream import app
+from beetsplug.beetstream.playlist import Playlist, song_entries
+
+def test_concurrent_edits_from_two_processes_are_kept(client, lib, tmp_path):
+    path = tmp_path / 'playlists' / 'mix.m3u'
+    path.write_text('#EXTM3U\n')
+    ids = [item.id for item in lib.items()]
+
+    with app.app_context():
+        g.lib = lib
+        # Each server process keeps its own copy of the playlist
+        first = Playlist(path)
+        second = Playlist(path)
+        first.append(song_entries(lib, ids[:1]))
+        second.append(song_entries(lib, ids[1:2]))
+        second.rename('Mix')
+        first.write()
+        second.write()
+
+        assert Playlist(path).get_song_ids() == ids[:2]
+        assert Playlist(path).get_name() == 'Mix'
+        assert second.get_song_ids() == ids[:2]
+
+def test_written_edits_are_not_applied_again(client, lib, tmp_path):
+    path = tmp_path / 'playlists' / 'mix.m3u'
+    path.write_text('#EXTM3U\n')
+    ids = [item.id for item in lib.items()]
+
+    with app.app_context():
+        g.lib = lib
+        first = Playlist(path)
+        second = Playlist(path)
+        first.append(song_entries(lib, ids[:1]))
+        first.write()
+        second.append(song_entries(lib, ids[1:2]))
+        second.write()
+        first.append(song_entries(lib, ids[2:]))
+        first.write()
+
+        assert Playlist(path).get_song_ids() == ids